@@ -11,7 +11,7 @@ from amanda.compiler.parse import parse
 from amanda.compiler.compile import Generator
 from amanda.compiler.semantic import Analyzer
 from amanda.compiler.codegen import ByteGen
-from amanda.libamanda import run_module
+from amanda.libamanda import RawModule, run_raw_module
 
 
 def write_file(name, code):
@@ -32,12 +32,14 @@ def run_frontend(filename):
 
 def run_file(args):
     compiler = ByteGen()
-    bin_obj = compiler.compile(run_frontend(args.file))
+    module = compiler.compile_module(run_frontend(args.file))
 
     if args.debug:
         write_file("debug.amasm", compiler.make_debug_asm())
 
-    exit_code = run_module(bin_obj)
+    exit_code = run_raw_module(
+        RawModule.from_module(module), buffered=args.buffered
+    )
     if exit_code != 0:
         sys.exit(exit_code)
 
@@ -49,6 +51,13 @@ def main(*args):
         "-d", "--debug", help="Generate a debug amasm file", action="store_true"
     )
 
+    parser.add_argument(
+        "-b",
+        "--buffered",
+        help="Write the output in blocks instead of line by line",
+        action="store_true",
+    )
+
     parser.add_argument("file", help="source file to be executed")
 
     if len(args):
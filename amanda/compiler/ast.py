@@ -229,6 +229,8 @@ class Call(Expr):
         super().__init__(paren)
         self.callee = callee
         self.fargs = fargs
+        # Set by the semantic analyser
+        self.symbol = None
         self.tag_children()
 
 
@@ -1,104 +1,399 @@
+"""
+Reads and writes compiled modules in the amac format read by the vm.
+
+A module is laid out as a fixed header followed by a section table and
+the data of each section. Every record has a fixed size and every
+section starts at a multiple of 8 bytes, so a module can be read in
+place (e.g. from a memory mapped .amac file) without being parsed.
+All numbers are little endian.
+
+    header:   magic (b"AMAC"), version (u16), number of sections (u16),
+              entry_locals (u32), entry_max_stack (u32)
+    sections: kind (u32), offset (u32), size (u32) of each section
+"""
+
+import argparse
+from enum import IntEnum
 from io import BytesIO
 import struct
-from typing import Dict, Any, Sized, List, cast
+import sys
+from typing import Dict, Any, List, Tuple, Union
 
+MAGIC = b"AMAC"
+VERSION = 3
 
-def into_bson_int32(number: int) -> bytes:
-    return struct.pack("<l", number)
+HEADER = struct.Struct("<4sHHII")
+SECTION = struct.Struct("<III")
+# Constants: tag, length of the string (strings only), value.
+# The value of a string is its offset in the strings section
+CONST_INT = struct.Struct("<B3xIq")
+CONST_REAL = struct.Struct("<B3xId")
+CONST_REF = struct.Struct("<B3xIQ")
+# Offset and length of a name in the strings section
+NAME = struct.Struct("<II")
+# Name (offset, length), start_ip, locals, params, max_stack,
+# param_types (offset, length)
+FUNCTION = struct.Struct("<IIIIIIII")
 
+# Codes of the types in the param_types of a function. There is one
+# code per param, except that vectors are written as TYPE_VEC followed
+# by the code of their elements (e.g. "[i" is [int])
+TYPE_INT = "i"
+TYPE_REAL = "r"
+TYPE_BOOL = "b"
+TYPE_TEXTO = "t"
+TYPE_INDEF = "x"
+TYPE_VEC = "["
+TYPE_KLASS = "k"
 
-def into_bson_int64(number: int) -> bytes:
-    return struct.pack("<q", number)
+SECTION_ALIGN = 8
 
 
-def into_bson_f64(bson_float: float) -> bytes:
-    return struct.pack("<d", bson_float)
+class Section(IntEnum):
+    CODE = 1
+    CONSTANTS = 2
+    STRINGS = 3
+    GLOBALS = 4
+    FUNCTIONS = 5
+    LINE_TABLE = 6
 
 
-def into_int32(bson_int: bytes) -> int:
-    return cast(int, struct.unpack("<l", bson_int)[0])
+class ConstTag(IntEnum):
+    INT = 0
+    REAL = 1
+    STR = 2
+    BOOL = 3
+    NULL = 4
 
 
-def bson_int32_len(obj: Sized) -> bytes:
-    if len(obj) >= 2 ** (31):
-        raise OverflowError(
-            f"Object too large to be bsonyfied. Object size: {len(obj)}"
+class StringTable:
+    """UTF-8 data of every string in a module. Each string is stored once."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.refs: Dict[str, Tuple[int, int]] = {}
+
+    def add(self, string: str) -> Tuple[int, int]:
+        ref = self.refs.get(string)
+        if ref is None:
+            encoded = string.encode()
+            ref = self.refs[string] = (len(self.data), len(encoded))
+            self.data += encoded
+        return ref
+
+
+def into_varint(number: int) -> bytes:
+    """Encodes an unsigned int using 7 bits per byte (LEB128).
+    The high bit of each byte is set if more bytes follow."""
+    varint = bytearray()
+    while True:
+        byte = number & 0x7F
+        number >>= 7
+        if number:
+            varint.append(byte | 0x80)
+        else:
+            varint.append(byte)
+            return bytes(varint)
+
+
+def pack_line_table(entries: List[Tuple[int, int]]) -> bytes:
+    """
+    Delta encodes a line table sorted by offset.
+    Each (offset, line) entry is written as the distance to the offset of
+    the previous entry (unsigned varint) followed by the difference to
+    the line of the previous entry (zigzag encoded varint).
+    """
+    table = BytesIO()
+    prev_offset, prev_line = 0, 0
+    for offset, line in entries:
+        assert offset >= prev_offset, "Line table must be sorted by offset"
+        line_delta = line - prev_line
+        # Zigzag: maps signed deltas to unsigned ints (0, -1, 1, -2 -> 0, 1, 2, 3)
+        zigzag = line_delta * 2 if line_delta >= 0 else -line_delta * 2 - 1
+        table.write(into_varint(offset - prev_offset))
+        table.write(into_varint(zigzag))
+        prev_offset, prev_line = offset, line
+    return table.getvalue()
+
+
+def read_varint(data: memoryview, pos: int) -> Tuple[int, int]:
+    """Decodes the varint at pos. Returns its value and the position
+    of the next byte."""
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def unpack_line_table(data: memoryview) -> List[Tuple[int, int]]:
+    """Decodes a line table written by pack_line_table."""
+    entries = []
+    pos = offset = line = 0
+    while pos < len(data):
+        offset_delta, pos = read_varint(data, pos)
+        zigzag, pos = read_varint(data, pos)
+        offset += offset_delta
+        line += (zigzag >> 1) ^ -(zigzag & 1)
+        entries.append((offset, line))
+    return entries
+
+
+def pack_constants(constants: List[Any], strings: StringTable) -> bytearray:
+    section = bytearray(CONST_REF.size * len(constants))
+    for i, const in enumerate(constants):
+        offset = i * CONST_REF.size
+        const_t = type(const)
+        if const_t == int:
+            CONST_INT.pack_into(section, offset, ConstTag.INT, 0, const)
+        elif const_t == float:
+            CONST_REAL.pack_into(section, offset, ConstTag.REAL, 0, const)
+        elif const_t == str:
+            str_offset, size = strings.add(const)
+            CONST_REF.pack_into(section, offset, ConstTag.STR, size, str_offset)
+        elif const_t == bool:
+            CONST_REF.pack_into(section, offset, ConstTag.BOOL, 0, const)
+        elif const is None:
+            CONST_REF.pack_into(section, offset, ConstTag.NULL, 0, 0)
+        else:
+            raise NotImplementedError(f"Cannot serialize type: {str(const_t)}")
+    return section
+
+
+def pack_names(names: List[str], strings: StringTable) -> bytearray:
+    section = bytearray(NAME.size * len(names))
+    for i, name in enumerate(names):
+        NAME.pack_into(section, i * NAME.size, *strings.add(name))
+    return section
+
+
+def pack_functions(
+    functions: List[Dict[str, Any]], strings: StringTable
+) -> bytearray:
+    section = bytearray(FUNCTION.size * len(functions))
+    for i, func in enumerate(functions):
+        FUNCTION.pack_into(
+            section,
+            i * FUNCTION.size,
+            *strings.add(func["name"]),
+            func["start_ip"],
+            func["locals"],
+            func["params"],
+            func["max_stack"],
+            *strings.add(func["param_types"]),
         )
-    return into_bson_int32(len(obj))
+    return section
+
+
+def align(offset: int) -> int:
+    return -(-offset // SECTION_ALIGN) * SECTION_ALIGN
 
 
-def dump_value(buf: BytesIO, type_code: bytes, *args: bytes) -> None:
-    buf.write(type_code)
-    for arg in args:
-        buf.write(arg)
+def pack_sections(module: Dict[str, Any]) -> List[Tuple[Section, Any]]:
+    """Returns the data of each section of a module, in the order
+    they are written."""
+    strings = StringTable()
+    sections = [
+        (Section.CODE, module["ops"]),
+        (Section.CONSTANTS, pack_constants(module["constants"], strings)),
+        (Section.GLOBALS, pack_names(module["globals"], strings)),
+        (Section.FUNCTIONS, pack_functions(module["functions"], strings)),
+        (Section.LINE_TABLE, module["line_table"]),
+    ]
+    # Every string is known once the other sections are packed
+    sections.insert(2, (Section.STRINGS, strings.data))
+    return sections
 
 
-def dumps(data: Dict[str, Any]) -> bytes:
+def dumps(module: Dict[str, Any]) -> bytes:
     """
-    Converts bytecode ops and extra metadata into the BSON format.
-    Link to the spec: https://bsonspec.org/spec.html
+    Converts bytecode ops and extra metadata into the amac format.
     """
-    document = BytesIO()
-    e_list = BytesIO()
-    for key, value in data.items():
-        val_t = type(value)
-        if val_t == float:
-            dump_value(
-                e_list, b"\x01", key.encode(), b"\x00", into_bson_f64(value)
-            )
-        elif val_t == str:
-            str_bytes = value.encode()
-            str_len = bson_int32_len(str_bytes)
-            dump_value(
-                e_list,
-                b"\x02",
-                key.encode(),
-                b"\x00",
-                str_len,
-                value.encode(),
-                b"\x00",
-            )
-        elif val_t == dict:
-            dump_value(
-                e_list,
-                b"\x03",
-                key.encode(),
-                b"\x00",
-                dumps(value),
-            )
-        elif val_t == list:
-            arr_obj = {}
-            for i, val in enumerate(value):
-                arr_obj[str(i)] = val
-            dump_value(
-                e_list,
-                b"\x04",
-                key.encode(),
-                b"\x00",
-                dumps(arr_obj),
-            )
-        elif val_t == bytes:
-            size = len(value)
-            dump_value(
-                e_list,
-                b"\x05",
-                key.encode(),
-                b"\x00",
-                into_bson_int32(size),
-                b"\x80",
-                value,
-            )
-        elif val_t == int:
-            dump_value(
-                e_list, b"\x12", key.encode(), b"\x00", into_bson_int64(value)
+    sections = pack_sections(module)
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for kind, data in sections:
+        offset = align(offset)
+        table.append((kind, offset, len(data)))
+        offset += len(data)
+    if offset >= 2**32:
+        raise OverflowError(
+            f"Module too large to be serialized. Module size: {offset}"
+        )
+
+    buf = bytearray(offset)
+    HEADER.pack_into(
+        buf,
+        0,
+        MAGIC,
+        VERSION,
+        len(sections),
+        module["entry_locals"],
+        module["entry_max_stack"],
+    )
+    for i, (entry, (_, data)) in enumerate(zip(table, sections)):
+        SECTION.pack_into(buf, HEADER.size + i * SECTION.size, *entry)
+        _, offset, size = entry
+        buf[offset : offset + size] = data
+    return bytes(buf)
+
+
+def read_sections(data: Union[bytes, memoryview]) -> Dict[Section, memoryview]:
+    """
+    Returns a view over the data of each section of a module.
+    Raises ValueError if data is not a module this version can read.
+    """
+    view = memoryview(data)
+    if len(view) < HEADER.size or view[:4] != MAGIC:
+        raise ValueError("Not an amac module")
+    _, version, count, _, _ = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise ValueError(f"Unsupported module version: {version}")
+    sections = {}
+    for i in range(count):
+        kind, offset, size = SECTION.unpack_from(
+            view, HEADER.size + i * SECTION.size
+        )
+        try:
+            sections[Section(kind)] = view[offset : offset + size]
+        except ValueError:
+            # Sections added by newer compilers are skipped
+            continue
+    return sections
+
+
+def unpack_constants(data: memoryview, strings: memoryview) -> List[Any]:
+    constants: List[Any] = []
+    for offset in range(0, len(data), CONST_REF.size):
+        tag = data[offset]
+        if tag == ConstTag.INT:
+            constants.append(CONST_INT.unpack_from(data, offset)[2])
+        elif tag == ConstTag.REAL:
+            constants.append(CONST_REAL.unpack_from(data, offset)[2])
+        elif tag == ConstTag.STR:
+            _, size, str_offset = CONST_REF.unpack_from(data, offset)
+            constants.append(
+                str(strings[str_offset : str_offset + size], "utf-8")
             )
+        elif tag == ConstTag.BOOL:
+            constants.append(CONST_REF.unpack_from(data, offset)[2] != 0)
+        elif tag == ConstTag.NULL:
+            constants.append(None)
         else:
-            raise NotImplementedError(f"Cannot serialize type: {str(val_t)}")
-    doc_len = bson_int32_len(e_list.getvalue())
-    document.write(doc_len)
-    document.write(e_list.getvalue())
-    document.write(b"\x00")
-    doc = document.getvalue()
-    document.close()
-    e_list.close()
-    return doc
+            raise ValueError(f"Unknown constant tag: {tag}")
+    return constants
+
+
+def loads(data: Union[bytes, memoryview]) -> Dict[str, Any]:
+    """
+    Reads a module written by dumps. ops and line_table are views
+    over data, so no bytes are copied.
+    """
+    sections = read_sections(data)
+    _, _, _, entry_locals, entry_max_stack = HEADER.unpack_from(data)
+    empty = memoryview(b"")
+    strings = sections.get(Section.STRINGS, empty)
+
+    def name(offset: int, size: int) -> str:
+        return str(strings[offset : offset + size], "utf-8")
+
+    functions = [
+        {
+            "name": name(offset, size),
+            "start_ip": start_ip,
+            "locals": locals_,
+            "params": params,
+            "max_stack": max_stack,
+            "param_types": name(*param_types),
+        }
+        for (
+            offset,
+            size,
+            start_ip,
+            locals_,
+            params,
+            max_stack,
+            *param_types,
+        ) in FUNCTION.iter_unpack(sections.get(Section.FUNCTIONS, empty))
+    ]
+    return {
+        "entry_locals": entry_locals,
+        "entry_max_stack": entry_max_stack,
+        "constants": unpack_constants(
+            sections.get(Section.CONSTANTS, empty), strings
+        ),
+        "globals": [
+            name(*ref)
+            for ref in NAME.iter_unpack(sections.get(Section.GLOBALS, empty))
+        ],
+        "ops": sections.get(Section.CODE, empty),
+        "functions": functions,
+        "line_table": sections.get(Section.LINE_TABLE, empty),
+    }
+
+
+def read_module(filename: str) -> bytes:
+    """Returns the module stored in an .amac file or the module
+    compiled from an amanda source file."""
+    if not filename.endswith(".ama"):
+        with open(filename, "rb") as module_file:
+            return module_file.read()
+    # Imported here to avoid a circular import with codegen
+    from amanda.__main__ import run_frontend
+    from amanda.compiler.codegen import ByteGen
+
+    return ByteGen().compile(run_frontend(filename))
+
+
+def count_ops(code: memoryview) -> int:
+    from amanda.compiler.codegen import OP_INFO, OPCODES
+
+    count = ip = 0
+    while ip < len(code):
+        ip += OP_INFO[OPCODES[code[ip]]].size
+        count += 1
+    return count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Prints the size of each section of a compiled module"
+    )
+    parser.add_argument(
+        "file", help="amac module or amanda source file to compile"
+    )
+    args = parser.parse_args()
+
+    data = read_module(args.file)
+    try:
+        sections = read_sections(data)
+    except ValueError as e:
+        sys.exit(f"{args.file}: {e}")
+    module = loads(data)
+    counts = {
+        Section.CODE: count_ops(module["ops"]),
+        Section.CONSTANTS: len(module["constants"]),
+        Section.STRINGS: None,
+        Section.GLOBALS: len(module["globals"]),
+        Section.FUNCTIONS: len(module["functions"]),
+        Section.LINE_TABLE: len(unpack_line_table(module["line_table"])),
+    }
+    print(f"module:      {args.file}")
+    print(f"version:     {VERSION}")
+    print(f"total size:  {len(data)} bytes")
+    print(f"header size: {HEADER.size + SECTION.size * len(sections)} bytes")
+    locals_, max_stack = module["entry_locals"], module["entry_max_stack"]
+    print(f"entry frame: {locals_} locals, max stack {max_stack}")
+    print()
+    print(f"{'section':<12}{'size':>10}{'entries':>10}")
+    for kind, section in sections.items():
+        count = counts[kind]
+        entries = "" if count is None else count
+        print(f"{kind.name.lower():<12}{len(section):>10}{entries:>10}")
+
+
+if __name__ == "__main__":
+    main()
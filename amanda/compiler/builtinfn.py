@@ -9,9 +9,37 @@ class BuiltinFn(enum.Enum):
     TAM = "tam"
     ANEXA = "anexa"
     REMOVA = "remova"
+    LEIA_INTS = "leia_ints"
+    LEIA_REAIS = "leia_reais"
+    LEIA_LINHAS = "leia_linhas"
 
     def __str__(self) -> str:
         return f"{self.value}"
 
 
 BUILTINS = {key.lower(): value for key, value in BuiltinFn.__members__.items()}
+
+# Element type of the vector returned by each of the bulk input builtins
+BULK_READS = {
+    BuiltinFn.LEIA_INTS: "int",
+    BuiltinFn.LEIA_REAIS: "real",
+    BuiltinFn.LEIA_LINHAS: "texto",
+}
+
+# Native functions in the order of the builtin table of the vm.
+# Must match the order used by load_builtins in vm/src/builtins.rs
+NATIVES = (
+    "escrevaln",
+    "escreva",
+    "leia",
+    "leia_int",
+    "leia_real",
+    "tam",
+    "vec",
+    "anexa",
+    "remova",
+    "txt_contem",
+    "leia_ints",
+    "leia_reais",
+    "leia_linhas",
+)
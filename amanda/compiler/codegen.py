@@ -1,14 +1,26 @@
 import sys
 import pdb
-from typing import List
-from io import StringIO, BytesIO
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Callable,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from io import StringIO
 from enum import Enum, auto
 import amanda.compiler.symbols as symbols
-from amanda.compiler.type import Type, Kind
+from amanda.compiler.type import Type, Kind, Vector
 import amanda.compiler.ast as ast
 from amanda.compiler.tokens import TokenType as TT
 from amanda.compiler.error import AmandaError, throw_error
 from amanda.compiler import bindump
+from amanda.compiler.builtinfn import NATIVES
 import struct
 
 
@@ -41,11 +53,11 @@ class OpCode(Enum):
     OP_INDEX_GET = auto()
     # Performs TOS-2[TOS-1] = TOS.
     OP_INDEX_SET = auto()
-    # Gets a global variable. The arg is the index to the name of the var on the
-    # constant table. Pushes value to the top of the stack
+    # Gets a global variable. The arg is the slot of the var in the
+    # globals table. Pushes value to the top of the stack
     GET_GLOBAL = auto()
-    # Sets global variable. The arg is the index to the name of the var on the
-    # constant table. Pops TOS and sets it as the value of the local
+    # Sets global variable. The arg is the slot of the var in the
+    # globals table. Pops TOS and sets it as the value of the global
     SET_GLOBAL = auto()
     # Sets the pc to the arg.
     JUMP = auto()
@@ -70,85 +82,364 @@ class OpCode(Enum):
     # Builds a vec using elements on the stack. 8-bit arg indicates the number of elements
     # on the stack to use.
     BUILD_VEC = auto()
+    # Superinstructions. These are never emitted directly by the code generator,
+    # they are produced by the op fusion pass (see ByteGen.fuse_ops).
+    # Adds the constant at the index given by the second 16-bit arg to the local in the
+    # slot given by the first 16-bit arg. Replaces GET_LOCAL x; LOAD_CONST k; OP_ADD; SET_LOCAL x
+    INC_LOCAL = auto()
+    # Performs the binary op given by the 8-bit arg using the locals in the slots
+    # given by the two 16-bit args as operands. Pushes the result onto the stack.
+    # Replaces GET_LOCAL a; GET_LOCAL b; OP_*
+    BINOP_LOCALS = auto()
+    # Compares TOS-1 and TOS using the comparison op given by the 8-bit arg.
+    # If the result is false, sets the pc to the 64-bit arg. Pops both operands.
+    # Replaces OP_<cmp>; JUMP_IF_FALSE
+    COMPARE_AND_JUMP = auto()
+    # Pushes a copy of TOS onto the stack
+    DUP = auto()
+    # If TOS == false, sets the pc to the arg and leaves TOS on the stack.
+    # Otherwise pops TOS. Used to short-circuit 'e'
+    JUMP_IF_FALSE_OR_POP = auto()
+    # If TOS == true, sets the pc to the arg and leaves TOS on the stack.
+    # Otherwise pops TOS. Used to short-circuit 'ou'
+    JUMP_IF_TRUE_OR_POP = auto()
+    # Short and near forms of the jump ops. Instead of an absolute 64-bit address,
+    # they take a signed offset relative to the start of the op: 8-bit for
+    # the short forms and 16-bit for the near forms. Chosen by ByteGen.relax_jumps
+    JUMP_SHORT = auto()
+    JUMP_NEAR = auto()
+    JUMP_IF_FALSE_SHORT = auto()
+    JUMP_IF_FALSE_NEAR = auto()
+    COMPARE_AND_JUMP_SHORT = auto()
+    COMPARE_AND_JUMP_NEAR = auto()
+    JUMP_IF_FALSE_OR_POP_SHORT = auto()
+    JUMP_IF_FALSE_OR_POP_NEAR = auto()
+    JUMP_IF_TRUE_OR_POP_SHORT = auto()
+    JUMP_IF_TRUE_OR_POP_NEAR = auto()
+    # Calls the function at the index given by the 16-bit arg in the functions
+    # of the module. The 8-bit arg is the number of args.
+    # Emitted instead of GET_GLOBAL f; CALL_FUNCTION when f is known statically
+    CALL_DIRECT = auto()
+    # Calls the native function at the index given by the 16-bit arg in the builtin
+    # table of the vm (see builtinfn.NATIVES). The 8-bit arg is the number of args.
+    CALL_NATIVE = auto()
+    # Like CALL_DIRECT, but reuses the frame of the current function instead of
+    # pushing a new one. Emitted for 'retorna f(...)'. Never falls through.
+    TAIL_CALL = auto()
+    # Pops TOS. Discards the value of expressions used as statements
+    POP = auto()
     # Stops execution of the VM. Must always be added to stop execution of the vm
     HALT = 0xFF
 
     def op_size(self) -> int:
-        # Return number of bytes (including args) that each op
-        # uses
-        num_ops = len(list(OpCode))
-        assert (
-            num_ops == 32
-        ), f"Please update the size of ops after adding a new Op. New size: {num_ops}"
-        if self in (
-            OpCode.CALL_FUNCTION,
-            OpCode.CAST,
-            OpCode.BUILD_STR,
-            OpCode.BUILD_VEC,
-        ):
-            return OP_SIZE * 2
-        elif self in (
-            OpCode.LOAD_CONST,
-            OpCode.SET_LOCAL,
-            OpCode.GET_LOCAL,
-            OpCode.GET_GLOBAL,
-            OpCode.SET_GLOBAL,
-        ):
-            return OP_SIZE * 3
-        elif self in (
-            OpCode.JUMP,
-            OpCode.JUMP_IF_FALSE,
-        ):
-            return OP_SIZE * 9
-        else:
-            return OP_SIZE
+        # Return number of bits (including args) that each op uses
+        return OP_INFO[self].size * OP_SIZE
+
+    def stack_effect(self, args: Sequence[Any] = (), jump: bool = False) -> int:
+        """Returns the net change in the size of the stack after the op
+        is executed. If jump is set, returns the change when the op jumps."""
+        effect = OP_INFO[self].stack_effect
+        if jump:
+            effect = JUMP_STACK_EFFECTS.get(JUMP_FORM_OF[self][0], effect)
+        return effect(*args) if callable(effect) else effect
 
     def __str__(self) -> str:
         return str(self.value)
 
 
+# Net effect of each op on the size of the stack.
+# Ops whose effect depends on their args map to a function of the args.
+# The short and near forms of jumps use the effect of their long form
+StackEffect = Union[int, Callable[..., int]]
+STACK_EFFECTS: Dict[OpCode, StackEffect] = {
+    OpCode.MOSTRA: -1,
+    OpCode.LOAD_CONST: 1,
+    OpCode.OP_ADD: -1,
+    OpCode.OP_MINUS: -1,
+    OpCode.OP_MUL: -1,
+    OpCode.OP_DIV: -1,
+    OpCode.OP_FLOORDIV: -1,
+    OpCode.OP_MODULO: -1,
+    OpCode.OP_INVERT: 0,
+    OpCode.OP_AND: -1,
+    OpCode.OP_OR: -1,
+    OpCode.OP_NOT: 0,
+    OpCode.OP_EQ: -1,
+    OpCode.OP_NOTEQ: -1,
+    OpCode.OP_GREATER: -1,
+    OpCode.OP_GREATEREQ: -1,
+    OpCode.OP_LESS: -1,
+    OpCode.OP_LESSEQ: -1,
+    OpCode.OP_INDEX_GET: -1,
+    OpCode.OP_INDEX_SET: -3,
+    OpCode.GET_GLOBAL: 1,
+    OpCode.SET_GLOBAL: -1,
+    OpCode.JUMP: 0,
+    OpCode.JUMP_IF_FALSE: -1,
+    OpCode.GET_LOCAL: 1,
+    OpCode.SET_LOCAL: -1,
+    # Pops the args and the callee, pushes the result
+    OpCode.CALL_FUNCTION: lambda argc: -argc,
+    OpCode.RETURN: -1,
+    OpCode.CAST: -1,
+    OpCode.BUILD_STR: lambda n: 1 - n,
+    OpCode.BUILD_VEC: lambda n: 1 - n,
+    OpCode.INC_LOCAL: 0,
+    OpCode.BINOP_LOCALS: 1,
+    OpCode.COMPARE_AND_JUMP: -2,
+    OpCode.DUP: 1,
+    OpCode.JUMP_IF_FALSE_OR_POP: -1,
+    OpCode.JUMP_IF_TRUE_OR_POP: -1,
+    OpCode.CALL_DIRECT: lambda func, argc: 1 - argc,
+    OpCode.CALL_NATIVE: lambda func, argc: 1 - argc,
+    OpCode.TAIL_CALL: lambda func, argc: -argc,
+    OpCode.POP: -1,
+    OpCode.HALT: 0,
+}
+
+# Effect of the jump ops that leave the stack as it is when they jump
+JUMP_STACK_EFFECTS: Dict[OpCode, StackEffect] = {
+    OpCode.JUMP_IF_FALSE_OR_POP: 0,
+    OpCode.JUMP_IF_TRUE_OR_POP: 0,
+}
+
+
+# Ops that can be used as the operation of a BINOP_LOCALS
+FUSABLE_BINOPS = (
+    OpCode.OP_ADD,
+    OpCode.OP_MINUS,
+    OpCode.OP_MUL,
+    OpCode.OP_DIV,
+    OpCode.OP_FLOORDIV,
+    OpCode.OP_MODULO,
+    OpCode.OP_EQ,
+    OpCode.OP_NOTEQ,
+    OpCode.OP_GREATER,
+    OpCode.OP_GREATEREQ,
+    OpCode.OP_LESS,
+    OpCode.OP_LESSEQ,
+)
+
+# Ops that can be used as the comparison of a COMPARE_AND_JUMP
+FUSABLE_CMPS = (
+    OpCode.OP_EQ,
+    OpCode.OP_NOTEQ,
+    OpCode.OP_GREATER,
+    OpCode.OP_GREATEREQ,
+    OpCode.OP_LESS,
+    OpCode.OP_LESSEQ,
+)
+
+# Maps the long form of each jump op to its short and near forms
+JUMP_FORMS = {
+    OpCode.JUMP: (OpCode.JUMP_SHORT, OpCode.JUMP_NEAR),
+    OpCode.JUMP_IF_FALSE: (
+        OpCode.JUMP_IF_FALSE_SHORT,
+        OpCode.JUMP_IF_FALSE_NEAR,
+    ),
+    OpCode.COMPARE_AND_JUMP: (
+        OpCode.COMPARE_AND_JUMP_SHORT,
+        OpCode.COMPARE_AND_JUMP_NEAR,
+    ),
+    OpCode.JUMP_IF_FALSE_OR_POP: (
+        OpCode.JUMP_IF_FALSE_OR_POP_SHORT,
+        OpCode.JUMP_IF_FALSE_OR_POP_NEAR,
+    ),
+    OpCode.JUMP_IF_TRUE_OR_POP: (
+        OpCode.JUMP_IF_TRUE_OR_POP_SHORT,
+        OpCode.JUMP_IF_TRUE_OR_POP_NEAR,
+    ),
+}
+
+# Range of the relative offset of the short and near forms
+JUMP_RANGES = ((-(2**7), 2**7 - 1), (-(2**15), 2**15 - 1))
+
+# Maps every form of a jump to its long form and the index of the form
+# (0: short, 1: near, 2: long)
+JUMP_FORM_OF = {
+    **{op: (op, 2) for op in JUMP_FORMS},
+    **{
+        form: (op, i)
+        for op, forms in JUMP_FORMS.items()
+        for i, form in enumerate(forms)
+    },
+}
+
+# Maps ops that jump to the position of the label in their args
+JUMP_OPS = {
+    op: 1 if JUMP_FORM_OF[op][0] == OpCode.COMPARE_AND_JUMP else 0
+    for op in JUMP_FORM_OF
+}
+
+# Ops after which execution never falls through to the next op
+TERMINATORS = (OpCode.JUMP, OpCode.RETURN, OpCode.TAIL_CALL, OpCode.HALT)
+
+# struct formats of the args of each op. All args are big endian.
+# Ops that are not listed have no args
+ARG_FORMATS = {
+    OpCode.LOAD_CONST: ">H",
+    OpCode.GET_GLOBAL: ">H",
+    OpCode.SET_GLOBAL: ">H",
+    OpCode.GET_LOCAL: ">H",
+    OpCode.SET_LOCAL: ">H",
+    OpCode.CALL_FUNCTION: ">B",
+    OpCode.CAST: ">B",
+    OpCode.BUILD_STR: ">B",
+    OpCode.BUILD_VEC: ">B",
+    OpCode.INC_LOCAL: ">HH",
+    OpCode.BINOP_LOCALS: ">BHH",
+    OpCode.CALL_DIRECT: ">HB",
+    OpCode.CALL_NATIVE: ">HB",
+    OpCode.TAIL_CALL: ">HB",
+    # Jumps: the label arg is encoded as an absolute address (long form)
+    # or as an offset relative to the start of the op (short and near forms)
+    **{op: ">Q" for op in JUMP_FORMS},
+    **{short: ">b" for short, _ in JUMP_FORMS.values()},
+    **{near: ">h" for _, near in JUMP_FORMS.values()},
+    OpCode.COMPARE_AND_JUMP: ">BQ",
+    OpCode.COMPARE_AND_JUMP_SHORT: ">Bb",
+    OpCode.COMPARE_AND_JUMP_NEAR: ">Bh",
+}
+
+
+class OpInfo(NamedTuple):
+    size: int  # Size in bytes, including the op itself
+    encoding: struct.Struct  # Encodes the op followed by its args
+    stack_effect: StackEffect
+
+
+# Static metadata of every op
+OP_INFO: Dict[OpCode, OpInfo] = {}
+for op in OpCode:
+    encoding = struct.Struct(">B" + ARG_FORMATS.get(op, ">")[1:])
+    effect = STACK_EFFECTS[JUMP_FORM_OF.get(op, (op,))[0]]
+    OP_INFO[op] = OpInfo(encoding.size, encoding, effect)
+
+# Maps the value of each op to the op
+OPCODES = {op.value: op for op in OpCode}
+
+
+# (op, args, lineno) entry of ByteGen.ops
+Op = Tuple[OpCode, Tuple[Any, ...], int]
+# A rewrite rule (see ByteGen.rewrite_ops) returns None or the number
+# of ops consumed and the ops that replace them
+Rewrite = Optional[Tuple[int, List[Op]]]
+Rule = Callable[[int, Set[int]], Rewrite]
+
+
+def decode_op(
+    code: Union[bytes, bytearray, memoryview], ip: int
+) -> Tuple[OpCode, Tuple[Any, ...]]:
+    """Decodes the op at offset ip of code. Returns the op and its args,
+    with the target of jumps as an absolute offset."""
+    op = OPCODES[code[ip]]
+    args = OP_INFO[op].encoding.unpack_from(code, ip)[1:]
+    if op in JUMP_OPS and JUMP_FORM_OF[op][1] != 2:
+        label_idx = JUMP_OPS[op]
+        args = (*args[:label_idx], args[label_idx] + ip)
+    return op, args
+
+
+TYPE_CODES = {
+    Kind.TINT: bindump.TYPE_INT,
+    Kind.TREAL: bindump.TYPE_REAL,
+    Kind.TBOOL: bindump.TYPE_BOOL,
+    Kind.TTEXTO: bindump.TYPE_TEXTO,
+    Kind.TINDEF: bindump.TYPE_INDEF,
+    Kind.TKLASS: bindump.TYPE_KLASS,
+}
+
+
+def type_code(param_type: Type) -> str:
+    """Returns the code of a type in the param_types of a function record."""
+    if isinstance(param_type, Vector):
+        return bindump.TYPE_VEC + type_code(param_type.element_type)
+    return TYPE_CODES[param_type.kind]
+
+
 class ByteGen:
     """
     Converts an amanda AST into executable bytecode instructions.
     """
 
     CONST_TABLE = 0
-    NAME_TABLE = 1
-
-    def __init__(self):
+    GLOBAL_TABLE = 1
+
+    def __init__(
+        self,
+        fuse_ops: bool = True,
+        peephole: bool = True,
+        relax_jumps: bool = True,
+        promote_globals: bool = True,
+        stream: bool = False,
+    ) -> None:
         self.depth = -1
         self.ama_lineno = 1  # tracks lineno in input amanda src
-        self.program_symtab = None
-        self.scope_symtab = None
-        self.func_locals = {}
-        self.const_table = {}
-        self.names = {}
-        self.labels = {}
-        self.ops = []
-        self.funcs = []
-        self.ip = 0  # Current bytecode offset
+        self.program_symtab: Optional[symbols.Scope] = None
+        self.scope_symtab: Optional[symbols.Scope] = None
+        # Maps local symbols to their slot in the frame
+        self.func_locals: Dict[symbols.Symbol, int] = {}
+        self.next_local = 0  # First free slot in the current frame
+        self.num_locals = 0  # Number of slots used by the current frame
+        # Value of next_local when each block was entered
+        self.block_locals: List[int] = []
+        self.const_table: Dict[Tuple[type, Any], int] = {}
+        # Key of each constant in const_table, by index
+        self.const_keys: List[Tuple[type, Any]] = []
+        self.globals: Dict[str, int] = {}  # Maps global names to their slot
+        # Maps labels to their position in self.ops
+        self.labels: Dict[int, Any] = {}
+        self.ops: List[Op] = []
+        self.offsets: List[int] = []  # Bytecode offset of each op. Set by layout
+        self.code = bytearray()  # Encoded ops
+        # Maps labels that are not placed yet to the jumps
+        # that must be patched once they are (stream mode)
+        self.fixups: Dict[int, List[Tuple[int, OpCode, Tuple[Any, ...]]]] = {}
+        self.funcs: List[Dict[str, Any]] = []
+        # Maps function names to their index in self.funcs
+        self.func_index: Dict[str, int] = {}
         self.lineno = -1
         self.ctx_loop_start = -1
         self.ctx_loop_exit = -1
-        self.src_map = {}  # Maps source lines to bytecode offset
-
-    def compile(self, program) -> bytes:
+        # (offset, line) of each run of ops generated for the same
+        # source line, sorted by offset. Set by layout
+        self.line_table: List[Tuple[int, int]] = []
+        self.should_fuse_ops = fuse_ops
+        self.should_peephole = peephole
+        self.removed_ops = 0  # Number of ops removed by the peephole pass
+        self.should_relax_jumps = relax_jumps
+        self.should_promote_globals = promote_globals
+        # In stream mode ops are encoded as soon as they are generated
+        # and self.ops is not kept. The passes that rewrite self.ops
+        # are skipped and jumps keep their long form
+        self.stream = stream
+
+    def compile(self, program: ast.Program) -> bytes:
         """Compiles an amanda ast into bytecode ops.
         Returns a serialized object that contains the bytecode and
         other info used at runtime.
         """
+        return bindump.dumps(self.compile_module(program))
+
+    def compile_module(self, program: ast.Program) -> Dict[str, Any]:
+        """Compiles an amanda ast into bytecode ops.
+        Returns the bytecode and other info used at runtime
+        without serializing them.
+        """
         self.program_symtab = self.scope_symtab = program.symbols
         # Define builtin constants
-        self.get_table_index("verdadeiro", self.CONST_TABLE)
-        self.get_table_index("falso", self.CONST_TABLE)
+        self.get_table_index(True, self.CONST_TABLE)
+        self.get_table_index(False, self.CONST_TABLE)
         sym_types = (
             symbols.VariableSymbol,
             symbols.FunctionSymbol,
             Type,
         )
+        assert program.symbols is not None, "Program was not analysed!"
+        # Every global (builtins included) gets a fixed slot
         for name, symbol in program.symbols.symbols.items():
-            if type(symbol) in sym_types:
-                self.get_table_index(name, self.NAME_TABLE)
+            if type(symbol) in sym_types and not self.is_entry_local(symbol):
+                self.get_table_index(name, self.GLOBAL_TABLE)
 
         self.compile_block(program)
         assert self.depth == -1, "A block was not exited in some local scope!"
@@ -156,99 +447,392 @@ class ByteGen:
         self.lineno = 0
         self.append_op(OpCode.HALT)
 
-        ops = BytesIO()
-        for op in self.ops:
-            ops.write(self.write_op_bytes(op))
-        code = ops.getvalue()
-        ops.close()
-
-        src_map = []
-        for lineno, offsets in self.src_map.items():
-            if lineno == 0:
-                continue
-            # Offset array must contain start and end
-            # If it only contains one value, start == end
-            if len(offsets) == 1:
-                offsets.append(offsets[0])
-            assert (
-                len(offsets) == 2
-            ), f"Found line with offset != 2: {(lineno, offsets)}"
-            offsets.append(lineno)
-            src_map.extend(offsets)
-        module = {
-            "entry_locals": len(self.func_locals),
-            "constants": list(self.const_table.keys()),
-            "names": list(self.names.keys()),
-            "ops": code,
-            "functions": self.funcs,
-            "src_map": src_map,
+        if self.stream:
+            assert not self.fixups, "Some labels were never placed!"
+        else:
+            if self.should_peephole:
+                self.peephole()
+            if self.should_fuse_ops:
+                self.fuse_ops()
+            if self.should_relax_jumps:
+                self.relax_jumps()
+            else:
+                self.layout()
+            self.code = bytearray(self.offsets[-1])
+            for op, ip in zip(self.ops, self.offsets):
+                self.pack_op(self.code, op, ip)
+
+        functions = [
+            {
+                "name": func["name"],
+                "start_ip": self.label_offset(func["start_ip"]),
+                "locals": func["locals"],
+                "params": func["params"],
+                "param_types": func["param_types"],
+                "max_stack": self.max_stack(
+                    self.label_offset(func["start_ip"])
+                ),
+            }
+            for func in self.funcs
+        ]
+        return {
+            "entry_locals": self.num_locals,
+            "entry_max_stack": self.max_stack(0),
+            "constants": [const for _, const in self.const_table],
+            "globals": list(self.globals.keys()),
+            "ops": self.code,
+            "functions": functions,
+            "line_table": bindump.pack_line_table(self.line_table),
         }
 
-        return bindump.dumps(module)
-
-    def new_label(self) -> str:
+    def new_label(self) -> int:
         idx = len(self.labels)
-        self.labels[idx] = self.ip  # Placeholder value
+        # Placeholder value. In stream mode None marks labels not placed yet
+        self.labels[idx] = None if self.stream else len(self.ops)
         return idx
 
-    def patch_label_loc(self, label) -> str:
-        if self.ip > (2 ** 64) - 1:
+    def patch_label_loc(self, label: int) -> None:
+        if not self.stream:
+            self.labels[label] = len(self.ops)
+            return
+        ip = len(self.code)
+        self.labels[label] = ip
+        # Patch the forward jumps emitted before the label was placed
+        for jump_ip, op, args in self.fixups.pop(label, ()):
+            label_idx = JUMP_OPS[op]
+            args = (*args[:label_idx], ip)
+            OP_INFO[op].encoding.pack_into(self.code, jump_ip, op.value, *args)
+
+    def label_offset(self, label: int) -> int:
+        """Returns the bytecode offset a label points to."""
+        pos: int = self.labels[label]
+        return pos if self.stream else self.offsets[pos]
+
+    def append_op(self, op: OpCode, *args: Any) -> None:
+        if self.stream:
+            self.emit_op(op, args)
+        else:
+            self.ops.append((op, args, self.lineno))
+
+    def emit_op(self, op: OpCode, args: Tuple[Any, ...]) -> None:
+        """Encodes op at the end of self.code. Jumps to labels that
+        are not placed yet are patched by patch_label_loc."""
+        ip = len(self.code)
+        if not self.line_table or self.line_table[-1][1] != self.lineno:
+            self.line_table.append((ip, self.lineno))
+        if op in JUMP_OPS:
+            label_idx = JUMP_OPS[op]
+            label = args[label_idx]
+            target = self.labels[label]
+            if target is None:
+                self.fixups.setdefault(label, []).append((ip, op, args))
+                target = 0
+            args = (*args[:label_idx], target)
+        self.code += OP_INFO[op].encoding.pack(op.value, *args)
+
+    def layout(self) -> None:
+        """Computes the bytecode offset of every op and the line table
+        that maps offsets back to source lines.
+        Must run after all passes over self.ops."""
+        self.offsets = []
+        self.line_table = []
+        ip = 0
+        for op, _, lineno in self.ops:
+            self.offsets.append(ip)
+            # A new entry starts whenever the line changes
+            if not self.line_table or self.line_table[-1][1] != lineno:
+                self.line_table.append((ip, lineno))
+            ip += OP_INFO[op].size
+        # Labels may point to the end of the code
+        self.offsets.append(ip)
+        if ip > (2 ** 64) - 1:
             raise Exception(
-                f"Address of jump ({self.ip}) is too large to be supported by the vm"
+                f"Address of jump ({ip}) is too large to be supported by the vm"
             )
-        self.labels[label] = self.ip
-
-    def append_op(self, op, *args):
-        if self.lineno in self.src_map:
-            offsets = self.src_map[self.lineno]
-            if len(offsets) < 2:
-                offsets.append(self.ip)
-            elif offsets[-1] < self.ip:
-                offsets[-1] = self.ip
-        else:
-            self.src_map[self.lineno] = [self.ip]
-        self.ip += op.op_size() // OP_SIZE
-        self.ops.append((op, args))
 
-    def load_const(self, const):
+    def max_stack(self, start: int) -> int:
+        """Returns the maximum size reached by the operand stack
+        when running the code that starts at offset start of self.code.
+        Calls do not leave the current code, so only
+        the ops of a single function are visited."""
+        depths = {start: 0}
+        pending = [start]
+        max_depth = 0
+        while pending:
+            pos = pending.pop()
+            depth = depths[pos]
+            while True:
+                op, args = decode_op(self.code, pos)
+                if op in JUMP_OPS:
+                    target = args[JUMP_OPS[op]]
+                    target_depth = depth + op.stack_effect(args, jump=True)
+                    if target not in depths:
+                        depths[target] = target_depth
+                        pending.append(target)
+                    assert (
+                        depths[target] == target_depth
+                    ), f"Stack size mismatch at op {target}"
+                depth += op.stack_effect(args)
+                assert depth >= 0, f"Stack underflow at op {pos}"
+                max_depth = max(max_depth, depth)
+                if JUMP_FORM_OF.get(op, (op,))[0] in TERMINATORS:
+                    break
+                pos += OP_INFO[op].size
+                if pos in depths:
+                    assert (
+                        depths[pos] == depth
+                    ), f"Stack size mismatch at op {pos}"
+                    break
+                depths[pos] = depth
+        return max_depth
+
+    def relax_jumps(self) -> None:
+        """Picks the smallest form for every jump. Every jump starts in its
+        short form and the ones whose target is out of range are widened until
+        the layout no longer changes. Since jumps only grow, this always ends.
+        """
+        ops = self.ops
+        for i, (op, args, lineno) in enumerate(ops):
+            if op in JUMP_FORMS:
+                ops[i] = (JUMP_FORMS[op][0], args, lineno)
+        changed = True
+        while changed:
+            changed = False
+            self.layout()
+            for i, (op, args, lineno) in enumerate(ops):
+                if op not in JUMP_FORM_OF:
+                    continue
+                long_op, form = JUMP_FORM_OF[op]
+                if form == 2:
+                    continue
+                label = args[JUMP_OPS[op]]
+                offset = self.offsets[self.labels[label]] - self.offsets[i]
+                while form < 2:
+                    low, high = JUMP_RANGES[form]
+                    if low <= offset <= high:
+                        break
+                    form += 1
+                new_op = long_op if form == 2 else JUMP_FORMS[long_op][form]
+                if new_op != op:
+                    ops[i] = (new_op, args, lineno)
+                    changed = True
+
+    def rewrite_ops(self, rule: Rule) -> None:
+        """Rewrites self.ops using rule. rule is called with the position
+        of an op and the set of positions that are jump targets and returns
+        either None, to keep the op, or a tuple with the number of ops consumed
+        and the ops that replace them. Labels are moved along with the ops
+        they point to, so only the first op of a window may be a jump target."""
+        targets = self.jump_targets()
+        new_ops: List[Op] = []
+        new_pos = {}
+        i = 0
+        while i < len(self.ops):
+            new_pos[i] = len(new_ops)
+            match = rule(i, targets)
+            if match is None:
+                new_ops.append(self.ops[i])
+                i += 1
+                continue
+            consumed, replacement = match
+            assert not any(
+                pos in targets for pos in range(i + 1, i + consumed)
+            ), "Ops that are jump targets can not be rewritten"
+            new_ops.extend(replacement)
+            # Labels that are not jumped to may still point inside the window
+            for pos in range(i + 1, i + consumed):
+                new_pos[pos] = len(new_ops)
+            i += consumed
+        new_pos[len(self.ops)] = len(new_ops)
+        for label, pos in self.labels.items():
+            self.labels[label] = new_pos[pos]
+        self.ops = new_ops
+
+    def jump_targets(self) -> Set[int]:
+        """Returns the positions of the ops that are targets of jumps
+        or the start of a function."""
+        labels = {func["start_ip"] for func in self.funcs}
+        for op, args, _ in self.ops:
+            if op in JUMP_OPS:
+                labels.add(args[JUMP_OPS[op]])
+        return {self.labels[label] for label in labels}
+
+    def peephole(self) -> None:
+        """Cleans up the ops emitted by the generator. Runs until no
+        more ops can be removed."""
+        num_ops = len(self.ops)
+        while True:
+            self.rewrite_ops(self.thread_jump)
+            self.rewrite_ops(self.remove_dead_code())
+            self.rewrite_ops(self.peephole_window)
+            if len(self.ops) == num_ops:
+                break
+            self.removed_ops += num_ops - len(self.ops)
+            num_ops = len(self.ops)
+
+    def label_target(self, label: int) -> Optional[Op]:
+        """Returns the op a label points to or None if it points to the
+        end of the code."""
+        pos = self.labels[label]
+        return self.ops[pos] if pos < len(self.ops) else None
+
+    def thread_jump(self, i: int, targets: Set[int]) -> Rewrite:
+        # Jumps to unconditional jumps go straight to the final target.
+        # Jumps to the next op are removed.
+        op, args, lineno = self.ops[i]
+        if op not in JUMP_OPS:
+            return None
+        label_idx = JUMP_OPS[op]
+        label = args[label_idx]
+        new_op = op
+        seen = {label}
+        target = self.label_target(label)
+        while target:
+            target_op, target_args, _ = target
+            if target_op == OpCode.JUMP:
+                pass
+            # A short-circuited value that reaches a test of the same
+            # condition would jump again
+            elif new_op == OpCode.JUMP_IF_FALSE_OR_POP and target_op in (
+                OpCode.JUMP_IF_FALSE_OR_POP,
+                OpCode.JUMP_IF_FALSE,
+            ):
+                new_op = target_op
+            elif (
+                new_op == OpCode.JUMP_IF_TRUE_OR_POP
+                and target_op == OpCode.JUMP_IF_TRUE_OR_POP
+            ):
+                pass
+            else:
+                break
+            if target_args[0] in seen:
+                break
+            label = target_args[0]
+            seen.add(label)
+            target = self.label_target(label)
+        if op == OpCode.JUMP and self.labels[label] == i + 1:
+            return (1, [])
+        if label == args[label_idx]:
+            return None
+        args = (*args[:label_idx], label, *args[label_idx + 1 :])
+        op = new_op
+        return (1, [(op, args, lineno)])
+
+    def remove_dead_code(self) -> Rule:
+        # Ops that follow a jump, a return or a halt can only be
+        # reached if they are the target of a jump
+        reachable = True
+
+        def rule(i: int, targets: Set[int]) -> Rewrite:
+            nonlocal reachable
+            if i in targets:
+                reachable = True
+            if not reachable:
+                return (1, [])
+            reachable = self.ops[i][0] not in TERMINATORS
+            return None
+
+        return rule
+
+    def peephole_window(self, i: int, targets: Set[int]) -> Rewrite:
+        ops = self.ops
+        if i + 1 >= len(ops) or i + 1 in targets:
+            return None
+        (op_a, args_a, line_a), (op_b, args_b, line_b) = ops[i], ops[i + 1]
+        # SET_x n; GET_x n -> DUP; SET_x n
+        for set_op, get_op in (
+            (OpCode.SET_LOCAL, OpCode.GET_LOCAL),
+            (OpCode.SET_GLOBAL, OpCode.GET_GLOBAL),
+        ):
+            if op_a == set_op and op_b == get_op and args_a == args_b:
+                return (2, [(OpCode.DUP, (), line_a), ops[i]])
+
+        if i + 2 >= len(ops) or i + 2 in targets:
+            return None
+        op_c, args_c, _ = ops[i + 2]
+        # LOAD_CONST int; GET_GLOBAL real; CAST 0 -> LOAD_CONST real
+        if (
+            op_a == OpCode.LOAD_CONST
+            and op_b == OpCode.GET_GLOBAL
+            and args_b[0] == self.globals.get("real")
+            and op_c == OpCode.CAST
+            and args_c[0] == 0
+        ):
+            const_t, const = self.const_keys[args_a[0]]
+            if const_t == int:
+                idx = self.get_table_index(float(const), self.CONST_TABLE)
+                return (3, [(OpCode.LOAD_CONST, (idx,), line_a)])
+        return None
+
+    def fuse_ops(self) -> None:
+        """Replaces common op sequences with superinstructions."""
+        self.rewrite_ops(self.fuse_window)
+
+    def fuse_window(self, i: int, targets: Set[int]) -> Rewrite:
+        ops = self.ops
+
+        def window(size: int) -> Optional[List[Op]]:
+            # Ops in a window can not be jumped into
+            if i + size > len(ops) or any(
+                pos in targets for pos in range(i + 1, i + size)
+            ):
+                return None
+            return ops[i : i + size]
+
+        # GET_LOCAL x; LOAD_CONST k; OP_ADD; SET_LOCAL x
+        # LOAD_CONST k; GET_LOCAL x; OP_ADD; SET_LOCAL x
+        w = window(4)
+        if w and w[2][0] == OpCode.OP_ADD and w[3][0] == OpCode.SET_LOCAL:
+            (op_a, args_a, _), (op_b, args_b, _) = w[0], w[1]
+            slot = w[3][1][0]
+            if op_a == OpCode.LOAD_CONST and op_b == OpCode.GET_LOCAL:
+                (op_a, args_a), (op_b, args_b) = (op_b, args_b), (op_a, args_a)
+            if (
+                op_a == OpCode.GET_LOCAL
+                and op_b == OpCode.LOAD_CONST
+                and args_a[0] == slot
+            ):
+                return (4, [(OpCode.INC_LOCAL, (slot, args_b[0]), w[3][2])])
+
+        # GET_LOCAL a; GET_LOCAL b; OP_*
+        w = window(3)
+        if (
+            w
+            and w[0][0] == OpCode.GET_LOCAL
+            and w[1][0] == OpCode.GET_LOCAL
+            and w[2][0] in FUSABLE_BINOPS
+        ):
+            args: Tuple[Any, ...] = (w[2][0].value, w[0][1][0], w[1][1][0])
+            return (3, [(OpCode.BINOP_LOCALS, args, w[2][2])])
+
+        # OP_<cmp>; JUMP_IF_FALSE
+        w = window(2)
+        if w and w[0][0] in FUSABLE_CMPS and w[1][0] == OpCode.JUMP_IF_FALSE:
+            args = (w[0][0].value, w[1][1][0])
+            return (2, [(OpCode.COMPARE_AND_JUMP, args, w[0][2])])
+        return None
+
+    def load_const(self, const: Any) -> None:
         self.append_op(
             OpCode.LOAD_CONST, self.get_table_index(const, self.CONST_TABLE)
         )
 
-    def format_u64_arg(self, arg) -> List[int]:
-        u64 = struct.pack(">Q", arg)
-        return [int(b) for b in u64]
-
-    def format_u16_arg(self, arg):
-        high = (arg & 0xFF00) >> 8
-        low = arg & 0x00FF
-        return high, low
-
-    def write_op_bytes(self, op) -> bytes:
-        op, args = op
-        # Get patched jump label
-        if op in (OpCode.JUMP_IF_FALSE, OpCode.JUMP):
-            args = [self.labels[args[0]]]
-
-        if op.op_size() == OP_SIZE:
-            return bytes([op.value])
-        elif op.op_size() == OP_SIZE * 2:
-            return bytes([op.value, args[0]])
-        elif op.op_size() == OP_SIZE * 3:
-            high, low = self.format_u16_arg(args[0])
-            return bytes([op.value, high, low])
-        elif op.op_size() == OP_SIZE * 9:
-            u64 = self.format_u64_arg(args[0])
-            return bytes([op.value, *u64])
-        else:
-            raise NotImplementedError(
-                f"Encoding of op {op.name} has not yet been implemented"
-            )
+    def pack_op(self, code: bytearray, entry: Op, ip: int) -> None:
+        """Encodes an entry of self.ops into code at offset ip."""
+        op, args, _ = entry
+        if op in JUMP_OPS:
+            # Replace the label with the address of the jump
+            label_idx = JUMP_OPS[op]
+            target = self.label_offset(args[label_idx])
+            if JUMP_FORM_OF[op][1] != 2:
+                target -= ip
+            args = (*args[:label_idx], target)
+        OP_INFO[op].encoding.pack_into(code, ip, op.value, *args)
 
     def disassemble_op(self, op, args) -> str:
-        if op in (OpCode.JUMP_IF_FALSE, OpCode.JUMP):
-            # get jump address
-            args = [self.labels[args[0]]]
+        args = list(args)
+        if op == OpCode.BINOP_LOCALS or JUMP_OPS.get(op) == 1:
+            args[0] = OpCode(args[0]).name
         if len(args):
             op_args = " ".join([str(s) for s in args])
             return f"{op_args}"
@@ -258,21 +842,23 @@ class ByteGen:
     def make_debug_asm(self) -> str:
         debug_out = StringIO()
         debug_out.write(f".entry_space: ")
-        debug_out.write(str(len(self.func_locals)))
+        debug_out.write(str(self.num_locals))
         debug_out.write("\n")
+        debug_out.write(f".removed_ops: {self.removed_ops}\n")
         debug_out.write(".consts\n")
-        for const, i in self.const_table.items():
-            debug_out.write(f"{i}: {const}\n")
-        debug_out.write(".names\n")
-        for name, i in self.names.items():
+        for (_, const), i in self.const_table.items():
+            debug_out.write(f"{i}: {const!r}\n")
+        debug_out.write(".globals\n")
+        for name, i in self.globals.items():
             debug_out.write(f"{i}: {name}\n")
         debug_out.write(".ops\n")
 
-        i = 0
-        for op, args in self.ops:
+        ip = 0
+        while ip < len(self.code):
+            op, args = decode_op(self.code, ip)
             op_args = self.disassemble_op(op, args)
-            debug_out.write(f"{i}: {op.name} {op_args}".strip() + "\n")
-            i += op.op_size() // OP_SIZE
+            debug_out.write(f"{ip}: {op.name} {op_args}".strip() + "\n")
+            ip += OP_INFO[op].size
 
         return self.build_str(debug_out)
 
@@ -303,43 +889,93 @@ class ByteGen:
     def enter_block(self, scope):
         self.depth += 1
         self.scope_symtab = scope
+        self.block_locals.append(self.next_local)
 
     def exit_block(self):
         self.depth -= 1
         self.scope_symtab = self.scope_symtab.enclosing_scope
-        num_locals = len(self.func_locals)
+        # Locals of the block are out of scope, so their
+        # slots can be reused by the blocks that come after it
+        self.next_local = self.block_locals.pop()
+
+    def define_local(self, symbol: symbols.Symbol) -> int:
+        """Assigns the first free slot in the current frame to a local."""
+        slot = self.next_local
+        self.func_locals[symbol] = slot
+        self.next_local += 1
+        self.num_locals = max(self.num_locals, self.next_local)
+        return slot
+
+    def gen_statement(self, node: Any) -> None:
+        self.gen(node)
+        # Discard the value of expressions that are used as statements
+        if isinstance(node, ast.Expr) and not isinstance(
+            node, (ast.Assign, ast.IndexSet, ast.Set)
+        ):
+            self.append_op(OpCode.POP)
 
     def compile_block(self, node):
         self.enter_block(node.symbols)
         for child in node.children:
-            self.gen(child)
+            self.gen_statement(child)
         self.exit_block()
 
     def get_table_index(self, item, table):
         # TODO: Make load const instruction use 64 bit arg
-        tab = self.const_table if table == self.CONST_TABLE else self.names
+        tab = self.const_table if table == self.CONST_TABLE else self.globals
+        if table == self.CONST_TABLE:
+            # Constants are keyed by type as well as value,
+            # otherwise 1, 1.0 and verdadeiro would share a slot
+            item = (type(item), item)
         if item in tab:
             idx = tab[item]
         else:
             idx = len(tab)
             tab[item] = idx
+            if table == self.CONST_TABLE:
+                self.const_keys.append(item)
         assert (
             idx < (2 ** 16) - 1
         ), f"Too many items in a single table for the current file."
         return idx
 
     def gen_constant(self, node):
-        literal = str(node.token.lexeme)
-        idx = self.get_table_index(literal, self.CONST_TABLE)
+        token = node.token
+        lexeme = token.lexeme
+        if token.token == TT.INTEGER:
+            value = int(lexeme)
+        elif token.token == TT.REAL:
+            value = float(lexeme)
+        elif token.token == TT.STRING:
+            # Strip the delimiters
+            value = lexeme[1:-1]
+        elif token.token in (TT.VERDADEIRO, TT.FALSO):
+            value = token.token == TT.VERDADEIRO
+        else:
+            value = None
+        idx = self.get_table_index(value, self.CONST_TABLE)
         self.append_op(OpCode.LOAD_CONST, idx)
         self.gen_auto_cast(node.prom_type)
 
+    def is_entry_local(self, symbol: symbols.Symbol) -> bool:
+        """Top-level variables that are never used inside a function
+        are stored as locals of the entry frame instead of globals."""
+        return (
+            self.should_promote_globals
+            and isinstance(symbol, symbols.VariableSymbol)
+            and symbol.is_global
+            and not symbol.used_in_func
+        )
+
+    def is_global(self, symbol: symbols.Symbol) -> bool:
+        return symbol.is_global and not self.is_entry_local(symbol)
+
     def load_variable(self, symbol):
         name = symbol.name
-        if symbol.is_global:
-            self.append_op(OpCode.GET_GLOBAL, self.names[name])
+        if self.is_global(symbol):
+            self.append_op(OpCode.GET_GLOBAL, self.globals[name])
         else:
-            self.append_op(OpCode.GET_LOCAL, self.func_locals[symbol.out_id])
+            self.append_op(OpCode.GET_LOCAL, self.func_locals[symbol])
 
     def gen_variable(self, node):
         name = node.token.lexeme
@@ -363,29 +999,26 @@ class ByteGen:
         # Find a better way to do this
         init_values = {
             "int": 0,
-            "real": "0.0",  # Warning: This might come back to haunt me
-            "bool": "falso",
-            "texto": "''",
+            "real": 0.0,
+            "bool": False,
+            "texto": "",
         }
         if assign:
             self.gen_assign(assign)
         else:
-            initializer = init_values.get(str(node.var_type), "falso")
+            initializer = init_values.get(str(node.var_type), False)
             init_idx = self.get_table_index(initializer, self.CONST_TABLE)
             self.append_op(OpCode.LOAD_CONST, init_idx)
             self.set_variable(symbol)
 
     def set_variable(self, symbol):
         name = symbol.name
-        if symbol.is_global:
-            var_idx = self.get_table_index(name, self.NAME_TABLE)
-            self.append_op(OpCode.SET_GLOBAL, var_idx)
+        if self.is_global(symbol):
+            self.append_op(OpCode.SET_GLOBAL, self.globals[name])
         else:
-            local = symbol.out_id
-            if local not in self.func_locals:
-                idx = len(self.func_locals)
-                self.func_locals[local] = idx
-            self.append_op(OpCode.SET_LOCAL, self.func_locals[local])
+            if symbol not in self.func_locals:
+                self.define_local(symbol)
+            self.append_op(OpCode.SET_LOCAL, self.func_locals[symbol])
 
     # TODO: Test whether chained assign still with
     # mixture of normal assigns and index set (Potential bug)
@@ -417,10 +1050,26 @@ class ByteGen:
             )
         self.gen_auto_cast(node.prom_type)
 
-    def gen_binop(self, node):
+    def gen_logical_op(self, node: ast.BinOp) -> None:
+        # Right operand is only evaluated if the left one
+        # does not determine the result
+        operator = node.token.token
+        after_op = self.new_label()
         self.gen(node.left)
+        if operator == TT.E:
+            self.append_op(OpCode.JUMP_IF_FALSE_OR_POP, after_op)
+        else:
+            self.append_op(OpCode.JUMP_IF_TRUE_OR_POP, after_op)
         self.gen(node.right)
+        self.patch_label_loc(after_op)
+        self.gen_auto_cast(node.prom_type)
+
+    def gen_binop(self, node):
         operator = node.token.token
+        if operator in (TT.E, TT.OU):
+            return self.gen_logical_op(node)
+        self.gen(node.left)
+        self.gen(node.right)
         if operator == TT.PLUS:
             self.append_op(OpCode.OP_ADD)
         elif operator == TT.MINUS:
@@ -433,10 +1082,6 @@ class ByteGen:
             self.append_op(OpCode.OP_FLOORDIV)
         elif operator == TT.MODULO:
             self.append_op(OpCode.OP_MODULO)
-        elif operator == TT.E:
-            self.append_op(OpCode.OP_AND)
-        elif operator == TT.OU:
-            self.append_op(OpCode.OP_OR)
         elif operator == TT.DOUBLEEQUAL:
             self.append_op(OpCode.OP_EQ)
         elif operator == TT.NOTEQUAL:
@@ -500,7 +1145,7 @@ class ByteGen:
         self.append_op(OpCode.JUMP_IF_FALSE, after_loop)
         # Block
         for child in block.children:
-            self.gen(child)
+            self.gen_statement(child)
         self.append_op(OpCode.JUMP, loop)
         # END LOOP
         self.patch_label_loc(after_loop)
@@ -536,7 +1181,7 @@ class ByteGen:
         self.append_op(OpCode.JUMP_IF_FALSE, after_loop)
         # Body
         for child in block.children:
-            self.gen(child)
+            self.gen_statement(child)
         # update: control_var += inc
         self.gen(range_expr.inc)
         self.load_variable(control_var)
@@ -552,55 +1197,96 @@ class ByteGen:
     def gen_functiondecl(self, node):
         func_symbol = self.scope_symtab.resolve(node.name.lexeme)
         name = func_symbol.name
-        name_idx = self.get_table_index(func_symbol.name, self.NAME_TABLE)
         func_end = self.new_label()
 
         self.append_op(OpCode.JUMP, func_end)
         func_start = self.new_label()
+        self.patch_label_loc(func_start)
+        # Register the function before generating the body
+        # so that recursive calls can refer to it
+        # start_ip is resolved into an offset after layout
+        # TODO: use uint64 for ip and locals
+        func = {
+            "name": name,
+            "start_ip": func_start,
+            "locals": 0,
+            "params": len(func_symbol.params),
+            "param_types": "".join(
+                type_code(param.type) for param in func_symbol.params.values()
+            ),
+        }
+        self.func_index[name] = len(self.funcs)
+        self.funcs.append(func)
 
         block = node.block
 
-        prev_func_locals = self.func_locals
+        prev_frame = (self.func_locals, self.next_local, self.num_locals)
         self.func_locals = {}
+        self.next_local = self.num_locals = 0
         for param in func_symbol.params.values():
-            local = param.out_id
-            idx = len(self.func_locals)
-            self.func_locals[local] = idx
+            self.define_local(param)
 
         self.enter_block(block.symbols)
         for child in block.children:
-            self.gen(child)
+            self.gen_statement(child)
         # default return
-        self.load_const("falso")
+        self.load_const(False)
         self.append_op(OpCode.RETURN)
         self.exit_block()
-        num_locals = len(self.func_locals)
-        self.func_locals = prev_func_locals
+        func["locals"] = self.num_locals
+        self.func_locals, self.next_local, self.num_locals = prev_frame
 
         self.patch_label_loc(func_end)
-        # TODO: use uint64 for ip and locals
-        self.funcs.append(
-            {
-                "name": name,
-                "start_ip": self.labels[func_start],
-                "locals": num_locals,
-            }
-        )
 
     def gen_call(self, node):
         func = node.symbol
         # Push and store params
         for arg in node.fargs:
             self.gen(arg)
-        self.gen(node.callee)
-        self.append_op(OpCode.CALL_FUNCTION, len(node.fargs))
+        argc = len(node.fargs)
+        # Skip the lookup of the callee if it is known statically
+        call_op = self.get_direct_call(node)
+        if call_op == OpCode.CALL_DIRECT:
+            self.append_op(call_op, self.func_index[func.name], argc)
+        elif call_op == OpCode.CALL_NATIVE:
+            self.append_op(call_op, NATIVES.index(func.name), argc)
+        else:
+            self.gen(node.callee)
+            self.append_op(OpCode.CALL_FUNCTION, argc)
         self.gen_auto_cast(node.prom_type)
 
+    def get_direct_call(self, node: ast.Call) -> Optional[OpCode]:
+        """Returns the op used to call a statically known callee
+        or None if the callee must be looked up at runtime."""
+        func = node.symbol
+        if not isinstance(node.callee, ast.Variable) or not isinstance(
+            func, symbols.FunctionSymbol
+        ):
+            return None
+        if func.name in self.func_index:
+            return OpCode.CALL_DIRECT
+        if func.is_native and func.name in NATIVES:
+            return OpCode.CALL_NATIVE
+        return None
+
     def gen_retorna(self, node):
+        exp = node.exp
+        # retorna f(...) reuses the frame of the current function.
+        # Calls whose result must be converted are not in tail position
+        if (
+            isinstance(exp, ast.Call)
+            and self.get_direct_call(exp) == OpCode.CALL_DIRECT
+            and not self.needs_auto_cast(exp.prom_type)
+        ):
+            for arg in exp.fargs:
+                self.gen(arg)
+            func_idx = self.func_index[exp.callee.token.lexeme]
+            self.append_op(OpCode.TAIL_CALL, func_idx, len(exp.fargs))
+            return
         if node.exp:
             self.gen(node.exp)
         else:
-            self.load_const("falso")
+            self.load_const(False)
         self.append_op(OpCode.RETURN)
 
     def gen_converta(self, node):
@@ -615,8 +1301,11 @@ class ByteGen:
         arg = 0 if target_t.kind != Kind.TINDEF else 1
         self.append_op(OpCode.CAST, arg)
 
+    def needs_auto_cast(self, prom_type: Optional[Type]) -> bool:
+        return prom_type is not None and prom_type.kind == Kind.TREAL
+
     def gen_auto_cast(self, prom_type):
-        if not prom_type or prom_type.kind != Kind.TREAL:
+        if not self.needs_auto_cast(prom_type):
             return
         self.load_variable(prom_type)
         self.append_op(OpCode.CAST, 0)
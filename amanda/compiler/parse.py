@@ -878,8 +878,15 @@ class Parser:
         char = format_str.read(1)
         parts = []
 
+        # Keep the delimiters so that parts look like regular string literals
+        delim = token.lexeme[0]
         tokenify_str = lambda lexeme: ast.Constant(
-            Token(TT.STRING, lexeme=lexeme, line=token.line, col=token.col)
+            Token(
+                TT.STRING,
+                lexeme=f"{delim}{lexeme}{delim}",
+                line=token.line,
+                col=token.col,
+            )
         )
         # TODO: Reuse this buffer
         current_str = StringIO()
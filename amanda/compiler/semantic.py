@@ -7,7 +7,7 @@ import amanda.compiler.ast as ast
 import amanda.compiler.symbols as symbols
 from amanda.compiler.type import builtin_types, Kind, Type, Vector, Klass
 from amanda.compiler.error import AmandaError
-from amanda.compiler.builtinfn import BUILTINS, BuiltinFn
+from amanda.compiler.builtinfn import BUILTINS, BULK_READS, BuiltinFn
 from amanda.config import STD_LIB
 
 
@@ -293,6 +293,7 @@ class Analyzer(ast.Visitor):
         # Check if non void function has return
         symbol = symbols.FunctionSymbol(name, function_type)
         symbol.is_global = True
+        symbol.is_native = node.is_native
         self.define_symbol(symbol, self.scope_depth, self.ctx_scope)
         scope, symbol.params = self.define_func_scope(name, node.params)
 
@@ -444,6 +445,10 @@ class Analyzer(ast.Visitor):
         node.eval_type = sym.type
         node.var_symbol = sym
         assert node.var_symbol
+        if self.ctx_func is not None and isinstance(
+            sym, symbols.VariableSymbol
+        ):
+            sym.used_in_func = True
         return sym
 
     # This function is everywhere because
@@ -881,6 +886,16 @@ class Analyzer(ast.Visitor):
             node.eval_type = self.global_scope.resolve("int")
             # TODO: Fix this awful hack
             node.symbol = self.global_scope.resolve("tam")
+        elif fn in BULK_READS:
+            self.check_arity(node.fargs, fn, 1)
+            count = node.fargs[0]
+            self.visit(count)
+            if count.eval_type.kind != Kind.TINT:
+                self.error(
+                    f"O argumento 1 da função '{fn}' deve ser um número inteiro"
+                )
+            el_type = self.global_scope.resolve(BULK_READS[fn])
+            node.eval_type = Vector(el_type)
         else:
             raise NotImplementedError(
                 f"Code for the builtin '{fn}' has not been implemented"
@@ -34,6 +34,7 @@ class Symbol:
 class VariableSymbol(Symbol):
     def __init__(self, name, var_type):
         super().__init__(name, var_type)
+        self.used_in_func = False  # Referenced inside a function body
 
     def can_evaluate(self):
         return True
@@ -44,6 +45,7 @@ class FunctionSymbol(Symbol):
         super().__init__(name, func_type)
         self.params = params  # dict of symbols
         self.scope = None
+        self.is_native = False
 
     def __str__(self):
         params = ",".join(self.params)
@@ -1,14 +1,488 @@
 import ctypes
+import struct
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 from amanda.config import LIB_AMA
+from amanda.compiler import bindump
 
 
-# TODO: Use a struct to represent the module instead of using
-# BSON
-def run_module(module_bin: bytes) -> int:
+@lru_cache(maxsize=None)
+def load_library() -> ctypes.CDLL:
+    """Loads the vm and declares the signature of its entry points.
+    The library is only loaded once per process."""
     lib_ama = ctypes.CDLL(LIB_AMA)
-    count = len(module_bin)
-    # Note: Using ubyte to guarantee that arg 1 is an array of bytes
-    # on all platforms
-    ByteArray = ctypes.c_uint8 * count
-    bin_arr = ByteArray(*bytearray(module_bin))
-    return lib_ama.run_module(ctypes.byref(bin_arr), ctypes.c_int32(count))
+    lib_ama.run_module.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_uint32,
+        ctypes.c_bool,
+        ctypes.POINTER(Limits),
+    )
+    lib_ama.run_module.restype = ctypes.c_uint8
+    lib_ama.run_raw_module.argtypes = (
+        ctypes.POINTER(RawModule),
+        ctypes.c_bool,
+        ctypes.POINTER(Limits),
+    )
+    lib_ama.run_raw_module.restype = ctypes.c_uint8
+    lib_ama.load_module.argtypes = (ctypes.c_void_p, ctypes.c_uint32)
+    lib_ama.load_module.restype = ctypes.c_void_p
+    lib_ama.run_session.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_bool,
+        ctypes.POINTER(Limits),
+    )
+    lib_ama.run_session.restype = ctypes.c_uint8
+    lib_ama.run_session_io.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.c_uint32,
+        ctypes.c_uint32,
+        ctypes.POINTER(Limits),
+    )
+    lib_ama.run_session_io.restype = ctypes.c_uint8
+    for accessor in (lib_ama.run_output, lib_ama.run_error):
+        accessor.argtypes = (ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint32))
+        accessor.restype = ctypes.c_void_p
+    lib_ama.call_function.argtypes = (
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_uint32,
+        ctypes.c_void_p,
+        ctypes.c_uint32,
+        ctypes.c_uint32,
+        ctypes.POINTER(Limits),
+    )
+    lib_ama.call_function.restype = ctypes.c_uint8
+    lib_ama.call_output.argtypes = (
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_uint32),
+    )
+    lib_ama.call_output.restype = ctypes.c_void_p
+    lib_ama.free_session.argtypes = (ctypes.c_void_p,)
+    lib_ama.free_session.restype = None
+    lib_ama.dispatch_count.argtypes = ()
+    lib_ama.dispatch_count.restype = ctypes.c_uint64
+    return lib_ama
+
+
+class Py_buffer(ctypes.Structure):
+    """Mirrors the Py_buffer struct of the C API."""
+
+    _fields_ = [
+        ("buf", ctypes.c_void_p),
+        ("obj", ctypes.c_void_p),
+        ("len", ctypes.c_ssize_t),
+        ("itemsize", ctypes.c_ssize_t),
+        ("readonly", ctypes.c_int),
+        ("ndim", ctypes.c_int),
+        ("format", ctypes.c_char_p),
+        ("shape", ctypes.c_void_p),
+        ("strides", ctypes.c_void_p),
+        ("suboffsets", ctypes.c_void_p),
+        ("internal", ctypes.c_void_p),
+    ]
+
+
+# Requests a contiguous buffer, which may be read only
+PyBUF_SIMPLE = 0
+# Declared here instead of through the attributes of ctypes.pythonapi,
+# whose argtypes are shared with every other user of it
+get_buffer = ctypes.PYFUNCTYPE(
+    ctypes.c_int, ctypes.py_object, ctypes.POINTER(Py_buffer), ctypes.c_int
+)(("PyObject_GetBuffer", ctypes.pythonapi))
+release_buffer = ctypes.PYFUNCTYPE(None, ctypes.POINTER(Py_buffer))(
+    ("PyBuffer_Release", ctypes.pythonapi)
+)
+
+
+class BufferPointer:
+    """
+    Pointer to the data of an object that supports the buffer protocol,
+    such as a bytearray or an mmap. The buffer is held until this object
+    is freed, so the data can't be moved or released while the vm reads
+    it. Works for read only buffers too, which ctypes can't point to.
+    """
+
+    def __init__(self, obj: Any):
+        self.buffer = Py_buffer()
+        get_buffer(obj, ctypes.byref(self.buffer), PyBUF_SIMPLE)
+        self.address: int = self.buffer.buf
+        self._as_parameter_ = ctypes.c_void_p(self.address)
+
+    def __del__(self) -> None:
+        release_buffer(ctypes.byref(self.buffer))
+
+
+def as_pointer(
+    module_bin: Union[bytes, bytearray, memoryview],
+) -> Union[bytes, BufferPointer]:
+    """Returns an object that ctypes passes as a pointer to the
+    first byte of module_bin, without copying it. module_bin must be
+    contiguous."""
+    if isinstance(module_bin, bytes):
+        # ctypes passes a pointer to the internal buffer of bytes
+        return module_bin
+    return BufferPointer(module_bin)
+
+
+class RawSlice(ctypes.Structure):
+    _fields_ = [("ptr", ctypes.c_void_p), ("len", ctypes.c_size_t)]
+
+
+class RawModule(ctypes.Structure):
+    """
+    Module handed over to the vm as separate sections instead of a
+    single amac buffer. Mirrors binload::RawModule. Each section holds
+    the same records as in an amac module (see amanda.compiler.bindump).
+    """
+
+    _fields_ = [
+        ("entry_locals", ctypes.c_uint32),
+        ("entry_max_stack", ctypes.c_uint32),
+        ("code", RawSlice),
+        ("constants", RawSlice),
+        ("strings", RawSlice),
+        ("globals", RawSlice),
+        ("functions", RawSlice),
+        ("line_table", RawSlice),
+    ]
+
+    @classmethod
+    def from_module(cls, module: Dict[str, Any]) -> "RawModule":
+        """Builds the struct from the dict returned by
+        ByteGen.compile_module. The code and the line table are passed
+        as built by the compiler. The other sections are packed into
+        records by bindump.pack_sections, as dumps does, so the only
+        work saved is copying every section into one buffer. The
+        sections point into buffers owned by the struct, so it must be
+        kept alive while the vm runs."""
+        raw = cls(module["entry_locals"], module["entry_max_stack"])
+        raw.buffers = []
+        for kind, data in bindump.pack_sections(module):
+            buffer = BufferPointer(data)
+            raw.buffers.append(buffer)
+            slice_ = RawSlice(buffer.address, memoryview(data).nbytes)
+            setattr(raw, kind.name.lower(), slice_)
+        return raw
+
+
+class CancelFlag:
+    """
+    Flag that stops the runs it is given to once it is set. It is
+    meant to be set from another thread while the vm runs.
+    """
+
+    def __init__(self) -> None:
+        self.flag = ctypes.c_bool(False)
+
+    def set(self) -> None:
+        self.flag.value = True
+
+    def clear(self) -> None:
+        self.flag.value = False
+
+    def is_set(self) -> bool:
+        return self.flag.value
+
+
+class Limits(ctypes.Structure):
+    """Mirrors vm::Limits."""
+
+    _fields_ = [("budget", ctypes.c_uint64), ("cancel", ctypes.c_void_p)]
+
+
+# Status returned by the functions that run a module. OK when the
+# program finished, ERROR when it stopped with a runtime error and
+# OUT_OF_BUDGET or CANCELLED when it was stopped by its limits
+OK = 0
+ERROR = 1
+OUT_OF_BUDGET = 2
+CANCELLED = 3
+# Status returned by run_module when the module can't be loaded
+INVALID_MODULE = 4
+
+
+def make_limits(budget: int, cancel: Optional[CancelFlag]) -> Any:
+    """Returns the limits passed to the vm, or None if there are none.
+    The limits are checked at backward jumps and calls, so a run may
+    go a few ops past budget before it is stopped."""
+    if not budget and cancel is None:
+        return None
+    address = ctypes.addressof(cancel.flag) if cancel is not None else None
+    return ctypes.byref(Limits(budget, address))
+
+
+def run_module(
+    module_bin: Union[bytes, bytearray, memoryview],
+    buffered: bool = False,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> int:
+    """
+    Runs a module serialized with bindump.dumps. When buffered is
+    set, the output is written to stdout in blocks instead of line by
+    line. It is still written before input is read and when the
+    program stops.
+
+    Returns OK if the program finished and ERROR if it stopped with a
+    runtime error, which is printed to stderr. The run is stopped with
+    OUT_OF_BUDGET once it dispatches more than
+    budget ops (0 means no limit) and with CANCELLED once cancel is
+    set. Raises ValueError if the module is invalid.
+    """
+    count = memoryview(module_bin).nbytes
+    status: int = load_library().run_module(
+        as_pointer(module_bin), count, buffered, make_limits(budget, cancel)
+    )
+    if status == INVALID_MODULE:
+        raise ValueError("Invalid module")
+    return status
+
+
+def run_raw_module(
+    module: RawModule,
+    buffered: bool = False,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> int:
+    """Runs a module without serializing it. See run_module."""
+    status: int = load_library().run_raw_module(
+        ctypes.byref(module), buffered, make_limits(budget, cancel)
+    )
+    return status
+
+
+def load_module(module_bin: Union[bytes, bytearray, memoryview]) -> int:
+    """Loads a module serialized with bindump.dumps so that it can be
+    run many times with run_session. Returns a handle to the session,
+    which must be released with free_session. Raises ValueError if
+    the module is invalid."""
+    count = memoryview(module_bin).nbytes
+    session: Optional[int] = load_library().load_module(
+        as_pointer(module_bin), count
+    )
+    if session is None:
+        raise ValueError("Invalid module")
+    return session
+
+
+def run_session(
+    session: int,
+    buffered: bool = False,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> int:
+    """Runs the module of a session. Globals, the stack and the values
+    allocated by the previous run are reset before each run. Returns
+    the same status as run_module."""
+    status: int = load_library().run_session(
+        session, buffered, make_limits(budget, cancel)
+    )
+    return status
+
+
+# Default limit of the output captured by run_session_io
+OUTPUT_LIMIT = 16 * 2**20
+
+
+class CapturedRun(NamedTuple):
+    # OK, ERROR, OUT_OF_BUDGET or CANCELLED. See run_module
+    status: int
+    output: bytes
+    # Message of the error that stopped the program. Empty if there was none
+    error: str
+
+
+def read_buffer(accessor: Any, session: int) -> bytes:
+    size = ctypes.c_uint32()
+    return ctypes.string_at(accessor(session, ctypes.byref(size)), size.value)
+
+
+def run_session_io(
+    session: int,
+    stdin: bytes = b"",
+    output_limit: int = OUTPUT_LIMIT,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> CapturedRun:
+    """
+    Runs the module of a session with stdin as its input and captures
+    what it writes instead of printing it. A program that writes more
+    than output_limit bytes is stopped with an error, and the output
+    is cut at the limit. See run_module for budget and cancel.
+    """
+    lib_ama = load_library()
+    status = lib_ama.run_session_io(
+        session,
+        as_pointer(stdin),
+        len(stdin),
+        output_limit,
+        make_limits(budget, cancel),
+    )
+    return CapturedRun(
+        status,
+        read_buffer(lib_ama.run_output, session),
+        read_buffer(lib_ama.run_error, session).decode(),
+    )
+
+
+def run_module_io(
+    module_bin: Union[bytes, bytearray, memoryview],
+    stdin: bytes = b"",
+    output_limit: int = OUTPUT_LIMIT,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> CapturedRun:
+    """Runs a module serialized with bindump.dumps once. See
+    run_session_io."""
+    session = load_module(module_bin)
+    try:
+        return run_session_io(session, stdin, output_limit, budget, cancel)
+    finally:
+        free_session(session)
+
+
+# Tags of the values exchanged with the vm. Mirrors marshal.rs
+VALUE_INT = 0
+VALUE_REAL = 1
+VALUE_STR = 2
+VALUE_BOOL = 3
+VALUE_NULL = 4
+VALUE_VECTOR = 5
+
+INT64 = struct.Struct("<q")
+F64 = struct.Struct("<d")
+UINT32 = struct.Struct("<I")
+
+# Status returned by call_function
+CALL_OK = 0
+CALL_ERROR = 1
+CALL_NOT_FOUND = 2
+CALL_BAD_ARGS = 3
+CALL_BAD_RESULT = 4
+CALL_OUT_OF_BUDGET = 5
+CALL_CANCELLED = 6
+
+
+class OutOfBudget(RuntimeError):
+    pass
+
+
+class Cancelled(RuntimeError):
+    pass
+
+
+def encode_value(value: Any, out: bytearray) -> None:
+    value_t = type(value)
+    if value_t == bool:
+        out.append(VALUE_BOOL)
+        out.append(value)
+    elif value_t == int:
+        out.append(VALUE_INT)
+        out += INT64.pack(value)
+    elif value_t == float:
+        out.append(VALUE_REAL)
+        out += F64.pack(value)
+    elif value_t == str:
+        encoded = value.encode()
+        out.append(VALUE_STR)
+        out += UINT32.pack(len(encoded))
+        out += encoded
+    elif value is None:
+        out.append(VALUE_NULL)
+    elif value_t == list:
+        out.append(VALUE_VECTOR)
+        out += UINT32.pack(len(value))
+        for element in value:
+            encode_value(element, out)
+    else:
+        raise TypeError(f"Cannot convert {value_t.__name__} to an amanda value")
+
+
+def decode_value(data: memoryview, pos: int) -> Tuple[Any, int]:
+    """Decodes the value at pos. Returns it and the position of the
+    next value."""
+    tag = data[pos]
+    pos += 1
+    if tag == VALUE_INT:
+        return INT64.unpack_from(data, pos)[0], pos + INT64.size
+    elif tag == VALUE_REAL:
+        return F64.unpack_from(data, pos)[0], pos + F64.size
+    elif tag == VALUE_STR:
+        size = UINT32.unpack_from(data, pos)[0]
+        pos += UINT32.size
+        return str(data[pos : pos + size], "utf-8"), pos + size
+    elif tag == VALUE_BOOL:
+        return data[pos] != 0, pos + 1
+    elif tag == VALUE_NULL:
+        return None, pos
+    elif tag == VALUE_VECTOR:
+        size = UINT32.unpack_from(data, pos)[0]
+        pos += UINT32.size
+        elements: List[Any] = []
+        for _ in range(size):
+            element, pos = decode_value(data, pos)
+            elements.append(element)
+        return elements, pos
+    raise ValueError(f"Unknown value tag: {tag}")
+
+
+def call_function(
+    session: int,
+    name: str,
+    *args: Any,
+    budget: int = 0,
+    cancel: Optional[CancelFlag] = None,
+) -> Any:
+    """
+    Calls a top level function of the module of a session and returns
+    its result. Arguments and results can be int, float, str, bool
+    and lists of them. Raises TypeError if an argument doesn't match
+    the type of its param. An int is accepted where a real is expected. Globals hold the values left by the last
+    run_session, so the module should be run before its functions
+    are called. A call stopped by its limits (see run_module) raises
+    OutOfBudget or Cancelled. The values allocated by a call are freed
+    when it returns, unless the call stores one of them in a global or
+    in a list that existed before it. Those are kept until the next
+    run_session, so sessions that keep values this way should be run
+    again from time to time.
+    """
+    lib_ama = load_library()
+    encoded = bytearray()
+    for arg in args:
+        encode_value(arg, encoded)
+    name_bytes = name.encode()
+    status = lib_ama.call_function(
+        session,
+        name_bytes,
+        len(name_bytes),
+        as_pointer(encoded),
+        len(encoded),
+        len(args),
+        make_limits(budget, cancel),
+    )
+    output = read_buffer(lib_ama.call_output, session)
+    if status == CALL_OK:
+        return decode_value(memoryview(output), 0)[0]
+    message = output.decode()
+    if status == CALL_NOT_FOUND:
+        raise NameError(message)
+    elif status == CALL_BAD_ARGS:
+        raise TypeError(message)
+    elif status == CALL_BAD_RESULT:
+        raise ValueError(message)
+    elif status == CALL_OUT_OF_BUDGET:
+        raise OutOfBudget(message)
+    elif status == CALL_CANCELLED:
+        raise Cancelled(message)
+    raise RuntimeError(message)
+
+
+def free_session(session: int) -> None:
+    load_library().free_session(session)
+
+
+def dispatch_count() -> int:
+    """Returns the number of ops dispatched by the last module run."""
+    count: int = load_library().dispatch_count()
+    return count
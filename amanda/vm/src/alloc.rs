@@ -5,6 +5,8 @@ use std::ptr;
 struct InnerRef<'a> {
     inner: *mut AmaValue<'a>,
     next: *const InnerRef<'a>,
+    //Number of objects allocated before this one
+    id: u64,
 }
 
 #[derive(Debug, Copy, Clone)]
@@ -24,6 +26,11 @@ impl<'a> Ref<'a> {
          */
         unsafe { &mut (*(*self.0).inner) }
     }
+
+    fn id(&self) -> u64 {
+        //SAFETY: See inner
+        unsafe { (*self.0).id }
+    }
 }
 
 macro_rules! raw_from_box {
@@ -36,6 +43,13 @@ macro_rules! raw_from_box {
 pub struct Alloc<'a> {
     objects: Option<Ref<'a>>,
     null_ref: Option<Ref<'a>>,
+    count: u64,
+    //Objects with an id below scope_start were allocated before the
+    //current scope. u64::MAX when there is no scope
+    scope_start: u64,
+    //Set when an object of the current scope is stored where it
+    //outlives the scope
+    escaped: bool,
 }
 
 impl<'a> Alloc<'a> {
@@ -43,6 +57,9 @@ impl<'a> Alloc<'a> {
         let mut alloc = Alloc {
             objects: None,
             null_ref: None,
+            count: 0,
+            scope_start: u64::MAX,
+            escaped: false,
         };
         //Create a single reference to None to be used
         //by the vm
@@ -62,7 +79,9 @@ impl<'a> Alloc<'a> {
         let ama_ref = Ref(raw_from_box!(InnerRef {
             inner: value_alloc,
             next: ptr::null(),
+            id: self.count,
         }));
+        self.count += 1;
         if let Some(ref object) = self.objects {
             //SAFETY: Pointer obtained from box
             unsafe { &mut *ama_ref.0 }.next = object.0;
@@ -77,4 +96,58 @@ impl<'a> Alloc<'a> {
     pub fn null_ref(&self) -> Ref<'a> {
         self.null_ref.unwrap()
     }
+
+    //Marks the objects allocated so far. See free_after
+    pub fn mark(&self) -> Option<Ref<'a>> {
+        self.objects
+    }
+
+    //Frees every object allocated after mark was taken.
+    //SAFETY: None of the freed objects may be used again
+    pub unsafe fn free_after(&mut self, mark: Option<Ref<'a>>) {
+        let mark = mark.map_or(ptr::null_mut(), |object| object.0);
+        while let Some(object) = self.objects {
+            if object.0 == mark {
+                break;
+            }
+            let inner_ref = Box::from_raw(object.0);
+            drop(Box::from_raw(inner_ref.inner));
+            self.objects = if inner_ref.next.is_null() {
+                None
+            } else {
+                Some(Ref(inner_ref.next as *mut InnerRef))
+            };
+        }
+    }
+
+    //Starts a scope whose objects are freed by end_scope, unless one of
+    //them is stored where it outlives the scope. See note_store
+    pub fn begin_scope(&mut self) -> Option<Ref<'a>> {
+        self.scope_start = self.count;
+        self.escaped = false;
+        self.mark()
+    }
+
+    //Must be called when value is stored in target, or in a global when
+    //target is None
+    pub fn note_store(&mut self, target: Option<Ref<'a>>, value: Ref<'a>) {
+        let is_old = |object: Ref<'a>| object.id() < self.scope_start;
+        if !is_old(value) && target.map_or(true, is_old) {
+            self.escaped = true;
+        }
+    }
+
+    //Ends the scope started by begin_scope and returns whether its
+    //objects were freed.
+    //SAFETY: Only the globals and the objects allocated before the
+    //scope may be used again
+    pub unsafe fn end_scope(&mut self, mark: Option<Ref<'a>>) -> bool {
+        let escaped = self.escaped;
+        if !escaped {
+            self.free_after(mark);
+        }
+        self.scope_start = u64::MAX;
+        self.escaped = false;
+        !escaped
+    }
 }
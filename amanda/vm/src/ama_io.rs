@@ -0,0 +1,266 @@
+use crate::errors::AmaErr;
+use std::fmt;
+use std::io;
+use std::io::{BufRead, Cursor, Write};
+use std::str;
+use std::str::FromStr;
+
+//Where the input read by leia comes from
+enum Input {
+    Stdin,
+    //Input supplied by the host
+    Buffer(Cursor<Vec<u8>>),
+}
+
+impl Input {
+    fn with_reader<T>(
+        &mut self,
+        read: impl FnOnce(&mut dyn BufRead) -> io::Result<T>,
+    ) -> Result<T, AmaErr> {
+        let result = match self {
+            Input::Stdin => read(&mut io::stdin().lock()),
+            Input::Buffer(cursor) => read(cursor),
+        };
+        result.map_err(|_| String::from("Não foi possível ler a entrada"))
+    }
+}
+
+//Reads the next sequence of characters delimited by whitespace into
+//token. The whitespace after it is consumed. Returns false at the end
+//of the input
+fn read_token(reader: &mut dyn BufRead, token: &mut Vec<u8>) -> io::Result<bool> {
+    token.clear();
+    loop {
+        let buf = reader.fill_buf()?;
+        if buf.is_empty() {
+            return Ok(!token.is_empty());
+        }
+        let mut used = 0;
+        let mut found = false;
+        for &byte in buf {
+            used += 1;
+            if !byte.is_ascii_whitespace() {
+                token.push(byte);
+            } else if !token.is_empty() {
+                found = true;
+                break;
+            }
+        }
+        reader.consume(used);
+        if found {
+            return Ok(true);
+        }
+    }
+}
+
+//Size of the blocks written to stdout when the output is buffered
+const BLOCK_SIZE: usize = 64 * 1024;
+
+//Where the output of mostra and escreva goes to
+enum Output {
+    Stdout,
+    //Output is kept in data and written to stdout in blocks. It is
+    //also written when input is read and when the program stops
+    BufferedStdout { data: Vec<u8> },
+    //Output captured for the host. Writing past limit is an error.
+    //error holds the message of the error that stopped the program
+    Buffer {
+        data: Vec<u8>,
+        limit: usize,
+        error: String,
+    },
+}
+
+pub struct AmaIO {
+    input: Input,
+    output: Output,
+}
+
+impl AmaIO {
+    pub fn stdio() -> Self {
+        AmaIO {
+            input: Input::Stdin,
+            output: Output::Stdout,
+        }
+    }
+
+    //Same as stdio, but the output is written to stdout in blocks
+    pub fn buffered_stdio() -> Self {
+        AmaIO {
+            input: Input::Stdin,
+            output: Output::BufferedStdout {
+                data: Vec::with_capacity(BLOCK_SIZE),
+            },
+        }
+    }
+
+    //Reads input from input and captures up to output_limit bytes of output
+    pub fn in_memory(input: &[u8], output_limit: usize) -> Self {
+        AmaIO {
+            input: Input::Buffer(Cursor::new(input.to_vec())),
+            output: Output::Buffer {
+                data: Vec::new(),
+                limit: output_limit,
+                error: String::new(),
+            },
+        }
+    }
+
+    //Used by the write! and writeln! macros
+    pub fn write_fmt(&mut self, args: fmt::Arguments) -> Result<(), AmaErr> {
+        match &mut self.output {
+            Output::Stdout => {
+                let mut stdout = io::stdout().lock();
+                stdout.write_fmt(args).unwrap();
+                stdout.flush().unwrap();
+                Ok(())
+            }
+            Output::BufferedStdout { data } => {
+                data.write_fmt(args).unwrap();
+                if data.len() >= BLOCK_SIZE {
+                    self.flush();
+                }
+                Ok(())
+            }
+            Output::Buffer { data, limit, .. } => {
+                data.write_fmt(args).unwrap();
+                if data.len() > *limit {
+                    data.truncate(*limit);
+                    return Err(String::from("Limite de saída excedido"));
+                }
+                Ok(())
+            }
+        }
+    }
+
+    //Writes the output kept by the buffered mode to stdout
+    pub fn flush(&mut self) {
+        if let Output::BufferedStdout { data } = &mut self.output {
+            let mut stdout = io::stdout().lock();
+            stdout.write_all(data).unwrap();
+            stdout.flush().unwrap();
+            data.clear();
+        }
+    }
+
+    //Reads a line without the line break at the end
+    pub fn read_line(&mut self) -> Result<String, AmaErr> {
+        self.next_line()?.ok_or_else(|| String::from("Fim da entrada"))
+    }
+
+    //Reads count lines, or every line left when count is None
+    pub fn read_lines(&mut self, count: Option<usize>) -> Result<Vec<String>, AmaErr> {
+        let mut lines = Vec::with_capacity(count.unwrap_or(0));
+        while count.map_or(true, |count| lines.len() < count) {
+            match self.next_line()? {
+                Some(line) => lines.push(line),
+                None if count.is_none() => break,
+                None => return Err(String::from("Fim da entrada")),
+            }
+        }
+        Ok(lines)
+    }
+
+    //Reads count values separated by whitespace, or every value left when
+    //count is None. invalid is the error raised for values that can't be parsed
+    pub fn read_values<T: FromStr>(
+        &mut self,
+        count: Option<usize>,
+        invalid: &str,
+    ) -> Result<Vec<T>, AmaErr> {
+        self.flush();
+        self.input.with_reader(|reader| {
+            let mut values = Vec::with_capacity(count.unwrap_or(0));
+            let mut token = Vec::new();
+            while count.map_or(true, |count| values.len() < count) {
+                if !read_token(reader, &mut token)? {
+                    if count.is_none() {
+                        break;
+                    }
+                    return Ok(Err(String::from("Fim da entrada")));
+                }
+                match str::from_utf8(&token).ok().and_then(|token| token.parse().ok()) {
+                    Some(value) => values.push(value),
+                    None => return Ok(Err(String::from(invalid))),
+                }
+            }
+            Ok(Ok(values))
+        })?
+    }
+
+    //Returns None at the end of the input
+    fn next_line(&mut self) -> Result<Option<String>, AmaErr> {
+        //Prompts written before the read must be visible
+        self.flush();
+        let mut line = Vec::new();
+        self.input.with_reader(|reader| reader.read_until(b'\n', &mut line))?;
+        if line.is_empty() {
+            return Ok(None);
+        }
+        if line.ends_with(b"\n") {
+            line.pop();
+            if line.ends_with(b"\r") {
+                line.pop();
+            }
+        }
+        Ok(Some(String::from_utf8_lossy(&line).into_owned()))
+    }
+
+    //Prints the error that stopped the program, or keeps it for the host
+    pub fn report_error(&mut self, err: AmaErr) {
+        match &mut self.output {
+            Output::Stdout | Output::BufferedStdout { .. } => eprint!("{}", err),
+            Output::Buffer { error, .. } => *error = err,
+        }
+    }
+
+    //Returns the output captured so far. Empty when writing to stdout
+    pub fn output(&self) -> &[u8] {
+        match &self.output {
+            Output::Stdout | Output::BufferedStdout { .. } => &[],
+            Output::Buffer { data, .. } => data,
+        }
+    }
+
+    //Returns the error reported by report_error. Empty when there was none
+    pub fn error(&self) -> &str {
+        match &self.output {
+            Output::Stdout | Output::BufferedStdout { .. } => "",
+            Output::Buffer { error, .. } => error,
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_read_lines() {
+        let mut io = AmaIO::in_memory(b"1\r\n\ndois", 0);
+        assert_eq!(io.read_line().unwrap(), "1");
+        assert_eq!(io.read_line().unwrap(), "");
+        assert_eq!(io.read_line().unwrap(), "dois");
+        assert!(io.read_line().is_err());
+    }
+
+    #[test]
+    fn test_read_values() {
+        let mut io = AmaIO::in_memory(b"1 -2\n  3\n4 x\n5\nseis\nsete", 0);
+        assert_eq!(io.read_values::<i64>(Some(3), "").unwrap(), vec![1, -2, 3]);
+        assert_eq!(io.read_values::<i64>(Some(1), "").unwrap(), vec![4]);
+        assert_eq!(io.read_values::<i64>(Some(1), "invalido"), Err(String::from("invalido")));
+        assert_eq!(io.read_values::<f64>(Some(1), "").unwrap(), vec![5.0]);
+        assert_eq!(io.read_lines(None).unwrap(), vec!["seis", "sete"]);
+        assert!(io.read_values::<i64>(Some(1), "").is_err());
+        assert!(io.read_values::<i64>(None, "").unwrap().is_empty());
+    }
+
+    #[test]
+    fn test_output_limit() {
+        let mut io = AmaIO::in_memory(b"", 5);
+        assert!(write!(io, "{}", "abc").is_ok());
+        assert!(write!(io, "{}", 123).is_err());
+        assert_eq!(io.output(), b"abc12");
+    }
+}
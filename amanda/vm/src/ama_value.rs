@@ -1,4 +1,5 @@
 use crate::alloc::{Alloc, Ref};
+use crate::ama_io::AmaIO;
 use crate::errors::AmaErr;
 use crate::opcode::OpCode;
 use std::borrow::Cow;
@@ -51,7 +52,7 @@ pub type FuncArgs<'a, 'args> = &'args [Ref<'a>];
 #[derive(Clone, Copy)]
 pub struct NativeFunc<'a> {
     pub name: &'a str,
-    pub func: fn(FuncArgs<'a, '_>, &mut Alloc<'a>) -> Result<Ref<'a>, AmaErr>,
+    pub func: fn(FuncArgs<'a, '_>, &mut Alloc<'a>, &mut AmaIO) -> Result<Ref<'a>, AmaErr>,
 }
 
 impl<'a> Debug for NativeFunc<'a> {
@@ -69,6 +70,11 @@ pub struct AmaFunc<'a> {
     pub last_i: usize,
     pub bp: isize,
     pub locals: usize,
+    pub params: usize,
+    //Max number of values pushed on top of the locals
+    pub max_stack: usize,
+    //Code of the type of each param (see marshal::check_type)
+    pub param_types: &'a str,
 }
 
 /*Primitive Types*/
@@ -93,7 +99,7 @@ pub enum AmaValue<'a> {
     //Heap objects
     Vector(Vec<Ref<'a>>),
     //TODO: Change this into a Box<str>,
-    Str(Cow<'a, String>),
+    Str(Cow<'a, str>),
 }
 
 impl<'a> AmaValue<'a> {
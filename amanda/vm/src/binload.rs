@@ -1,286 +1,278 @@
 use crate::alloc::{Alloc, Ref};
 use crate::ama_value::{AmaFunc, AmaValue};
 use std::borrow::Cow;
-use std::collections::HashMap;
-use std::io::Cursor;
-use std::io::Read;
-use std::str::FromStr;
-
-#[derive(Debug)]
-pub enum Const {
-    Str(String),
-    Int(i64),
-    Double(f64),
-    Bool(bool),
-}
+use std::cell::OnceCell;
+use std::convert::TryInto;
+use std::slice;
+use std::str;
+
+//Layout of the amac format. See amanda/compiler/bindump.py
+const MAGIC: &[u8] = b"AMAC";
+const VERSION: u16 = 3;
+const HEADER_SIZE: usize = 16;
+const SECTION_SIZE: usize = 12;
+const CONST_SIZE: usize = 16;
+const NAME_SIZE: usize = 8;
+const FUNCTION_SIZE: usize = 32;
+
+//Section kinds
+const CODE: u32 = 1;
+const CONSTANTS: u32 = 2;
+const STRINGS: u32 = 3;
+const GLOBALS: u32 = 4;
+const FUNCTIONS: u32 = 5;
+const LINE_TABLE: u32 = 6;
+
+//Constant tags
+const CONST_INT: u8 = 0;
+const CONST_REAL: u8 = 1;
+const CONST_STR: u8 = 2;
+const CONST_BOOL: u8 = 3;
+const CONST_NULL: u8 = 4;
 
 #[derive(Debug)]
 pub struct Module<'a> {
     pub constants: Vec<Ref<'a>>,
-    pub names: Vec<String>,
-    pub code: Vec<u8>,
+    //Name of the global stored in each slot
+    pub globals: Vec<&'a str>,
+    pub code: &'a [u8],
     pub main: AmaFunc<'a>,
     pub functions: Vec<AmaFunc<'a>>,
-    pub src_map: Vec<usize>,
+    //Delta encoded line table. Only decoded when an error is reported
+    pub line_table: &'a [u8],
+    //The line table is decoded once and kept here. See lines
+    lines: OnceCell<Vec<(usize, usize)>>,
 }
 
-impl Const {
-    pub fn get_str(&self) -> &String {
-        match self {
-            Self::Str(string) => &string,
-            _ => panic!("Const is not a string"),
-        }
+impl<'a> Module<'a> {
+    //Returns the (offset, line) entries of the line table, sorted by offset
+    pub fn lines(&self) -> &[(usize, usize)] {
+        self.lines.get_or_init(|| unpack_line_table(self.line_table))
     }
 }
 
-impl<'a> From<BSONType> for Const {
-    fn from(bson_val: BSONType) -> Const {
-        match bson_val {
-            BSONType::String(string) => Const::from_str(&string).unwrap(),
-            BSONType::Int(int) => Const::Int(int),
-            BSONType::Double(double) => Const::Double(double),
-            _ => panic!("Unexpected constant value"),
-        }
-    }
+//Module handed over by a host in the same process (see
+//amanda/libamanda.py). Each section holds the same records as
+//the matching section of an amac module
+#[repr(C)]
+pub struct RawModule {
+    pub entry_locals: u32,
+    pub entry_max_stack: u32,
+    pub code: RawSlice,
+    pub constants: RawSlice,
+    pub strings: RawSlice,
+    pub globals: RawSlice,
+    pub functions: RawSlice,
+    pub line_table: RawSlice,
 }
 
-impl<'a> FromStr for Const {
-    type Err = ();
+#[repr(C)]
+pub struct RawSlice {
+    pub ptr: *const u8,
+    pub len: usize,
+}
 
-    fn from_str(constant: &str) -> Result<Const, ()> {
-        if constant == "verdadeiro" || constant == "falso" {
-            let bool_val = if constant == "falso" { false } else { true };
-            return Ok(Const::Bool(bool_val));
-        }
-        let maybe_int = constant.parse::<i64>();
-        let maybe_float = constant.parse::<f64>();
-        if maybe_int.is_ok() {
-            return Ok(Const::Int(maybe_int.unwrap()));
-        } else if maybe_float.is_ok() {
-            return Ok(Const::Double(maybe_float.unwrap()));
+impl RawSlice {
+    //Safety: ptr must point to len bytes that outlive 'a
+    unsafe fn as_slice<'a>(&self) -> &'a [u8] {
+        if self.len == 0 {
+            &[]
         } else {
-            let slice: &str = if &constant[..1] == "\"" || &constant[..1] == "\'" {
-                &constant[1..constant.len() - 1]
-            } else {
-                constant
-            };
-            return Ok(Const::Str(String::from(slice)));
+            slice::from_raw_parts(self.ptr, self.len)
         }
     }
 }
 
-#[derive(Debug, PartialEq)]
-enum BSONType {
-    String(String),
-    Int(i64),
-    Double(f64),
-    Array(Vec<BSONType>),
-    Bytes(Vec<u8>),
-    Doc(HashMap<String, BSONType>),
+#[derive(Debug, Default)]
+struct Sections<'a> {
+    code: &'a [u8],
+    constants: &'a [u8],
+    strings: &'a [u8],
+    globals: &'a [u8],
+    functions: &'a [u8],
+    line_table: &'a [u8],
 }
 
-impl BSONType {
-    fn take_vec(self) -> Vec<BSONType> {
-        if let Self::Array(arr) = self {
-            arr
-        } else {
-            panic!("Value is not a vec")
-        }
-    }
+fn read_u16(bytes: &[u8], pos: usize) -> u16 {
+    u16::from_le_bytes(bytes[pos..pos + 2].try_into().unwrap())
 }
 
-fn read_bson_key(raw_doc: &mut Cursor<&mut [u8]>) -> String {
-    let mut key: String = String::new();
-    loop {
-        let mut buf: [u8; 1] = [0; 1];
-        raw_doc.read_exact(&mut buf).unwrap();
-        if buf[0] as char == '\0' {
-            break;
-        }
-        key.push(buf[0] as char);
-    }
-    key
+fn read_u32(bytes: &[u8], pos: usize) -> u32 {
+    u32::from_le_bytes(bytes[pos..pos + 4].try_into().unwrap())
 }
 
-fn read_bytes<const N: usize>(cursor: &mut Cursor<&mut [u8]>) -> [u8; N] {
-    let mut buf = [0; N];
-    cursor.read_exact(&mut buf).unwrap();
-    buf
+fn read_u64(bytes: &[u8], pos: usize) -> u64 {
+    u64::from_le_bytes(bytes[pos..pos + 8].try_into().unwrap())
 }
 
-fn unpack_bson_value(raw_doc: &mut Cursor<&mut [u8]>, value_type: u8) -> BSONType {
-    match value_type {
-        //Doc field types
-        0x01 => {
-            let num = read_bytes::<8>(raw_doc);
-            BSONType::Double(f64::from_le_bytes(num))
-        }
-        0x02 => {
-            let str_size = i32::from_le_bytes(read_bytes::<4>(raw_doc));
-            let mut string = vec![0; str_size as usize];
-            raw_doc.read_exact(&mut string).unwrap();
-            read_bytes::<1>(raw_doc); // Read null byte at the end
-            BSONType::String(String::from_utf8(string).unwrap())
-        }
-        0x03 => {
-            read_bytes::<4>(raw_doc);
-            let mut nested_doc = HashMap::new();
-            let mut buf;
-            loop {
-                buf = read_bytes::<1>(raw_doc);
-                if buf[0] as char == '\0' {
-                    break;
-                }
-                let key = read_bson_key(raw_doc);
-                let val = unpack_bson_value(raw_doc, buf[0]);
-                nested_doc.insert(key, val);
-            }
-
-            BSONType::Doc(nested_doc)
-        }
-        0x04 => {
-            read_bytes::<4>(raw_doc);
-            let mut bson_array = Vec::new();
-            let mut buf;
-            loop {
-                buf = read_bytes::<1>(raw_doc);
-                if buf[0] as char == '\0' {
-                    break;
-                }
-                read_bson_key(raw_doc);
-                bson_array.push(unpack_bson_value(raw_doc, buf[0]));
-            }
-            BSONType::Array(bson_array)
-        }
-        0x05 => {
-            let bin_len = i32::from_le_bytes(read_bytes::<4>(raw_doc));
-            //Ignore subtype
-            read_bytes::<1>(raw_doc);
-            let mut bin_data = vec![0; bin_len as usize];
-            raw_doc.read_exact(&mut bin_data).unwrap();
-            BSONType::Bytes(bin_data)
-        }
-        0x12 => {
-            let int64 = i64::from_le_bytes(read_bytes::<8>(raw_doc));
-            //Ignore subtype
-            BSONType::Int(int64)
+//Checks the header and the section table, so that a truncated or stale
+//module is reported to the host instead of making the vm panic
+fn read_sections(bin: &[u8]) -> Result<Sections<'_>, String> {
+    if bin.len() < HEADER_SIZE || &bin[0..4] != MAGIC {
+        return Err(String::from("Invalid module: not an amac module"));
+    }
+    let version = read_u16(bin, 4);
+    if version != VERSION {
+        return Err(format!("Invalid module: unsupported version {}", version));
+    }
+    let count = read_u16(bin, 6) as usize;
+    if bin.len() < HEADER_SIZE + count * SECTION_SIZE {
+        return Err(String::from("Invalid module: truncated section table"));
+    }
+    let mut sections = Sections::default();
+    for i in 0..count {
+        let entry = HEADER_SIZE + i * SECTION_SIZE;
+        let offset = read_u32(bin, entry + 4) as usize;
+        let size = read_u32(bin, entry + 8) as usize;
+        let data = bin
+            .get(offset..offset + size)
+            .ok_or_else(|| String::from("Invalid module: truncated section"))?;
+        match read_u32(bin, entry) {
+            CODE => sections.code = data,
+            CONSTANTS => sections.constants = data,
+            STRINGS => sections.strings = data,
+            GLOBALS => sections.globals = data,
+            FUNCTIONS => sections.functions = data,
+            LINE_TABLE => sections.line_table = data,
+            //Sections added by newer compilers are skipped
+            _ => (),
         }
-        _ => unimplemented!(
-            "BSON type has not been implemented. Type byte: {}",
-            value_type
-        ),
     }
+    Ok(sections)
 }
 
-fn unpack_bson_doc(raw_doc: &mut [u8]) -> HashMap<String, BSONType> {
-    let mut doc = HashMap::new();
-    let mut cursor = Cursor::new(raw_doc);
-    let mut buf: [u8; 1] = [0; 1];
-    while let Ok(()) = cursor.read_exact(&mut buf) {
-        if buf[0] as char == '\0' {
-            break;
-        }
-        let key = read_bson_key(&mut cursor);
-        let value = unpack_bson_value(&mut cursor, buf[0]);
-        doc.insert(key, value);
-    }
-    doc
+//Reads the (offset, length) reference to a string at pos
+fn read_name<'a>(bytes: &[u8], pos: usize, strings: &'a [u8]) -> &'a str {
+    let offset = read_u32(bytes, pos) as usize;
+    let size = read_u32(bytes, pos + 4) as usize;
+    str::from_utf8(&strings[offset..offset + size]).unwrap()
 }
 
-macro_rules! bson_take {
-    ($inner: path, $packed: expr) => {
-        if let $inner(inner) = $packed {
-            inner
-        } else {
-            unreachable!("Invalid field unpacking")
+fn read_varint(bytes: &[u8], pos: &mut usize) -> usize {
+    let mut value = 0;
+    let mut shift = 0;
+    loop {
+        let byte = bytes[*pos];
+        *pos += 1;
+        value |= ((byte & 0x7F) as usize) << shift;
+        if byte & 0x80 == 0 {
+            return value;
         }
-    };
+        shift += 7;
+    }
 }
 
-fn doc_into_amafn<'a>(doc: BSONType) -> (String, usize, usize) {
-    if let BSONType::Doc(mut func) = doc {
-        let start_ip = bson_take!(BSONType::Int, func.remove("start_ip").unwrap()) as usize;
-
-        (
-            bson_take!(BSONType::String, func.remove("name").unwrap()),
-            start_ip,
-            bson_take!(BSONType::Int, func.remove("locals").unwrap()) as usize,
-        )
-    } else {
-        unreachable!("functions should be an array of functions")
+//Decodes the delta encoded line table written by bindump.pack_line_table
+fn unpack_line_table(bytes: &[u8]) -> Vec<(usize, usize)> {
+    let mut table = Vec::new();
+    let mut pos = 0;
+    let (mut offset, mut line) = (0, 0isize);
+    while pos < bytes.len() {
+        offset += read_varint(bytes, &mut pos);
+        let zigzag = read_varint(bytes, &mut pos) as isize;
+        line += (zigzag >> 1) ^ -(zigzag & 1);
+        table.push((offset, line as usize));
     }
+    table
 }
 
-pub fn consume_const<'a>(constant: Const) -> AmaValue<'a> {
-    match constant {
-        Const::Str(string) => AmaValue::Str(Cow::Owned(string)),
-        Const::Int(int) => AmaValue::Int(int),
-        Const::Double(real) => AmaValue::F64(real),
-        Const::Bool(boolean) => AmaValue::Bool(boolean),
+fn read_constant<'a>(bytes: &[u8], pos: usize, strings: &'a [u8]) -> AmaValue<'a> {
+    let value = read_u64(bytes, pos + 8);
+    match bytes[pos] {
+        CONST_INT => AmaValue::Int(value as i64),
+        CONST_REAL => AmaValue::F64(f64::from_bits(value)),
+        CONST_STR => {
+            let size = read_u32(bytes, pos + 4) as usize;
+            let string = &strings[value as usize..value as usize + size];
+            AmaValue::Str(Cow::Borrowed(str::from_utf8(string).unwrap()))
+        }
+        CONST_BOOL => AmaValue::Bool(value != 0),
+        CONST_NULL => AmaValue::None,
+        tag => unreachable!("Unexpected constant tag: {}", tag),
     }
 }
 
-pub fn load_bin<'bin>(amac_bin: &'bin mut [u8], alloc: &mut Alloc<'bin>) -> Module<'bin> {
-    //Skip size bytes
-    let mut prog_data = unpack_bson_doc(amac_bin);
-    let raw_consts = prog_data.remove("constants").unwrap().take_vec();
-    let mut constants = Vec::with_capacity(raw_consts.len());
-    raw_consts
-        .into_iter()
-        .for_each(|constant| constants.push(alloc.alloc_ref(consume_const(Const::from(constant)))));
-    let names: Vec<String> = prog_data
-        .remove("names")
-        .unwrap()
-        .take_vec()
-        .into_iter()
-        .map(|name| bson_take!(BSONType::String, name))
-        .collect();
+pub fn load_bin<'bin>(
+    amac_bin: &'bin [u8],
+    alloc: &mut Alloc<'bin>,
+) -> Result<Module<'bin>, String> {
+    let sections = read_sections(amac_bin)?;
+    let main = (read_u32(amac_bin, 8), read_u32(amac_bin, 12));
+    Ok(load_sections(sections, main, alloc))
+}
 
-    let ops = bson_take!(BSONType::Bytes, prog_data.remove("ops").unwrap());
-    let entry_locals = bson_take!(BSONType::Int, prog_data.remove("entry_locals").unwrap());
-    let src_map: Vec<usize> = if let BSONType::Array(offsets) = prog_data.remove("src_map").unwrap()
-    {
-        offsets
-            .iter()
-            .map(|num| *bson_take!(BSONType::Int, num) as usize)
-            .collect()
-    } else {
-        unreachable!("src_map should be an array of ints")
+//Safety: every slice of raw must stay valid while the module is used
+pub unsafe fn load_raw<'a>(raw: &RawModule, alloc: &mut Alloc<'a>) -> Module<'a> {
+    let sections = Sections {
+        code: raw.code.as_slice(),
+        constants: raw.constants.as_slice(),
+        strings: raw.strings.as_slice(),
+        globals: raw.globals.as_slice(),
+        functions: raw.functions.as_slice(),
+        line_table: raw.line_table.as_slice(),
     };
+    load_sections(sections, (raw.entry_locals, raw.entry_max_stack), alloc)
+}
 
-    let functions: Vec<AmaFunc> =
-        if let BSONType::Array(funcs) = prog_data.remove("functions").unwrap() {
-            funcs
-                .into_iter()
-                .map(|func| {
-                    let (name, start_ip, locals) = doc_into_amafn(func);
-                    AmaFunc {
-                        //TODO: Check if i should be leaking memory
-                        name: Box::leak(name.into_boxed_str()),
-                        bp: -1,
-                        start_ip: start_ip,
-                        last_i: start_ip,
-                        ip: start_ip,
-                        locals: locals,
-                    }
-                })
-                .collect()
-        } else {
-            unreachable!("functions should be an array of functions")
+//Code and strings are borrowed from the module, so the only work done
+//at load time is allocating the constants and the function records.
+//main holds the locals and max stack size of the entry code
+fn load_sections<'a>(
+    sections: Sections<'a>,
+    main: (u32, u32),
+    alloc: &mut Alloc<'a>,
+) -> Module<'a> {
+    let strings = sections.strings;
+
+    let num_consts = sections.constants.len() / CONST_SIZE;
+    let mut constants = Vec::with_capacity(num_consts);
+    for i in 0..num_consts {
+        let constant = match read_constant(sections.constants, i * CONST_SIZE, strings) {
+            // There is only one None value
+            AmaValue::None => alloc.null_ref(),
+            constant => alloc.alloc_ref(constant),
         };
+        constants.push(constant);
+    }
+
+    let globals: Vec<&str> = (0..sections.globals.len() / NAME_SIZE)
+        .map(|i| read_name(sections.globals, i * NAME_SIZE, strings))
+        .collect();
+
+    let functions: Vec<AmaFunc> = (0..sections.functions.len() / FUNCTION_SIZE)
+        .map(|i| {
+            let pos = i * FUNCTION_SIZE;
+            let start_ip = read_u32(sections.functions, pos + 8) as usize;
+            AmaFunc {
+                name: read_name(sections.functions, pos, strings),
+                bp: -1,
+                start_ip: start_ip,
+                last_i: start_ip,
+                ip: start_ip,
+                locals: read_u32(sections.functions, pos + 12) as usize,
+                params: read_u32(sections.functions, pos + 16) as usize,
+                max_stack: read_u32(sections.functions, pos + 20) as usize,
+                param_types: read_name(sections.functions, pos + 24, strings),
+            }
+        })
+        .collect();
 
     Module {
         constants,
-        names,
-        code: ops,
-        src_map,
+        globals,
+        code: sections.code,
+        line_table: sections.line_table,
+        lines: OnceCell::new(),
         main: AmaFunc {
             name: "_inicio_",
             bp: -1,
             start_ip: 0,
             last_i: 0,
             ip: 0,
-            locals: entry_locals as usize,
+            locals: main.0 as usize,
+            params: 0,
+            max_stack: main.1 as usize,
+            param_types: "",
         },
         functions,
     }
@@ -290,171 +282,83 @@ pub fn load_bin<'bin>(amac_bin: &'bin mut [u8], alloc: &mut Alloc<'bin>) -> Modu
 mod tests {
     use super::*;
 
-    impl BSONType {
-        fn is_doc(&self) -> bool {
-            if let Self::Doc(_) = self {
-                true
-            } else {
-                false
-            }
-        }
-
-        fn is_vec(&self) -> bool {
-            if let Self::Array(_) = self {
-                true
-            } else {
-                false
-            }
-        }
-        fn get_doc(&self) -> &HashMap<String, BSONType> {
-            if let Self::Doc(doc) = self {
-                doc
-            } else {
-                panic!("Value is not a doc")
-            }
-        }
-
-        fn get_vec(&self) -> &Vec<BSONType> {
-            if let Self::Array(arr) = self {
-                arr
-            } else {
-                panic!("Value is not a vec")
-            }
+    //Module with 3 bytes of code and the constants 1 and "oi"
+    fn sample_module() -> Vec<u8> {
+        let mut bytes = vec![];
+        bytes.extend_from_slice(b"AMAC");
+        bytes.extend_from_slice(&VERSION.to_le_bytes());
+        bytes.extend_from_slice(&3u16.to_le_bytes());
+        bytes.extend_from_slice(&2u32.to_le_bytes());
+        bytes.extend_from_slice(&4u32.to_le_bytes());
+        //Section table: code, constants, strings
+        for (kind, offset, size) in [(CODE, 56, 3), (CONSTANTS, 64, 32), (STRINGS, 96, 2)] {
+            bytes.extend_from_slice(&kind.to_le_bytes());
+            bytes.extend_from_slice(&(offset as u32).to_le_bytes());
+            bytes.extend_from_slice(&(size as u32).to_le_bytes());
         }
-
-        fn get_f64(&self) -> f64 {
-            if let Self::Double(float) = self {
-                *float
-            } else {
-                panic!("Value is not a float")
-            }
-        }
-
-        fn get_i64(&self) -> i64 {
-            if let Self::Int(int) = self {
-                *int
-            } else {
-                panic!("Value is not a float")
-            }
-        }
-
-        fn get_str(&self) -> &str {
-            if let Self::String(string) = self {
-                &string
-            } else {
-                panic!("Value is not a string")
-            }
-        }
-
-        fn get_bytes(&self) -> &Vec<u8> {
-            if let Self::Bytes(bytes) = self {
-                bytes
-            } else {
-                panic!("Value is not a string")
-            }
-        }
-    }
-
-    #[test]
-    fn test_string_field() {
-        // { "name": "João Boris" }
-        let mut bytes = vec![
-            22, 0, 0, 0, 2, 110, 97, 109, 101, 0, 11, 0, 0, 0, 74, 111, 195, 163, 111, 32, 66, 111,
-            114, 105, 115, 0, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("name"), true);
-        assert_eq!(doc.get("name").unwrap().get_str(), "João Boris");
-    }
-
-    #[test]
-    fn test_f64_field() {
-        // { "credit": 100.50 }
-        let mut bytes = vec![
-            16, 0, 0, 0, 1, 99, 114, 101, 100, 105, 116, 0, 0, 0, 0, 0, 0, 32, 89, 64, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("credit"), true);
-        assert_eq!(doc.get("credit").unwrap().get_f64(), 100.50);
+        bytes.resize(56, 0);
+        bytes.extend_from_slice(&[0, 0, 0, 0, 0, 0, 0, 0]);
+        //1, "oi"
+        bytes.extend_from_slice(&[CONST_INT, 0, 0, 0, 0, 0, 0, 0]);
+        bytes.extend_from_slice(&1i64.to_le_bytes());
+        bytes.extend_from_slice(&[CONST_STR, 0, 0, 0, 2, 0, 0, 0]);
+        bytes.extend_from_slice(&0u64.to_le_bytes());
+        bytes.extend_from_slice(b"oi");
+        bytes
     }
 
     #[test]
-    fn test_i64_field() {
-        // { "age": 100 }
-        let mut bytes = vec![
-            13, 0, 0, 0, 18, 97, 103, 101, 0, 100, 0, 0, 0, 0, 0, 0, 0, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("age"), true);
-        assert_eq!(doc.get("age").unwrap().get_i64(), 100);
+    fn test_sections() {
+        let bytes = sample_module();
+        let sections = read_sections(&bytes).unwrap();
+        assert_eq!(sections.code, &[0, 0, 0]);
+        assert_eq!(sections.constants.len(), 2 * CONST_SIZE);
+        assert_eq!(sections.strings, b"oi");
+        assert!(sections.functions.is_empty());
     }
 
     #[test]
-    fn test_bytes_field() {
-        // { "bytes": [0, 1, 1, 2, 3 , 255] }
-        let mut bytes = vec![
-            18, 0, 0, 0, 5, 98, 121, 116, 101, 115, 0, 6, 0, 0, 0, 128, 0, 1, 1, 2, 3, 255, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("bytes"), true);
+    fn test_constants() {
+        let bytes = sample_module();
+        let sections = read_sections(&bytes).unwrap();
         assert_eq!(
-            doc.get("bytes").unwrap().get_bytes().clone(),
-            vec![0, 1, 1, 2, 3, 255]
+            read_constant(sections.constants, 0, sections.strings).take_int(),
+            1
+        );
+        assert_eq!(
+            read_constant(sections.constants, CONST_SIZE, sections.strings).take_str(),
+            "oi"
         );
     }
 
     #[test]
-    fn test_array_field() {
-        // { "names": ["João Boris", "Some other dude"] }
-        let mut bytes = vec![
-            54, 0, 0, 0, 4, 110, 97, 109, 101, 115, 0, 42, 0, 0, 0, 2, 48, 0, 11, 0, 0, 0, 74, 111,
-            195, 163, 111, 32, 66, 111, 114, 105, 115, 0, 2, 49, 0, 15, 0, 0, 0, 83, 111, 109, 101,
-            32, 111, 116, 104, 101, 114, 32, 100, 117, 100, 101, 0, 0, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("names"), true);
-        assert_eq!(doc.get("names").unwrap().is_vec(), true);
-        let arr = doc.get("names").unwrap().get_vec();
-        let mut arr_iter = arr.iter();
-        assert_eq!(arr_iter.len(), 2);
-        assert_eq!(arr_iter.next().unwrap().get_str(), "João Boris");
-        assert_eq!(arr_iter.next().unwrap().get_str(), "Some other dude");
+    fn test_bad_header() {
+        let mut bytes = sample_module();
+        bytes[0] = b'B';
+        assert!(read_sections(&bytes).unwrap_err().contains("not an amac module"));
+        let mut bytes = sample_module();
+        bytes[4] = 1;
+        assert!(read_sections(&bytes).unwrap_err().contains("version 1"));
+        let bytes = sample_module();
+        assert!(read_sections(&bytes[..40]).is_err());
+        assert!(read_sections(&bytes[..90]).is_err());
     }
 
     #[test]
-    fn test_doc_field() {
-        // { "user": {"name": "João Boris", "age": 28, "balance": 1000.52}  }
-        let mut bytes = vec![
-            63, 0, 0, 0, 3, 117, 115, 101, 114, 0, 52, 0, 0, 0, 2, 110, 97, 109, 101, 0, 11, 0, 0,
-            0, 74, 111, 195, 163, 111, 32, 66, 111, 114, 105, 115, 0, 18, 97, 103, 101, 0, 28, 0,
-            0, 0, 0, 0, 0, 0, 1, 98, 97, 108, 97, 110, 99, 101, 0, 92, 143, 194, 245, 40, 68, 143,
-            64, 0, 0,
-        ];
-        bytes.drain(0..4);
-
-        let doc = unpack_bson_doc(&mut bytes);
-        assert_eq!(doc.is_empty(), false);
-        assert_eq!(doc.contains_key("user"), true);
-        assert_eq!(doc.get("user").unwrap().is_doc(), true);
-
-        let nested_doc = doc.get("user").unwrap().get_doc();
-        assert_eq!(nested_doc.get("name").unwrap().get_str(), "João Boris");
-        assert_eq!(nested_doc.get("age").unwrap().get_i64(), 28);
-        assert_eq!(nested_doc.get("balance").unwrap().get_f64(), 1000.52);
+    fn test_line_table() {
+        // [(0, 1), (3, 2), (300, 1), (301, 200)]
+        let bytes = vec![0, 2, 3, 2, 169, 2, 1, 1, 142, 3];
+        assert_eq!(
+            unpack_line_table(&bytes),
+            vec![(0, 1), (3, 2), (300, 1), (301, 200)]
+        );
+        //The module decodes its table once
+        let sections = Sections {
+            line_table: &bytes,
+            ..Default::default()
+        };
+        let module = load_sections(sections, (0, 0), &mut Alloc::new());
+        assert_eq!(module.lines(), &[(0, 1), (3, 2), (300, 1), (301, 200)]);
+        assert!(std::ptr::eq(module.lines(), module.lines()));
     }
 }
@@ -1,76 +1,95 @@
 use crate::alloc::{Alloc, Ref};
+use crate::ama_io::AmaIO;
 use crate::ama_value::{AmaValue, FuncArgs, NativeFunc, Type};
 use crate::errors::AmaErr;
 use std::borrow::Cow;
-use std::io;
-use std::io::Write;
 use unicode_segmentation::UnicodeSegmentation;
 
 /*Helpers*/
 type AmaResult<'a> = Result<Ref<'a>, AmaErr>;
 
 /* Builtin functions*/
-fn escrevaln<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn escrevaln<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
     let value: &AmaValue = args[0].inner();
 
-    println!("{}", value);
+    writeln!(io, "{}", value)?;
     Ok(alloc.null_ref())
 }
 
-fn escreva<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn escreva<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
     let value: &AmaValue = args[0].inner();
 
-    print!("{}", value);
-    io::stdout().flush().unwrap();
+    write!(io, "{}", value)?;
     Ok(alloc.null_ref())
 }
 
-fn leia<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
-    escreva(args, alloc)?;
-
-    let mut input = String::from("");
-    //TODO: Propagate possible errors to caller
-    io::stdin().read_line(&mut input).unwrap();
-    //Remove newline at the end
-    debug_assert!(
-        input.remove(input.len() - 1) == 0xA as char,
-        "Removing wrong char"
-    );
-
+fn leia<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    escreva(args, alloc, io)?;
+    let input = io.read_line()?;
     Ok(alloc.alloc_ref(AmaValue::Str(Cow::Owned(input))))
 }
 
-fn leia_int<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
-    let input = leia(args, alloc);
-    if input.is_ok() {
-        //TODO: Propagate possible errors to caller
-        let maybe_int = input.unwrap().inner().take_str().parse::<i64>();
-        if let Err(_) = maybe_int {
-            Err("Valor introduzido não é um inteiro válido".to_string())
-        } else {
-            Ok(alloc.alloc_ref(AmaValue::Int(maybe_int.unwrap())))
-        }
+fn leia_int<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    let input = leia(args, alloc, io)?;
+    let maybe_int = input.inner().take_str().parse::<i64>();
+    if let Err(_) = maybe_int {
+        Err("Valor introduzido não é um inteiro válido".to_string())
     } else {
-        unreachable!()
+        Ok(alloc.alloc_ref(AmaValue::Int(maybe_int.unwrap())))
     }
 }
 
-fn leia_real<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
-    let input = leia(args, alloc);
-    if input.is_ok() {
-        //TODO: Propagate possible errors to caller
-        let maybe_double = input.unwrap().inner().take_str().parse::<f64>();
-        if let Err(_) = maybe_double {
-            Err("Valor introduzido não é um número real válido".to_string())
-        } else {
-            Ok(alloc.alloc_ref(AmaValue::F64(maybe_double.unwrap())))
-        }
+fn leia_real<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    let input = leia(args, alloc, io)?;
+    let maybe_double = input.inner().take_str().parse::<f64>();
+    if let Err(_) = maybe_double {
+        Err("Valor introduzido não é um número real válido".to_string())
+    } else {
+        Ok(alloc.alloc_ref(AmaValue::F64(maybe_double.unwrap())))
+    }
+}
+
+//Number of values to be read by the bulk input builtins.
+//A negative count reads every value left
+fn read_count(args: FuncArgs) -> Option<usize> {
+    let count = args[0].inner().take_int();
+    if count < 0 {
+        None
     } else {
-        unreachable!()
+        Some(count as usize)
     }
 }
 
-fn tam<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn alloc_vec<'a>(values: impl Iterator<Item = AmaValue<'a>>, alloc: &mut Alloc<'a>) -> Ref<'a> {
+    let vec = values.map(|value| alloc.alloc_ref(value)).collect();
+    alloc.alloc_ref(AmaValue::Vector(vec))
+}
+
+fn leia_ints<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    let values = io.read_values::<i64>(
+        read_count(args),
+        "Valor introduzido não é um inteiro válido",
+    )?;
+    Ok(alloc_vec(values.into_iter().map(AmaValue::Int), alloc))
+}
+
+fn leia_reais<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    let values = io.read_values::<f64>(
+        read_count(args),
+        "Valor introduzido não é um número real válido",
+    )?;
+    Ok(alloc_vec(values.into_iter().map(AmaValue::F64), alloc))
+}
+
+fn leia_linhas<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, io: &mut AmaIO) -> AmaResult<'a> {
+    let lines = io.read_lines(read_count(args))?;
+    Ok(alloc_vec(
+        lines.into_iter().map(|line| AmaValue::Str(Cow::Owned(line))),
+        alloc,
+    ))
+}
+
+fn tam<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, _: &mut AmaIO) -> AmaResult<'a> {
     let value = args[0].inner();
     match value {
         AmaValue::Str(string) => Ok(alloc.alloc_ref(AmaValue::Int(
@@ -81,7 +100,7 @@ fn tam<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
     }
 }
 
-fn txt_contem<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn txt_contem<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, _: &mut AmaIO) -> AmaResult<'a> {
     let haystack = args[0].inner();
     let needle = args[1].inner();
     match (haystack, needle) {
@@ -121,7 +140,7 @@ fn build_vec<'a>(
     }
 }
 
-fn vec<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn vec<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, _: &mut AmaIO) -> AmaResult<'a> {
     let el_type = args[0].inner().take_type();
     let dims = &args[1..];
     let n_dims = dims.len();
@@ -137,16 +156,17 @@ fn vec<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
     Ok(alloc.alloc_ref(vec))
 }
 
-fn anexa<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>) -> AmaResult<'a> {
+fn anexa<'a>(args: FuncArgs<'a, '_>, alloc: &mut Alloc<'a>, _: &mut AmaIO) -> AmaResult<'a> {
     let vec = match args[0].inner_mut() {
         AmaValue::Vector(vec) => vec,
         _ => unreachable!("Something bad is happening"),
     };
+    alloc.note_store(Some(args[0]), args[1]);
     vec.push(args[1]);
     Ok(alloc.null_ref())
 }
 
-fn remova<'a>(args: FuncArgs<'a, '_>, _: &mut Alloc<'a>) -> AmaResult<'a> {
+fn remova<'a>(args: FuncArgs<'a, '_>, _: &mut Alloc<'a>, _: &mut AmaIO) -> AmaResult<'a> {
     let vec = args[0].inner_mut();
     let idx = args[1].inner().take_int();
     vec.vec_index_check(idx)?;
@@ -159,12 +179,12 @@ fn remova<'a>(args: FuncArgs<'a, '_>, _: &mut Alloc<'a>) -> AmaResult<'a> {
 #[inline]
 fn new_builtin<'a>(
     name: &'a str,
-    func: fn(FuncArgs<'a, '_>, &mut Alloc<'a>) -> AmaResult<'a>,
+    func: fn(FuncArgs<'a, '_>, &mut Alloc<'a>, &mut AmaIO) -> AmaResult<'a>,
 ) -> (&'a str, AmaValue<'a>) {
     (name, (AmaValue::NativeFn(NativeFunc { name, func })))
 }
 
-pub fn load_builtins<'a>() -> [(&'a str, AmaValue<'a>); 14] {
+pub fn load_builtins<'a>() -> [(&'a str, AmaValue<'a>); 17] {
     [
         new_builtin("escrevaln", escrevaln),
         new_builtin("escreva", escreva),
@@ -176,6 +196,9 @@ pub fn load_builtins<'a>() -> [(&'a str, AmaValue<'a>); 14] {
         new_builtin("anexa", anexa),
         new_builtin("remova", remova),
         new_builtin("txt_contem", txt_contem),
+        new_builtin("leia_ints", leia_ints),
+        new_builtin("leia_reais", leia_reais),
+        new_builtin("leia_linhas", leia_linhas),
         ("int", AmaValue::Type(Type::Int)),
         ("real", AmaValue::Type(Type::Real)),
         ("bool", AmaValue::Type(Type::Bool)),
@@ -1,33 +1,336 @@
 use alloc::Alloc;
+use ama_io::AmaIO;
+use binload::{Module, RawModule};
+use errors::AmaErr;
+use session::{CallError, Session};
+use std::panic::{self, AssertUnwindSafe};
+use std::ptr;
 use std::slice;
-use vm::AmaVM;
+use std::sync::atomic::{AtomicU64, Ordering};
+use vm::{AmaVM, Interrupt, Limits};
 
 mod alloc;
+mod ama_io;
 mod ama_value;
 mod binload;
 mod builtins;
 mod errors;
+mod marshal;
 mod opcode;
+mod session;
 mod vm;
 
+//Status of the functions that run a module
 const OK: u8 = 0;
+//The program stopped with a runtime error
 const ERR: u8 = 1;
+//The run was stopped by the limits given by the host (see vm::Limits)
+const OUT_OF_BUDGET: u8 = 2;
+const CANCELLED: u8 = 3;
+//The module could not be loaded
+const INVALID_MODULE: u8 = 4;
 
+// Number of ops dispatched by the last call to run_module
+static DISPATCH_COUNT: AtomicU64 = AtomicU64::new(0);
+
+//Runs the body of an entry point. A panic must not unwind into the
+//host, so it is caught and its message is passed to on_panic
+fn guard<T>(body: impl FnOnce() -> T, on_panic: impl FnOnce(String) -> T) -> T {
+    panic::catch_unwind(AssertUnwindSafe(body)).unwrap_or_else(|payload| {
+        let msg = match payload.downcast_ref::<&str>() {
+            Some(msg) => msg.to_string(),
+            None => payload.downcast_ref::<String>().cloned().unwrap_or_default(),
+        };
+        on_panic(format!("Erro interno da máquina virtual: {}", msg))
+    })
+}
+
+//When buffered is set, the output of the module is written to stdout in
+//blocks instead of line by line (see ama_io.rs). limits may be null
 #[no_mangle]
-pub extern "C" fn run_module(bin_module: *mut u8, size: u32) -> u8 {
-    let module = unsafe {
-        assert!(!bin_module.is_null());
-        //Skip size bytes
-        &mut slice::from_raw_parts_mut(bin_module, size as usize)[4..]
-    };
+pub extern "C" fn run_module(
+    bin_module: *const u8,
+    size: u32,
+    buffered: bool,
+    limits: *const Limits,
+) -> u8 {
+    guard(
+        || {
+            let module = unsafe {
+                assert!(!bin_module.is_null());
+                slice::from_raw_parts(bin_module, size as usize)
+            };
 
-    let mut alloc = Alloc::new();
-    let mut ama_module = binload::load_bin(module, &mut alloc);
-    let mut vm = AmaVM::new(&mut ama_module, alloc);
-    if let Err(err) = vm.run() {
-        eprint!("{}", err);
-        OK
+            let mut alloc = Alloc::new();
+            match binload::load_bin(module, &mut alloc) {
+                Ok(ama_module) => run(&ama_module, alloc, buffered, limits),
+                Err(err) => {
+                    eprintln!("{}", err);
+                    INVALID_MODULE
+                }
+            }
+        },
+        |_| ERR,
+    )
+}
+
+//Runs a module built in memory by the host, without serializing it
+#[no_mangle]
+pub extern "C" fn run_raw_module(
+    raw_module: *const RawModule,
+    buffered: bool,
+    limits: *const Limits,
+) -> u8 {
+    guard(
+        || {
+            let raw_module = unsafe {
+                assert!(!raw_module.is_null());
+                &*raw_module
+            };
+
+            let mut alloc = Alloc::new();
+            let ama_module = unsafe { binload::load_raw(raw_module, &mut alloc) };
+            run(&ama_module, alloc, buffered, limits)
+        },
+        |_| ERR,
+    )
+}
+
+fn stdio(buffered: bool) -> AmaIO {
+    if buffered {
+        AmaIO::buffered_stdio()
+    } else {
+        AmaIO::stdio()
+    }
+}
+
+fn read_limits(limits: *const Limits) -> Limits {
+    if limits.is_null() {
+        Limits::none()
     } else {
-        ERR
+        unsafe { *limits }
+    }
+}
+
+fn run<'a>(
+    ama_module: &'a Module<'a>,
+    alloc: Alloc<'a>,
+    buffered: bool,
+    limits: *const Limits,
+) -> u8 {
+    let mut vm = AmaVM::new(ama_module, alloc);
+    vm.io = stdio(buffered);
+    vm.limits = read_limits(limits);
+    let result = vm.run();
+    exit_status(&mut vm, result)
+}
+
+fn exit_status(vm: &mut AmaVM, result: Result<(), AmaErr>) -> u8 {
+    DISPATCH_COUNT.store(vm.dispatches, Ordering::Relaxed);
+    if let Err(err) = result {
+        vm.io.report_error(err);
+        match vm.interrupt {
+            Some(Interrupt::OutOfBudget) => OUT_OF_BUDGET,
+            Some(Interrupt::Cancelled) => CANCELLED,
+            None => ERR,
+        }
+    } else {
+        OK
+    }
+}
+
+//Loads a module so that it can be run many times with run_session.
+//The module is copied, so the caller may free it once this returns.
+//The session must be freed with free_session. Returns null if the
+//module is invalid
+#[no_mangle]
+pub extern "C" fn load_module(bin_module: *const u8, size: u32) -> *mut Session {
+    guard(
+        || {
+            let module = unsafe {
+                assert!(!bin_module.is_null());
+                slice::from_raw_parts(bin_module, size as usize)
+            };
+            match Session::new(module) {
+                Ok(session) => Box::into_raw(Box::new(session)),
+                Err(err) => {
+                    eprintln!("{}", err);
+                    ptr::null_mut()
+                }
+            }
+        },
+        |_| ptr::null_mut(),
+    )
+}
+
+#[no_mangle]
+pub extern "C" fn run_session(session: *mut Session, buffered: bool, limits: *const Limits) -> u8 {
+    guard(
+        || {
+            let session = unsafe {
+                assert!(!session.is_null());
+                &mut *session
+            };
+            session.vm_mut().io = stdio(buffered);
+            session.vm_mut().limits = read_limits(limits);
+            let result = session.run();
+            exit_status(session.vm_mut(), result)
+        },
+        |_| ERR,
+    )
+}
+
+//Runs the module of a session with input as its stdin. Up to
+//output_limit bytes of output are captured instead of being written to
+//stdout, and can be read with run_output. The message of the error
+//that stopped the program, if any, can be read with run_error
+#[no_mangle]
+pub extern "C" fn run_session_io(
+    session: *mut Session,
+    input: *const u8,
+    input_len: u32,
+    output_limit: u32,
+    limits: *const Limits,
+) -> u8 {
+    guard(
+        || {
+            let (session, input) = unsafe {
+                assert!(!session.is_null() && !input.is_null());
+                (&mut *session, slice::from_raw_parts(input, input_len as usize))
+            };
+            session.vm_mut().io = AmaIO::in_memory(input, output_limit as usize);
+            session.vm_mut().limits = read_limits(limits);
+            let result = session.run();
+            exit_status(session.vm_mut(), result)
+        },
+        |msg| {
+            if !session.is_null() {
+                unsafe { (*session).vm_mut().io.report_error(msg) };
+            }
+            ERR
+        },
+    )
+}
+
+//Returns the output captured by the last run_session_io and writes its
+//size to size. The output is valid until the session is run again
+#[no_mangle]
+pub extern "C" fn run_output(session: *const Session, size: *mut u32) -> *const u8 {
+    let session = unsafe {
+        assert!(!session.is_null() && !size.is_null());
+        &*session
+    };
+    let output = session.vm().io.output();
+    unsafe { *size = output.len() as u32 };
+    output.as_ptr()
+}
+
+//Same as run_output, for the message of the error raised by the last
+//run_session_io. The size is 0 if the program ran without errors
+#[no_mangle]
+pub extern "C" fn run_error(session: *const Session, size: *mut u32) -> *const u8 {
+    let session = unsafe {
+        assert!(!session.is_null() && !size.is_null());
+        &*session
+    };
+    let error = session.vm().io.error();
+    unsafe { *size = error.len() as u32 };
+    error.as_ptr()
+}
+
+//Status of call_function
+const CALL_OK: u8 = 0;
+const CALL_ERROR: u8 = 1;
+const CALL_NOT_FOUND: u8 = 2;
+const CALL_BAD_ARGS: u8 = 3;
+const CALL_BAD_RESULT: u8 = 4;
+const CALL_OUT_OF_BUDGET: u8 = 5;
+const CALL_CANCELLED: u8 = 6;
+
+//Calls the top level function with the given name. args holds argc
+//values encoded as described in marshal.rs. The encoded result, or the
+//message of the error raised, can be read with call_output
+#[no_mangle]
+pub extern "C" fn call_function(
+    session: *mut Session,
+    name: *const u8,
+    name_len: u32,
+    args: *const u8,
+    args_len: u32,
+    argc: u32,
+    limits: *const Limits,
+) -> u8 {
+    guard(
+        || {
+            let (session, name, args) = unsafe {
+                assert!(!session.is_null() && !name.is_null() && !args.is_null());
+                (
+                    &mut *session,
+                    slice::from_raw_parts(name, name_len as usize),
+                    slice::from_raw_parts(args, args_len as usize),
+                )
+            };
+            call(session, &String::from_utf8_lossy(name), args, argc, limits)
+        },
+        |msg| {
+            if !session.is_null() {
+                unsafe { (*session).output = msg.into_bytes() };
+            }
+            CALL_ERROR
+        },
+    )
+}
+
+fn call(session: &mut Session, name: &str, args: &[u8], argc: u32, limits: *const Limits) -> u8 {
+    session.vm_mut().limits = read_limits(limits);
+    let (status, message) = match session.call(name, args, argc as usize) {
+        Ok(()) => return CALL_OK,
+        Err(CallError::NotFound) => (CALL_NOT_FOUND, format!("a função '{}' não foi definida", name)),
+        Err(CallError::BadArgs(msg)) => (CALL_BAD_ARGS, msg),
+        Err(CallError::Runtime(msg)) => match session.vm().interrupt {
+            Some(Interrupt::OutOfBudget) => (CALL_OUT_OF_BUDGET, msg),
+            Some(Interrupt::Cancelled) => (CALL_CANCELLED, msg),
+            None => (CALL_ERROR, msg),
+        },
+        Err(CallError::BadResult(msg)) => (CALL_BAD_RESULT, msg),
+    };
+    session.output = message.into_bytes();
+    status
+}
+
+//Returns the output of the last call_function and writes its size to size.
+//The output is valid until the next call
+#[no_mangle]
+pub extern "C" fn call_output(session: *const Session, size: *mut u32) -> *const u8 {
+    let session = unsafe {
+        assert!(!session.is_null() && !size.is_null());
+        &*session
+    };
+    unsafe { *size = session.output.len() as u32 };
+    session.output.as_ptr()
+}
+
+#[no_mangle]
+pub extern "C" fn free_session(session: *mut Session) {
+    if !session.is_null() {
+        unsafe { drop(Box::from_raw(session)) };
+    }
+}
+
+#[no_mangle]
+pub extern "C" fn dispatch_count() -> u64 {
+    DISPATCH_COUNT.load(Ordering::Relaxed)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_guard() {
+        assert_eq!(guard(|| 1, |_| 0), 1);
+        let msg = guard(|| panic!("falhou {}", 1), |msg| msg);
+        assert!(msg.ends_with("falhou 1"));
+        assert_eq!(guard(|| -> u8 { panic!("falhou") }, |_| ERR), ERR);
     }
 }
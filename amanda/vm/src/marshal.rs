@@ -0,0 +1,199 @@
+use crate::alloc::Alloc;
+use crate::ama_value::AmaValue;
+use std::borrow::Cow;
+use std::convert::TryInto;
+use std::str;
+
+//Values exchanged with the host (see amanda/libamanda.py).
+//Each value is a tag followed by its payload, in little endian:
+//int (i64), real (f64), texto (u32 length + utf-8), bool (u8),
+//nulo (nothing), vector (u32 length + elements)
+const INT: u8 = 0;
+const REAL: u8 = 1;
+const STR: u8 = 2;
+const BOOL: u8 = 3;
+const NULL: u8 = 4;
+const VECTOR: u8 = 5;
+
+//Codes of the types in the param_types of a function record.
+//See amanda/compiler/bindump.py
+const TYPE_INT: u8 = b'i';
+const TYPE_REAL: u8 = b'r';
+const TYPE_BOOL: u8 = b'b';
+const TYPE_TEXTO: u8 = b't';
+const TYPE_INDEF: u8 = b'x';
+const TYPE_VEC: u8 = b'[';
+const TYPE_KLASS: u8 = b'k';
+
+fn read_array<const N: usize>(bytes: &[u8], pos: &mut usize) -> Result<[u8; N], String> {
+    let array = bytes
+        .get(*pos..*pos + N)
+        .ok_or_else(|| String::from("Valor incompleto"))?
+        .try_into()
+        .unwrap();
+    *pos += N;
+    Ok(array)
+}
+
+pub fn read_value<'a>(
+    bytes: &[u8],
+    pos: &mut usize,
+    alloc: &mut Alloc<'a>,
+) -> Result<AmaValue<'a>, String> {
+    let tag = read_array::<1>(bytes, pos)?[0];
+    Ok(match tag {
+        INT => AmaValue::Int(i64::from_le_bytes(read_array(bytes, pos)?)),
+        REAL => AmaValue::F64(f64::from_le_bytes(read_array(bytes, pos)?)),
+        STR => {
+            let size = u32::from_le_bytes(read_array(bytes, pos)?) as usize;
+            let string = bytes
+                .get(*pos..*pos + size)
+                .and_then(|string| str::from_utf8(string).ok())
+                .ok_or_else(|| String::from("Texto inválido"))?;
+            *pos += size;
+            AmaValue::Str(Cow::Owned(String::from(string)))
+        }
+        BOOL => AmaValue::Bool(read_array::<1>(bytes, pos)?[0] != 0),
+        NULL => AmaValue::None,
+        VECTOR => {
+            let size = u32::from_le_bytes(read_array(bytes, pos)?) as usize;
+            let mut elements = Vec::with_capacity(size);
+            for _ in 0..size {
+                let element = match read_value(bytes, pos, alloc)? {
+                    AmaValue::None => alloc.null_ref(),
+                    element => alloc.alloc_ref(element),
+                };
+                elements.push(element);
+            }
+            AmaValue::Vector(elements)
+        }
+        tag => return Err(format!("Tipo de valor desconhecido: {}", tag)),
+    })
+}
+
+//Returns the size of the code of the type at the start of types
+pub fn type_size(types: &[u8]) -> usize {
+    match types.first() {
+        Some(&TYPE_VEC) => 1 + type_size(&types[1..]),
+        Some(_) => 1,
+        None => 0,
+    }
+}
+
+//Returns the name of the type at the start of types
+pub fn type_name(types: &[u8]) -> String {
+    match types.first() {
+        Some(&TYPE_INT) => String::from("int"),
+        Some(&TYPE_REAL) => String::from("real"),
+        Some(&TYPE_BOOL) => String::from("bool"),
+        Some(&TYPE_TEXTO) => String::from("texto"),
+        Some(&TYPE_VEC) => format!("[{}]", type_name(&types[1..])),
+        Some(&TYPE_KLASS) => String::from("objecto"),
+        _ => String::from("indef"),
+    }
+}
+
+//Checks that a value read by read_value has the type at the start
+//of types. Ints are converted to real where a real is expected, as
+//in the calls made by a program
+pub fn check_type(value: &mut AmaValue, types: &[u8]) -> bool {
+    let code = match types.first() {
+        Some(&code) => code,
+        None => return false,
+    };
+    if code == TYPE_REAL {
+        if let AmaValue::Int(int) = *value {
+            *value = AmaValue::F64(int as f64);
+        }
+    }
+    match (code, value) {
+        (TYPE_INDEF, _) => true,
+        (TYPE_INT, AmaValue::Int(_))
+        | (TYPE_REAL, AmaValue::F64(_))
+        | (TYPE_BOOL, AmaValue::Bool(_))
+        | (TYPE_TEXTO, AmaValue::Str(_))
+        | (TYPE_KLASS, AmaValue::None) => true,
+        //The elements were allocated by read_value, so they can be changed
+        (TYPE_VEC, AmaValue::Vector(elements)) => elements
+            .iter()
+            .all(|element| check_type(element.inner_mut(), &types[1..])),
+        _ => false,
+    }
+}
+
+pub fn write_value(value: &AmaValue, out: &mut Vec<u8>) -> Result<(), String> {
+    match value {
+        AmaValue::Int(int) => {
+            out.push(INT);
+            out.extend_from_slice(&int.to_le_bytes());
+        }
+        AmaValue::F64(real) => {
+            out.push(REAL);
+            out.extend_from_slice(&real.to_le_bytes());
+        }
+        AmaValue::Str(string) => {
+            out.push(STR);
+            out.extend_from_slice(&(string.len() as u32).to_le_bytes());
+            out.extend_from_slice(string.as_bytes());
+        }
+        AmaValue::Bool(boolean) => {
+            out.push(BOOL);
+            out.push(*boolean as u8);
+        }
+        AmaValue::None => out.push(NULL),
+        AmaValue::Vector(elements) => {
+            out.push(VECTOR);
+            out.extend_from_slice(&(elements.len() as u32).to_le_bytes());
+            for element in elements {
+                write_value(element.inner(), out)?;
+            }
+        }
+        _ => return Err(format!("Não é possível converter o valor: {}", value)),
+    }
+    Ok(())
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_round_trip() {
+        let mut alloc = Alloc::new();
+        let mut bytes = vec![VECTOR, 2, 0, 0, 0, INT];
+        bytes.extend_from_slice(&7i64.to_le_bytes());
+        bytes.extend_from_slice(&[STR, 2, 0, 0, 0, b'o', b'i']);
+        let mut pos = 0;
+        let value = read_value(&bytes, &mut pos, &mut alloc).unwrap();
+        assert_eq!(pos, bytes.len());
+        let mut out = Vec::new();
+        write_value(&value, &mut out).unwrap();
+        assert_eq!(out, bytes);
+    }
+
+    #[test]
+    fn test_truncated_value() {
+        let mut alloc = Alloc::new();
+        let mut pos = 0;
+        assert!(read_value(&[INT, 1, 0], &mut pos, &mut alloc).is_err());
+    }
+
+    #[test]
+    fn test_check_type() {
+        let mut alloc = Alloc::new();
+        let mut bytes = vec![VECTOR, 2, 0, 0, 0, INT];
+        bytes.extend_from_slice(&7i64.to_le_bytes());
+        bytes.push(INT);
+        bytes.extend_from_slice(&8i64.to_le_bytes());
+        let mut value = read_value(&bytes, &mut 0, &mut alloc).unwrap();
+        assert!(check_type(&mut value, b"[i"));
+        assert!(!check_type(&mut value, b"[t"));
+        assert!(!check_type(&mut value, b"i"));
+        assert!(check_type(&mut value, b"x"));
+        //Ints are promoted to real
+        assert!(check_type(&mut value, b"[r"));
+        assert!(!check_type(&mut value, b"[i"));
+        assert_eq!(type_size(b"[[ri"), 3);
+        assert_eq!(type_name(b"[[ri"), "[[real]]");
+    }
+}
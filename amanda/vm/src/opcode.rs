@@ -33,6 +33,26 @@ pub enum OpCode {
     Cast,
     BuildStr,
     BuildVec,
+    IncLocal,
+    BinopLocals,
+    CompareAndJump,
+    Dup,
+    JumpIfFalseOrPop,
+    JumpIfTrueOrPop,
+    JumpShort,
+    JumpNear,
+    JumpIfFalseShort,
+    JumpIfFalseNear,
+    CompareAndJumpShort,
+    CompareAndJumpNear,
+    JumpIfFalseOrPopShort,
+    JumpIfFalseOrPopNear,
+    JumpIfTrueOrPopShort,
+    JumpIfTrueOrPopNear,
+    CallDirect,
+    CallNative,
+    TailCall,
+    Pop,
     Halt = 255,
 }
 
@@ -70,6 +90,26 @@ impl From<&u8> for OpCode {
             OpCode::Cast,
             OpCode::BuildStr,
             OpCode::BuildVec,
+            OpCode::IncLocal,
+            OpCode::BinopLocals,
+            OpCode::CompareAndJump,
+            OpCode::Dup,
+            OpCode::JumpIfFalseOrPop,
+            OpCode::JumpIfTrueOrPop,
+            OpCode::JumpShort,
+            OpCode::JumpNear,
+            OpCode::JumpIfFalseShort,
+            OpCode::JumpIfFalseNear,
+            OpCode::CompareAndJumpShort,
+            OpCode::CompareAndJumpNear,
+            OpCode::JumpIfFalseOrPopShort,
+            OpCode::JumpIfFalseOrPopNear,
+            OpCode::JumpIfTrueOrPopShort,
+            OpCode::JumpIfTrueOrPopNear,
+            OpCode::CallDirect,
+            OpCode::CallNative,
+            OpCode::TailCall,
+            OpCode::Pop,
         ];
         if *number == 0xff {
             OpCode::Halt
@@ -78,3 +118,31 @@ impl From<&u8> for OpCode {
         }
     }
 }
+
+/// Encoding of the target of a jump op
+pub enum JumpForm {
+    /// Signed 8-bit offset relative to the start of the op
+    Short,
+    /// Signed 16-bit offset relative to the start of the op
+    Near,
+    /// Absolute 64-bit address
+    Long,
+}
+
+impl OpCode {
+    pub fn jump_form(&self) -> JumpForm {
+        match self {
+            OpCode::JumpShort
+            | OpCode::JumpIfFalseShort
+            | OpCode::CompareAndJumpShort
+            | OpCode::JumpIfFalseOrPopShort
+            | OpCode::JumpIfTrueOrPopShort => JumpForm::Short,
+            OpCode::JumpNear
+            | OpCode::JumpIfFalseNear
+            | OpCode::CompareAndJumpNear
+            | OpCode::JumpIfFalseOrPopNear
+            | OpCode::JumpIfTrueOrPopNear => JumpForm::Near,
+            _ => JumpForm::Long,
+        }
+    }
+}
@@ -0,0 +1,129 @@
+use crate::alloc::Alloc;
+use crate::binload;
+use crate::binload::Module;
+use crate::errors::AmaErr;
+use crate::marshal;
+use crate::vm::AmaVM;
+use std::collections::HashMap;
+use std::mem::ManuallyDrop;
+
+//A module that is loaded once and can be run many times.
+//The session owns a copy of the module, so the vm and the loaded
+//module borrow from memory that lives as long as the session
+pub struct Session {
+    vm: ManuallyDrop<AmaVM<'static>>,
+    module: *mut Module<'static>,
+    bin: *mut [u8],
+    //Maps the name of each function to its index in the module
+    functions: HashMap<&'static str, usize>,
+    //Result of the last call, or the error it raised
+    pub output: Vec<u8>,
+}
+
+pub enum CallError {
+    NotFound,
+    BadArgs(String),
+    Runtime(AmaErr),
+    BadResult(String),
+}
+
+impl Session {
+    pub fn new(bin_module: &[u8]) -> Result<Session, String> {
+        let bin = Box::into_raw(bin_module.to_vec().into_boxed_slice());
+        let mut alloc = Alloc::new();
+        //SAFETY: Both boxes are only freed when the session is dropped
+        let module = match binload::load_bin(unsafe { &*bin }, &mut alloc) {
+            Ok(module) => Box::into_raw(Box::new(module)),
+            Err(err) => {
+                drop(alloc);
+                unsafe { drop(Box::from_raw(bin)) };
+                return Err(err);
+            }
+        };
+        let vm = AmaVM::new(unsafe { &*module }, alloc);
+        let functions = unsafe { &*module }
+            .functions
+            .iter()
+            .enumerate()
+            .map(|(idx, func)| (func.name, idx))
+            .collect();
+        Ok(Session {
+            vm: ManuallyDrop::new(vm),
+            module,
+            bin,
+            functions,
+            output: Vec::new(),
+        })
+    }
+
+    pub fn run(&mut self) -> Result<(), AmaErr> {
+        self.vm.reset();
+        self.vm.run()
+    }
+
+    //Calls a function of the module with the values encoded in args
+    //and writes its encoded result to self.output. The objects allocated
+    //by the call are freed when it returns, unless one of them was stored
+    //in a global or in an object that existed before the call. Those are
+    //only freed by the next run
+    pub fn call(&mut self, name: &str, args: &[u8], argc: usize) -> Result<(), CallError> {
+        self.output.clear();
+        let idx = *self.functions.get(name).ok_or(CallError::NotFound)?;
+        let func = unsafe { &*self.module }.functions[idx];
+        if argc != func.params {
+            return Err(CallError::BadArgs(format!(
+                "número incorrecto de argumentos para a função {}. Esperava {} argumento(s), porém recebeu {}",
+                func.name, func.params, argc
+            )));
+        }
+        let mark = self.vm.alloc().begin_scope();
+        let result = self.call_idx(idx, args, argc);
+        //SAFETY: The result was encoded into self.output and the objects
+        //kept by the globals are not freed
+        unsafe { self.vm.alloc().end_scope(mark) };
+        result
+    }
+
+    fn call_idx(&mut self, idx: usize, args: &[u8], argc: usize) -> Result<(), CallError> {
+        let func = unsafe { &*self.module }.functions[idx];
+        let mut types = func.param_types.as_bytes();
+        let mut values = Vec::with_capacity(argc);
+        let mut pos = 0;
+        for i in 0..argc {
+            let mut value = marshal::read_value(args, &mut pos, self.vm.alloc())
+                .map_err(CallError::BadArgs)?;
+            if !marshal::check_type(&mut value, types) {
+                return Err(CallError::BadArgs(format!(
+                    "o argumento {} da função {} deve ser do tipo {}",
+                    i + 1,
+                    func.name,
+                    marshal::type_name(types)
+                )));
+            }
+            types = &types[marshal::type_size(types)..];
+            values.push(value);
+        }
+        let result = self.vm.call(idx, values).map_err(CallError::Runtime)?;
+        marshal::write_value(result.inner(), &mut self.output).map_err(CallError::BadResult)
+    }
+
+    pub fn vm(&self) -> &AmaVM<'static> {
+        &self.vm
+    }
+
+    pub fn vm_mut(&mut self) -> &mut AmaVM<'static> {
+        &mut self.vm
+    }
+}
+
+impl Drop for Session {
+    fn drop(&mut self) {
+        //SAFETY: The vm borrows the module and the module borrows
+        //the bytes, so they are dropped in that order
+        unsafe {
+            ManuallyDrop::drop(&mut self.vm);
+            drop(Box::from_raw(self.module));
+            drop(Box::from_raw(self.bin));
+        }
+    }
+}
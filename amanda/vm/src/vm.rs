@@ -1,15 +1,18 @@
 use std::fmt::Write;
 use std::borrow::Cow;
+use crate::ama_io::AmaIO;
 use crate::ama_value;
-use crate::ama_value::{AmaFunc, AmaValue};
+use crate::ama_value::{AmaFunc, AmaValue, NativeFunc};
 use crate::binload::Module;
 use crate::builtins;
 use crate::errors::AmaErr;
 use crate::alloc::{Alloc, Ref};
-use crate::opcode::OpCode;
+use crate::opcode::{JumpForm, OpCode};
 use unicode_segmentation::UnicodeSegmentation;
 use std::collections::HashMap;
 use std::convert::From;
+use std::ptr;
+use std::sync::atomic::{AtomicBool, Ordering};
 
 const RECURSION_LIMIT: usize = 1000;
 
@@ -57,23 +60,59 @@ impl<'a> FrameStack<'a> {
     }
 }
 
+//Limits set by the host on a run of the vm. They are checked at backward
+//jumps and calls, so that loops and recursion can't go past them
+#[repr(C)]
+#[derive(Clone, Copy)]
+pub struct Limits {
+    //Number of ops the vm may dispatch. 0 means no limit
+    pub budget: u64,
+    //Flag that another thread sets to stop the vm. May be null
+    pub cancel: *const AtomicBool,
+}
+
+impl Limits {
+    pub fn none() -> Self {
+        Limits {
+            budget: 0,
+            cancel: ptr::null(),
+        }
+    }
+}
+
+//Why the vm was stopped before the module finished
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub enum Interrupt {
+    OutOfBudget,
+    Cancelled,
+}
+
 pub struct AmaVM<'a> {
     module: &'a Module<'a>,
     frames: FrameStack<'a>,
-    globals: HashMap<&'a str, Ref<'a>>,
+    globals: Vec<Ref<'a>>,
+    //Value of each global before the module runs
+    initial_globals: Vec<Ref<'a>>,
+    //Objects allocated before the module runs
+    initial_objects: Option<Ref<'a>>,
+    natives: Vec<NativeFunc<'a>>,
     values: Vec<Ref<'a>>,
     alloc: Alloc<'a>, 
+    pub io: AmaIO,
     sp: isize,
+    pub dispatches: u64,
+    pub limits: Limits,
+    pub interrupt: Option<Interrupt>,
 }
 
-//TODO: Make this faster
-fn offset_to_line(offset: usize, src_map: &Vec<usize>) -> usize {
-    for i in (0..src_map.len()).step_by(3) {
-        if offset >= src_map[i] && offset <= src_map[i + 1] {
-            return src_map[i + 2];
-        }
+//Finds the last entry of the line table that starts at or before offset
+fn offset_to_line(offset: usize, line_table: &[(usize, usize)]) -> usize {
+    let idx = line_table.partition_point(|&(start, _)| start <= offset);
+    if idx == 0 {
+        0
+    } else {
+        line_table[idx - 1].1
     }
-    0
 }
 
 impl<'a> AmaVM<'a> {
@@ -82,46 +121,109 @@ impl<'a> AmaVM<'a> {
         let mut vm = AmaVM {
             module,
             frames: FrameStack::new(),
-            globals: HashMap::with_capacity(builtin_objs.len()), 
-            values: vec![alloc.null_ref(); module.main.locals.into()],
+            globals: vec![alloc.null_ref(); module.globals.len()],
+            initial_globals: Vec::new(),
+            initial_objects: None,
+            natives: Vec::with_capacity(builtin_objs.len()),
+            //Stack space used by the entry code is allocated up front
+            values: vec![alloc.null_ref(); module.main.locals + module.main.max_stack],
             alloc, 
+            io: AmaIO::stdio(),
             sp: -1,
+            dispatches: 0,
+            limits: Limits::none(),
+            interrupt: None,
         };
-        vm.frames.push(module.main).unwrap();
-        vm.sp = vm.values.len() as isize - 1;
-        vm.frames.peek_mut().bp = if vm.sp > -1 { 0 } else { -1 };
+        vm.enter_main();
 
+        //Resolve the slot of every function and builtin once
+        let mut defined: HashMap<&str, AmaValue<'a>> =
+            HashMap::with_capacity(module.functions.len() + builtin_objs.len());
         for func in module.functions.iter() {
-            vm.globals.insert(func.name, vm.alloc.alloc_ref(AmaValue::Func(*func)));
+            defined.insert(func.name, AmaValue::Func(*func));
         }
-        for (name, func) in builtin_objs{
-            vm.globals.insert(name, vm.alloc.alloc_ref(func));
+        for (name, func) in builtin_objs {
+            if let AmaValue::NativeFn(native_fn) = func {
+                vm.natives.push(native_fn);
+            }
+            defined.insert(name, func);
+        }
+        for (slot, name) in module.globals.iter().enumerate() {
+            if let Some(value) = defined.remove(name) {
+                vm.globals[slot] = vm.alloc.alloc_ref(value);
+            }
         }
+        vm.initial_globals = vm.globals.clone();
+        vm.initial_objects = vm.alloc.mark();
         vm
     }
 
+    pub fn alloc(&mut self) -> &mut Alloc<'a> {
+        &mut self.alloc
+    }
+
+    //Calls function idx of the module with args and returns its result.
+    //Globals keep the values left by the last run of the module
+    pub fn call(&mut self, idx: usize, args: Vec<AmaValue<'a>>) -> Result<Ref<'a>, AmaErr> {
+        let mut func = self.module.functions[idx];
+        debug_assert!(args.len() == func.params, "Wrong number of args");
+        self.frames = FrameStack::new();
+        self.enter_main();
+        self.dispatches = 0;
+        self.interrupt = None;
+        //The function returns to the halt at the end of the code
+        self.frames.peek_mut().ip = self.module.code.len() - 1;
+        let args_end = (self.sp + 1) as usize + args.len();
+        if self.values.len() < args_end {
+            self.values.resize(args_end, self.alloc.null_ref());
+        }
+        let argc = args.len() as isize;
+        for arg in args {
+            match arg {
+                AmaValue::None => self.op_push(self.alloc.null_ref()),
+                arg => self.alloc_push(arg),
+            }
+        }
+        self.setup_frame(&mut func, argc);
+        self.frames.push(func).unwrap();
+        self.run()?;
+        Ok(self.op_pop())
+    }
+
+    fn enter_main(&mut self) {
+        self.frames.push(self.module.main).unwrap();
+        self.sp = self.module.main.locals as isize - 1;
+        self.frames.peek_mut().bp = if self.sp > -1 { 0 } else { -1 };
+    }
+
+    //Restores the state the vm had before running the module,
+    //so that it can be run again. The module and builtins are kept
+    pub fn reset(&mut self) {
+        let null_ref = self.alloc.null_ref();
+        self.values.fill(null_ref);
+        self.globals.copy_from_slice(&self.initial_globals);
+        //SAFETY: Nothing refers to the objects allocated by the last run
+        //now that the stack and the globals are cleared
+        unsafe { self.alloc.free_after(self.initial_objects) };
+        self.frames = FrameStack::new();
+        self.enter_main();
+        self.dispatches = 0;
+        self.interrupt = None;
+    }
+
+    //The stack space of every frame is allocated when the frame is set up
+    //(see setup_frame), so push and pop never need to grow the stack
+    #[inline]
     fn op_push(&mut self, value: Ref<'a>) {
         self.sp += 1;
-        let values_size = self.values.len() as isize;
-        if self.sp == values_size {
-            self.values.push(value);
-        } else if self.sp < values_size {
-            self.values[self.sp as usize] = value;
-        }
+        self.values[self.sp as usize] = value;
     }
 
+    #[inline]
     fn op_pop(&mut self) -> Ref<'a> {
-        let values_size = (self.values.len() - 1) as isize;
-        if self.sp == values_size {
-            self.sp -= 1;
-            self.values.pop().unwrap()
-        } else if self.sp < values_size {
-            let idx = self.sp;
-            self.sp -= 1;
-            self.values[idx as usize]
-        } else {
-            panic!("Undefined VM State. sp larger than values!");
-        }
+        let value = self.values[self.sp as usize];
+        self.sp -= 1;
+        value
     }
 
     fn get_byte(&mut self) -> u8 {
@@ -134,17 +236,101 @@ impl<'a> AmaVM<'a> {
     }
 
     fn get_u64_arg(&mut self) -> u64 {
+        let start = self.frames.peek().ip + 1;
         let mut uint64 = [0; 8];
-        for i in 0..8 {
-            uint64[i] = self.get_byte();
-        }
+        uint64.copy_from_slice(&self.module.code[start..start + 8]);
+        self.frames.peek_mut().ip += 8;
         u64::from_be_bytes(uint64)
     }
 
-    fn reserve_stack_space(&mut self, size: usize) {
-        let new_len = self.values.len() + size;
-        self.values.resize(new_len, self.alloc.null_ref());
-        self.sp = self.values.len() as isize - 1;
+    fn get_jump_addr(&mut self, op: OpCode) -> usize {
+        // Relative offsets are counted from the start of the op
+        let op_start = self.frames.peek().last_i as isize;
+        match op.jump_form() {
+            JumpForm::Short => (op_start + self.get_byte() as i8 as isize) as usize,
+            JumpForm::Near => (op_start + self.get_u16_arg() as i16 as isize) as usize,
+            JumpForm::Long => self.get_u64_arg() as usize,
+        }
+    }
+
+    //Sets up the locals of a function whose args are at the top of the stack
+    //and allocates the stack space used by the function
+    fn setup_frame(&mut self, func: &mut AmaFunc<'a>, args: isize) {
+        let bp = self.sp - (args - 1);
+        if args > 0 || func.locals > 0 {
+            func.bp = bp;
+        }
+        let locals_end = bp as usize + func.locals;
+        let stack_size = locals_end + func.max_stack;
+        if self.values.len() < stack_size {
+            self.values.resize(stack_size, self.alloc.null_ref());
+        }
+        let null_ref = self.alloc.null_ref();
+        self.values[(self.sp + 1) as usize..locals_end].fill(null_ref);
+        self.sp = locals_end as isize - 1;
+    }
+
+    fn check_limits(&mut self) -> Result<(), AmaErr> {
+        if self.limits.budget > 0 && self.dispatches > self.limits.budget {
+            self.interrupt = Some(Interrupt::OutOfBudget);
+            return self.panic_and_throw("Limite de instruções excedido");
+        }
+        //SAFETY: The host keeps the flag alive while the vm runs
+        if !self.limits.cancel.is_null() && unsafe { (*self.limits.cancel).load(Ordering::Relaxed) } {
+            self.interrupt = Some(Interrupt::Cancelled);
+            return self.panic_and_throw("Execução cancelada");
+        }
+        Ok(())
+    }
+
+    #[inline]
+    fn jump(&mut self, addr: usize) -> Result<(), AmaErr> {
+        //Only backward jumps can form a loop
+        if addr <= self.frames.peek().last_i {
+            self.check_limits()?;
+        }
+        self.frames.peek_mut().ip = addr;
+        Ok(())
+    }
+
+    fn call_function(&mut self, mut func: AmaFunc<'a>, args: isize) -> Result<(), AmaErr> {
+        self.check_limits()?;
+        self.setup_frame(&mut func, args);
+        //Set return addr in caller
+        self.frames.peek_mut().ip += 1;
+        if let Err(()) = self.frames.push(func) {
+            return self.panic_and_throw("Limite máximo de recursão atingido");
+        }
+        Ok(())
+    }
+
+    fn tail_call(&mut self, mut func: AmaFunc<'a>, args: isize) -> Result<(), AmaErr> {
+        self.check_limits()?;
+        //Drop the locals of the current frame and move the args into their place
+        let args_start = (self.sp - (args - 1)) as usize;
+        let frame_bp = self.frames.peek().bp;
+        let base = if frame_bp > -1 { frame_bp as usize } else { args_start };
+        self.values.copy_within(args_start..(self.sp + 1) as usize, base);
+        self.sp = base as isize + args - 1;
+        self.setup_frame(&mut func, args);
+        //The return addr is still set in the caller
+        *self.frames.peek_mut() = func;
+        Ok(())
+    }
+
+    fn call_native(&mut self, native_fn: NativeFunc<'a>, args: isize) -> Result<(), AmaErr> {
+        let mut fn_args: &[Ref] = &[];
+        if args > 0 {
+            let start = (self.sp - (args - 1)) as usize;
+            fn_args = &self.values[start..=self.sp as usize];
+            self.sp = start as isize - 1;
+        }
+        let result = (native_fn.func)(fn_args, &mut self.alloc, &mut self.io);
+        if let Err(msg) = result {
+            return self.panic_and_throw(&msg);
+        }
+        self.op_push(result.unwrap());
+        Ok(())
     }
 
     fn alloc_push(&mut self, value: AmaValue<'a>){
@@ -156,12 +342,18 @@ impl<'a> AmaVM<'a> {
         loop {
             let op = self.module.code[self.frames.peek().ip];
             self.frames.peek_mut().last_i = self.frames.peek().ip;
+            self.dispatches += 1;
             match OpCode::from(&op) {
                 OpCode::LoadConst => {
                     let idx = self.get_u16_arg();
                     self.op_push(self.module.constants[idx as usize]);
                 }
-                OpCode::Mostra => println!("{}", self.op_pop().inner()),
+                OpCode::Mostra => {
+                    let value = self.op_pop();
+                    if let Err(msg) = writeln!(self.io, "{}", value.inner()) {
+                        return self.panic_and_throw(&msg);
+                    }
+                }
                 //Binary Operations
                 OpCode::OpAdd
                 | OpCode::OpMinus
@@ -241,7 +433,10 @@ impl<'a> AmaVM<'a> {
                     match target.inner_mut() {
                         AmaValue::Vector(vec) =>{
                             match target.inner().vec_index_check(idx){
-                                Ok(_) => vec[idx as usize] = value, 
+                                Ok(_) => {
+                                    self.alloc.note_store(Some(target), value);
+                                    vec[idx as usize] = value
+                                }
                                 Err(err) => self.panic_and_throw(&err)?
                             };
                         }
@@ -250,30 +445,29 @@ impl<'a> AmaVM<'a> {
 
                 }
                 OpCode::GetGlobal => {
-                    let id_idx = self.get_u16_arg() as usize;
-                    let id: &str = &self.module.names[id_idx];
-                    self.op_push(*self.globals.get(id).unwrap());
+                    let slot = self.get_u16_arg() as usize;
+                    self.op_push(self.globals[slot]);
                 }
                 OpCode::SetGlobal => {
-                    let id_idx = self.get_u16_arg() as usize;
-                    let id: &str = &self.module.names[id_idx];
+                    let slot = self.get_u16_arg() as usize;
                     let value = self.op_pop();
-                    self.globals.insert(id, value);
+                    self.alloc.note_store(None, value);
+                    self.globals[slot] = value;
                 }
-                OpCode::Jump => {
-                    let addr = self.get_u64_arg() as usize;
-                    self.frames.peek_mut().ip = addr;
+                OpCode::Jump | OpCode::JumpShort | OpCode::JumpNear => {
+                    let addr = self.get_jump_addr(OpCode::from(&op));
+                    self.jump(addr)?;
                     continue;
                 }
-                OpCode::JumpIfFalse => {
+                OpCode::JumpIfFalse | OpCode::JumpIfFalseShort | OpCode::JumpIfFalseNear => {
                     /*
                      * Jumps if the top of the values is false
                      * Pops the values
                      * */
-                    let addr = self.get_u64_arg() as usize;
+                    let addr = self.get_jump_addr(OpCode::from(&op));
                     let value = self.op_pop();
                     if let AmaValue::Bool(false) = value.inner() {
-                        self.frames.peek_mut().ip = addr;
+                        self.jump(addr)?;
                         continue;
                     }
                 }
@@ -289,40 +483,39 @@ impl<'a> AmaVM<'a> {
                     let args = self.get_byte() as isize;
                     let fn_val = self.op_pop();
                     match fn_val.inner() {
-                        AmaValue::Func(mut func) => {
-                            if args > 0 {
-                                func.bp = self.sp - (args - 1);
-                                let extra = func.locals - args as usize;
-                                self.reserve_stack_space(extra);
-                            } else if func.locals > 0 {
-                                func.bp = self.sp + 1;
-                                self.reserve_stack_space(func.locals);
-                            }
-                            //Set return addr in caller
-                            self.frames.peek_mut().ip += 1;
-                            if let Err(()) = self.frames.push(func) {
-                                return self.panic_and_throw("Limite máximo de recursão atingido");
-                            }
+                        AmaValue::Func(func) => {
+                            self.call_function(*func, args)?;
                             continue;
                         }
                         AmaValue::NativeFn(native_fn) => {
-                            let mut fn_args: &[Ref] = &[];
-                            if args > 0 {
-                                let start = (self.sp - (args - 1)) as usize;
-                                fn_args = &self.values[start..=self.sp as usize];
-                                self.sp = start as isize - 1;
-                            }
-                            let result = (native_fn.func)(fn_args, &mut self.alloc);
-                            if let Err(msg) = result {
-                                return self.panic_and_throw(&msg);
-                            }
-                            self.op_push(result.unwrap());
-                            //Drop values
-                            self.values.drain(self.sp as usize + 1..);
+                            self.call_native(*native_fn, args)?;
                         }
                         _ => panic!("Expected function at the top of the stack!"),
                     }
                 }
+                OpCode::CallDirect => {
+                    let idx = self.get_u16_arg() as usize;
+                    let func = self.module.functions[idx];
+                    let args = self.get_byte() as isize;
+                    self.call_function(func, args)?;
+                    continue;
+                }
+                OpCode::TailCall => {
+                    let idx = self.get_u16_arg() as usize;
+                    let func = self.module.functions[idx];
+                    let args = self.get_byte() as isize;
+                    self.tail_call(func, args)?;
+                    continue;
+                }
+                OpCode::CallNative => {
+                    let idx = self.get_u16_arg() as usize;
+                    let native_fn = self.natives[idx];
+                    let args = self.get_byte() as isize;
+                    self.call_native(native_fn, args)?;
+                }
+                OpCode::Pop => {
+                    self.sp -= 1;
+                }
                 OpCode::Return => {
                     let val = self.op_pop();
                     let frame_bp = self.frames.peek().bp;
@@ -340,7 +533,6 @@ impl<'a> AmaVM<'a> {
                     }
                     //Drop values
                     self.sp = start as isize - 1;
-                    self.values.drain((self.sp + 1) as usize..);
                     self.alloc_push(AmaValue::Str(Cow::Owned(built_str)));
                 }
                 OpCode::BuildVec => {
@@ -354,8 +546,6 @@ impl<'a> AmaVM<'a> {
                     let elements = AmaValue::Vector(Vec::from(&self.values[start..=self.sp as usize]));
                     self.sp = start as isize - 1;
                     self.alloc_push(elements);
-                    //Drop values
-                    self.values.drain(self.sp as usize + 1..);
                 }
                 OpCode::Cast => {
                     let arg = self.get_byte();
@@ -379,7 +569,78 @@ impl<'a> AmaVM<'a> {
                         self.op_push(val_ref);
                     }
                 }
-                OpCode::Halt => break,
+                OpCode::IncLocal => {
+                    let idx = self.frames.peek().bp as usize + self.get_u16_arg() as usize;
+                    let constant = self.module.constants[self.get_u16_arg() as usize];
+                    let result = AmaValue::binop(self.values[idx].inner(), OpCode::OpAdd, constant.inner());
+                    match result {
+                        Ok(value) => self.values[idx] = self.alloc.alloc_ref(value),
+                        Err(msg) => return self.panic_and_throw(msg),
+                    }
+                }
+                OpCode::BinopLocals => {
+                    let binop = OpCode::from(&self.get_byte());
+                    let bp = self.frames.peek().bp as usize;
+                    let left_idx = bp + self.get_u16_arg() as usize;
+                    let right_idx = bp + self.get_u16_arg() as usize;
+                    let (left, right) = (self.values[left_idx], self.values[right_idx]);
+                    match AmaValue::binop(left.inner(), binop, right.inner()) {
+                        Ok(value) => self.alloc_push(value),
+                        Err(msg) => return self.panic_and_throw(msg),
+                    }
+                }
+                OpCode::CompareAndJump
+                | OpCode::CompareAndJumpShort
+                | OpCode::CompareAndJumpNear => {
+                    /*
+                     * Compares TOS-1 with TOS and jumps if the result is false.
+                     * Pops both operands
+                     * */
+                    let cmp = OpCode::from(&self.get_byte());
+                    let addr = self.get_jump_addr(OpCode::from(&op));
+                    let right = self.op_pop();
+                    let left = self.op_pop();
+                    match AmaValue::binop(left.inner(), cmp, right.inner()) {
+                        Ok(AmaValue::Bool(false)) => {
+                            self.jump(addr)?;
+                            continue;
+                        }
+                        Ok(_) => (),
+                        Err(msg) => return self.panic_and_throw(msg),
+                    }
+                }
+                OpCode::JumpIfFalseOrPop
+                | OpCode::JumpIfFalseOrPopShort
+                | OpCode::JumpIfFalseOrPopNear
+                | OpCode::JumpIfTrueOrPop
+                | OpCode::JumpIfTrueOrPopShort
+                | OpCode::JumpIfTrueOrPopNear => {
+                    /*
+                     * Jumps if the top of the values matches the condition of the op,
+                     * leaving it on the stack. Otherwise pops it
+                     * */
+                    let jump_op = OpCode::from(&op);
+                    let addr = self.get_jump_addr(jump_op);
+                    let jump_on = match jump_op {
+                        OpCode::JumpIfTrueOrPop
+                        | OpCode::JumpIfTrueOrPopShort
+                        | OpCode::JumpIfTrueOrPopNear => true,
+                        _ => false,
+                    };
+                    if self.values[self.sp as usize].inner().take_bool() == jump_on {
+                        self.jump(addr)?;
+                        continue;
+                    }
+                    self.op_pop();
+                }
+                OpCode::Dup => {
+                    let top = self.values[self.sp as usize];
+                    self.op_push(top);
+                }
+                OpCode::Halt => {
+                    self.io.flush();
+                    break;
+                }
             }
             self.frames.peek_mut().ip += 1;
         }
@@ -392,7 +653,10 @@ impl<'a> AmaVM<'a> {
     }
 
     fn panic_and_throw(&mut self, error: &str) -> Result<(), AmaErr> {
+        //Output written before the error is shown before its message
+        self.io.flush();
         let mut frames_sp = self.frames.sp;
+        let line_table = self.module.lines();
         let mut err_str = if frames_sp > 0 {
             String::from("Fluxo de execução: \n")
         } else {
@@ -402,14 +666,14 @@ impl<'a> AmaVM<'a> {
             if frames_sp == 0 {
                 err_str.push_str(&format!(
                     "Erro na linha {}: {}.",
-                    offset_to_line(func.last_i, &self.module.src_map),
+                    offset_to_line(func.last_i, line_table),
                     error
                 ));
                 break;
             }
             err_str.push_str(&format!(
                 "    Linha {}, na função {}\n",
-                offset_to_line(func.last_i, &self.module.src_map),
+                offset_to_line(func.last_i, line_table),
                 func.name
             ));
             frames_sp = self.frames.sp;
@@ -438,10 +702,13 @@ mod tests {
 
     #[test]
     fn offset_to_line_works() {
-        let src_map = vec![0, 3, 1, 4, 5, 2];
-        assert_eq!(offset_to_line(0, &src_map), 1);
-        assert_eq!(offset_to_line(1, &src_map), 1);
-        assert_eq!(offset_to_line(3, &src_map), 1);
-        assert_eq!(offset_to_line(5, &src_map), 2);
+        let line_table = vec![(0, 1), (4, 2), (6, 1), (9, 3)];
+        assert_eq!(offset_to_line(0, &line_table), 1);
+        assert_eq!(offset_to_line(1, &line_table), 1);
+        assert_eq!(offset_to_line(3, &line_table), 1);
+        assert_eq!(offset_to_line(5, &line_table), 2);
+        assert_eq!(offset_to_line(7, &line_table), 1);
+        assert_eq!(offset_to_line(100, &line_table), 3);
+        assert_eq!(offset_to_line(0, &[]), 0);
     }
 }
@@ -0,0 +1,490 @@
+import unittest
+from io import StringIO
+from amanda.compiler.symbols import Module
+from amanda.compiler.parse import Parser
+from amanda.compiler.semantic import Analyzer
+from amanda.compiler.builtinfn import NATIVES
+from amanda.compiler.codegen import ByteGen, OpCode, JUMP_FORMS
+
+
+def compile_src(src, **options):
+    # Keep jumps in their long form unless a test asks for relaxation
+    options.setdefault("relax_jumps", False)
+    program = Parser("<test>", StringIO(src)).parse()
+    program = Analyzer("<test>", Module("<test>")).visit_program(program)
+    compiler = ByteGen(**options)
+    compiler.compile(program)
+    return compiler
+
+
+def op_names(compiler):
+    return [op.name for op, _, _ in compiler.ops]
+
+
+class FuseOpsTestCase(unittest.TestCase):
+    LOOP = """
+func soma(n: int): int
+    total : int = 0
+    i : int = 0
+    enquanto i < n faca
+        total = total + i
+        i += 1
+    fim
+    retorna total
+fim
+"""
+
+    def test_inc_local(self):
+        ops = op_names(compile_src(self.LOOP))
+        self.assertIn("INC_LOCAL", ops)
+        self.assertNotIn("OP_ADD", ops)
+
+    def test_inc_local_para(self):
+        src = """
+func f(n: int)
+    para i de 0..n faca
+        mostra i
+    fim
+fim
+"""
+        compiler = compile_src(src)
+        incs = [args for op, args, _ in compiler.ops if op == OpCode.INC_LOCAL]
+        self.assertEqual(len(incs), 1)
+
+    def test_binop_locals(self):
+        compiler = compile_src(self.LOOP)
+        binops = [
+            args for op, args, _ in compiler.ops if op == OpCode.BINOP_LOCALS
+        ]
+        self.assertEqual(
+            binops,
+            [(OpCode.OP_LESS.value, 2, 0), (OpCode.OP_ADD.value, 1, 2)],
+        )
+
+    def test_compare_and_jump(self):
+        src = """
+func f(n: int)
+    se n > 2 entao
+        mostra n
+    fim
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertIn("COMPARE_AND_JUMP", ops)
+        self.assertNotIn("OP_GREATER", ops)
+
+    def test_no_fusion_across_labels(self):
+        # The loop label points to GET_LOCAL i, so the condition
+        # can not be merged with the op that comes before it
+        src = """
+func f()
+    i : int = 0
+    enquanto i < 10 faca
+        i += 1
+    fim
+fim
+"""
+        compiler = compile_src(src)
+        targets = set(compiler.labels.values())
+        for pos, (op, _, _) in enumerate(compiler.ops):
+            if op == OpCode.INC_LOCAL:
+                self.assertNotIn(pos, targets)
+
+    def test_fusion_disabled(self):
+        ops = op_names(compile_src(self.LOOP, fuse_ops=False))
+        for op in ("INC_LOCAL", "BINOP_LOCALS", "COMPARE_AND_JUMP"):
+            self.assertNotIn(op, ops)
+
+    def test_jumps_are_relocated(self):
+        compiler = compile_src(self.LOOP)
+        for op, args, _ in compiler.ops:
+            if op in (OpCode.JUMP, OpCode.JUMP_IF_FALSE):
+                target = compiler.offsets[compiler.labels[args[0]]]
+                self.assertIn(target, compiler.offsets)
+
+
+class PeepholeTestCase(unittest.TestCase):
+    def test_dead_return_removed(self):
+        src = """
+func f(n: int): int
+    retorna n
+fim
+"""
+        compiler = compile_src(src)
+        self.assertEqual(op_names(compiler).count("RETURN"), 1)
+        self.assertGreater(compiler.removed_ops, 0)
+
+    def test_jump_to_next_removed(self):
+        src = """
+func f(n: int)
+    se n > 2 entao
+        mostra n
+    fim
+fim
+"""
+        ops = op_names(compile_src(src, fuse_ops=False))
+        # Only the jump over the function body is left
+        self.assertEqual(ops.count("JUMP"), 1)
+
+    def test_jump_threading(self):
+        src = """
+func f(n: int)
+    enquanto n > 0 faca
+        se n > 2 entao
+            n = n - 1
+        senao
+            n = n - 2
+        fim
+    fim
+fim
+"""
+        compiler = compile_src(src, fuse_ops=False)
+        for op, args, _ in compiler.ops:
+            if op == OpCode.JUMP:
+                target = compiler.label_target(args[0])
+                self.assertNotEqual(target[0], OpCode.JUMP)
+
+    def test_chained_assign(self):
+        src = """
+func f()
+    a, b : int
+    a = b = 3
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertIn("DUP", ops)
+        self.assertEqual(ops.count("GET_LOCAL"), 0)
+
+    def test_constant_cast(self):
+        compiler = compile_src("x : real = 2\n")
+        self.assertNotIn("CAST", op_names(compiler))
+        self.assertIn((float, 2.0), compiler.const_table)
+        self.assertEqual(compiler.const_keys, list(compiler.const_table))
+
+    def test_peephole_disabled(self):
+        compiler = compile_src("x : real = 2\n", peephole=False)
+        self.assertIn("CAST", op_names(compiler))
+        self.assertEqual(compiler.removed_ops, 0)
+
+
+class ShortCircuitTestCase(unittest.TestCase):
+    def test_logical_ops_jump(self):
+        src = """
+func f(a: bool, b: bool): bool
+    retorna (a e b) ou a
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertIn("JUMP_IF_FALSE_OR_POP", ops)
+        self.assertIn("JUMP_IF_TRUE_OR_POP", ops)
+        self.assertNotIn("OP_AND", ops)
+        self.assertNotIn("OP_OR", ops)
+
+    def test_condition_jumps_to_branch_exit(self):
+        # The short-circuit jump of a condition is threaded
+        # through the jump that exits the branch
+        src = """
+func f(a: bool, b: bool)
+    se a e b entao
+        mostra a
+    fim
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertNotIn("JUMP_IF_FALSE_OR_POP", ops)
+        self.assertEqual(ops.count("JUMP_IF_FALSE"), 2)
+
+
+class ConstantPoolTestCase(unittest.TestCase):
+    def test_typed_constants(self):
+        src = """
+a : int = 1
+b : real = 1.0
+c : texto = '1'
+d : bool = verdadeiro
+"""
+        constants = compile_src(src).const_table
+        for key in ((int, 1), (float, 1.0), (str, "1"), (bool, True)):
+            self.assertIn(key, constants)
+
+    def test_default_initializers(self):
+        src = """
+a : real
+b : texto
+c : bool
+"""
+        constants = compile_src(src).const_table
+        self.assertIn((float, 0.0), constants)
+        self.assertIn((str, ""), constants)
+        self.assertNotIn((str, "''"), constants)
+
+    def test_format_str_parts(self):
+        compiler = compile_src("x : int = 1\nmostra f'x: {x}'\n")
+        self.assertIn((str, "x: "), compiler.const_table)
+
+
+class GlobalSlotsTestCase(unittest.TestCase):
+    def test_globals_have_slots(self):
+        src = """
+x : int = 1
+func f(): int
+    retorna x
+fim
+mostra f()
+"""
+        compiler = compile_src(src)
+        for name in ("x", "f", "escrevaln", "int"):
+            self.assertIn(name, compiler.globals)
+        slots = sorted(compiler.globals.values())
+        self.assertEqual(slots, list(range(len(slots))))
+
+    def test_global_ops_use_slots(self):
+        compiler = compile_src("x : int = 1\nmostra x\n", promote_globals=False)
+        slot = compiler.globals["x"]
+        args = [
+            args[0]
+            for op, args, _ in compiler.ops
+            if op in (OpCode.GET_GLOBAL, OpCode.SET_GLOBAL)
+        ]
+        self.assertTrue(args)
+        self.assertTrue(all(arg == slot for arg in args))
+
+
+class DirectCallTestCase(unittest.TestCase):
+    def test_recursive_call(self):
+        src = """
+func fibo(n : int) : int
+    se n < 2 entao
+       retorna n
+    fim
+    retorna fibo(n-1) + fibo(n-2)
+fim
+mostra fibo(10)
+"""
+        compiler = compile_src(src)
+        calls = [
+            args for op, args, _ in compiler.ops if op == OpCode.CALL_DIRECT
+        ]
+        self.assertEqual(calls, [(0, 1), (0, 1), (0, 1)])
+        self.assertNotIn("CALL_FUNCTION", op_names(compiler))
+        self.assertNotIn("GET_GLOBAL", op_names(compiler))
+
+    def test_native_call(self):
+        compiler = compile_src("v : [int] = vec(int, 2)\nmostra tam(v)\n")
+        calls = [
+            args for op, args, _ in compiler.ops if op == OpCode.CALL_NATIVE
+        ]
+        self.assertEqual(
+            calls, [(NATIVES.index("vec"), 2), (NATIVES.index("tam"), 1)]
+        )
+
+
+class TailCallTestCase(unittest.TestCase):
+    def test_tail_call_in_branches(self):
+        src = """
+func f(n: int): int
+    se n == 0 entao
+        retorna 0
+    senao
+        retorna f(n - 1)
+    fim
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertEqual(ops.count("TAIL_CALL"), 1)
+        self.assertNotIn("CALL_DIRECT", ops)
+
+    def test_non_tail_call(self):
+        src = """
+func f(n: int): int
+    se n == 0 entao
+        retorna 0
+    fim
+    retorna 1 + f(n - 1)
+fim
+"""
+        ops = op_names(compile_src(src))
+        self.assertNotIn("TAIL_CALL", ops)
+        self.assertIn("CALL_DIRECT", ops)
+
+
+class MaxStackTestCase(unittest.TestCase):
+    def test_entry_max_stack(self):
+        compiler = compile_src("x : int = 1 + 2 * 3\n", peephole=False)
+        self.assertEqual(compiler.max_stack(0), 3)
+
+    def test_function_max_stack(self):
+        src = """
+func f(a: int, b: int): int
+    retorna a + b
+fim
+"""
+        compiler = compile_src(src, fuse_ops=False)
+        start = compiler.label_offset(compiler.funcs[0]["start_ip"])
+        self.assertEqual(compiler.max_stack(start), 2)
+
+    def test_call_statement_is_popped(self):
+        src = """
+i : int = 0
+enquanto i < 10 faca
+    escrevaln(i)
+    i += 1
+fim
+"""
+        compiler = compile_src(src)
+        self.assertIn("POP", op_names(compiler))
+        self.assertEqual(compiler.max_stack(0), 2)
+
+    def test_stack_effects(self):
+        self.assertEqual(OpCode.CALL_DIRECT.stack_effect((0, 3)), -2)
+        self.assertEqual(OpCode.JUMP_IF_FALSE_OR_POP.stack_effect((0,)), -1)
+        self.assertEqual(
+            OpCode.JUMP_IF_FALSE_OR_POP_SHORT.stack_effect((0,), jump=True), 0
+        )
+
+
+class LocalSlotsTestCase(unittest.TestCase):
+    def test_sibling_blocks_share_slots(self):
+        src = """
+func f(c: bool): int
+    se c entao
+        a : int = 1
+        b : int = 2
+        retorna a + b
+    senao
+        d : int = 5
+        retorna d
+    fim
+fim
+"""
+        compiler = compile_src(src)
+        self.assertEqual(compiler.funcs[0]["locals"], 3)
+
+    def test_enclosing_locals_are_kept(self):
+        src = """
+func f(): int
+    x : int = 1
+    enquanto x < 10 faca
+        y : int = x
+        x += y
+    fim
+    z : int = 2
+    retorna x + z
+fim
+"""
+        compiler = compile_src(src)
+        self.assertEqual(compiler.funcs[0]["locals"], 2)
+
+
+class PromoteGlobalsTestCase(unittest.TestCase):
+    SRC = """
+x : int = 0
+y : int = 1
+func f(): int
+    retorna y
+fim
+enquanto x < 10 faca
+    x += f()
+fim
+"""
+
+    def test_script_vars_are_locals(self):
+        compiler = compile_src(self.SRC)
+        self.assertNotIn("x", compiler.globals)
+        self.assertIn("y", compiler.globals)
+        self.assertEqual(compiler.num_locals, 1)
+
+    def test_promotion_disabled(self):
+        compiler = compile_src(self.SRC, promote_globals=False)
+        self.assertIn("x", compiler.globals)
+        self.assertEqual(compiler.num_locals, 0)
+
+
+class LineTableTestCase(unittest.TestCase):
+    def test_line_runs(self):
+        src = """
+x : int = 1
+se x > 0 entao
+    mostra x
+fim
+mostra x + 1
+"""
+        compiler = compile_src(src, promote_globals=False)
+        offsets = [offset for offset, _ in compiler.line_table]
+        self.assertEqual(offsets, sorted(set(offsets)))
+        lines = [line for _, line in compiler.line_table]
+        self.assertEqual(lines[:4], [2, 3, 4, 6])
+        # Consecutive entries always change the line
+        for prev, line in zip(lines, lines[1:]):
+            self.assertNotEqual(prev, line)
+
+
+class RelaxJumpsTestCase(unittest.TestCase):
+    def test_short_jumps(self):
+        src = """
+func f(n: int)
+    enquanto n > 0 faca
+        n -= 1
+    fim
+fim
+"""
+        relaxed = compile_src(src, relax_jumps=True)
+        ops = op_names(relaxed)
+        for long_op in JUMP_FORMS:
+            self.assertNotIn(long_op.name, ops)
+        self.assertIn("JUMP_SHORT", ops)
+        self.assertLess(relaxed.offsets[-1], compile_src(src).offsets[-1])
+
+    def test_wide_jumps(self):
+        # Body of the loop is too large for an 8-bit offset
+        body = "        mostra n\n" * 100
+        src = f"""
+func f(n: int)
+    enquanto n > 0 faca
+{body}        n -= 1
+    fim
+fim
+"""
+        compiler = compile_src(src, relax_jumps=True)
+        ops = op_names(compiler)
+        self.assertIn("JUMP_NEAR", ops)
+        for pos, (op, args, _) in enumerate(compiler.ops):
+            if op == OpCode.JUMP_SHORT:
+                target = compiler.offsets[compiler.labels[args[0]]]
+                self.assertLessEqual(abs(target - compiler.offsets[pos]), 127)
+
+
+class StreamTestCase(unittest.TestCase):
+    SRC = """
+func conta(n: int): int
+    total : int = 0
+    para i de 0..n faca
+        enquanto total > 100 faca
+            quebra
+        fim
+        total += i
+    fim
+    enquanto total > 0 faca
+        total -= 1
+        se (total % 2 == 0) e (total > 2) entao
+            continua
+        fim
+    fim
+    retorna conta(total - 1)
+fim
+x : int = conta(10)
+mostra x
+"""
+
+    def test_same_code_as_unoptimized(self):
+        options = {"fuse_ops": False, "peephole": False, "relax_jumps": False}
+        compiler = compile_src(self.SRC, **options)
+        streamed = compile_src(self.SRC, stream=True)
+        self.assertEqual(streamed.code, compiler.code)
+        self.assertEqual(streamed.line_table, compiler.line_table)
+        self.assertEqual(streamed.max_stack(0), compiler.max_stack(0))
+
+    def test_ops_are_not_kept(self):
+        compiler = compile_src(self.SRC, stream=True)
+        self.assertEqual(compiler.ops, [])
+        self.assertEqual(compiler.fixups, {})
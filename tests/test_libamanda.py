@@ -0,0 +1,424 @@
+import ctypes
+import mmap
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from io import StringIO
+from amanda.compiler.symbols import Module
+from amanda.compiler.parse import Parser
+from amanda.compiler.semantic import Analyzer
+from amanda.compiler.codegen import ByteGen
+from amanda.compiler.bindump import dumps
+from amanda.libamanda import (
+    load_library,
+    as_pointer,
+    run_module,
+    run_raw_module,
+    load_module,
+    run_session,
+    free_session,
+    call_function,
+    run_session_io,
+    run_module_io,
+    dispatch_count,
+    RawModule,
+    CancelFlag,
+    Cancelled,
+    OutOfBudget,
+    OK,
+    ERROR,
+    OUT_OF_BUDGET,
+    CANCELLED,
+)
+
+
+def compile_src(src):
+    program = Parser("<test>", StringIO(src)).parse()
+    program = Analyzer("<test>", Module("<test>")).visit_program(program)
+    return ByteGen().compile_module(program)
+
+
+class RunModuleTestCase(unittest.TestCase):
+    SRC = """
+total : int = 0
+para i de 0..10 faca
+    total += i
+fim
+"""
+
+    def test_library_is_loaded_once(self):
+        self.assertIs(load_library(), load_library())
+
+    def test_buffer_types(self):
+        module = dumps(compile_src(self.SRC))
+        run_module(module)
+        dispatches = dispatch_count()
+        self.assertGreater(dispatches, 0)
+        for buffer in (
+            bytearray(module),
+            memoryview(module),
+            memoryview(bytearray(module)),
+        ):
+            run_module(buffer)
+            self.assertEqual(dispatch_count(), dispatches)
+
+    def test_readonly_mmap_is_not_copied(self):
+        module = dumps(compile_src(self.SRC))
+        run_module(module)
+        dispatches = dispatch_count()
+        with tempfile.TemporaryFile() as module_file:
+            module_file.write(module)
+            module_file.flush()
+            with mmap.mmap(
+                module_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                pointer = as_pointer(mapped)
+                # A write to the file shows up at the address handed to
+                # the vm, so it points at the mapped pages
+                os.pwrite(module_file.fileno(), b"X", 0)
+                self.assertEqual(ctypes.string_at(pointer.address, 1), b"X")
+                os.pwrite(module_file.fileno(), module[:1], 0)
+                # The mapping can't be closed while the vm may read it
+                with self.assertRaises(BufferError):
+                    mapped.close()
+                del pointer
+                run_module(mapped)
+                self.assertEqual(dispatch_count(), dispatches)
+
+    def test_raw_module(self):
+        module = compile_src(self.SRC)
+        run_module(dumps(module))
+        dispatches = dispatch_count()
+        raw = RawModule.from_module(module)
+        self.assertEqual(raw.code.len, len(module["ops"]))
+        run_raw_module(raw)
+        self.assertEqual(dispatch_count(), dispatches)
+
+    def test_bad_header(self):
+        module = bytearray(dumps(compile_src(self.SRC)))
+        stale = bytearray(module)
+        stale[4] = 1
+        for bad in (b"BMAC" + module[4:], stale, module[:20]):
+            with self.assertRaises(ValueError):
+                run_module(bad)
+            with self.assertRaises(ValueError):
+                load_module(bad)
+
+
+class SessionTestCase(unittest.TestCase):
+    SRC = """
+total : int = 0
+v : [int] = [int: 1, 2, 3]
+para i de 0..10 faca
+    total += i
+fim
+v[0] = total
+"""
+
+    def test_run_many_times(self):
+        module = compile_src(self.SRC)
+        run_module(dumps(module))
+        dispatches = dispatch_count()
+        self.assertEqual(run_module(dumps(module)), OK)
+        session = load_module(dumps(module))
+        try:
+            for _ in range(3):
+                # Every run starts from the same state
+                self.assertEqual(run_session(session), OK)
+                self.assertEqual(dispatch_count(), dispatches)
+        finally:
+            free_session(session)
+
+    def test_runtime_error(self):
+        module = dumps(compile_src("x : int = 0\nmostra 1 // x\n"))
+        self.assertEqual(run_module(module), ERROR)
+        session = load_module(module)
+        try:
+            self.assertEqual(run_session(session), ERROR)
+        finally:
+            free_session(session)
+
+
+class CallFunctionTestCase(unittest.TestCase):
+    SRC = """
+base : int = 0
+func soma(a: int, b: int): int
+    retorna base + a + b
+fim
+func media(v: [int]): real
+    total : int = 0
+    para i de 0..tam(v) faca
+        total += v[i]
+    fim
+    retorna total / tam(v)
+fim
+func saudacao(nome: texto, formal: bool): texto
+    se formal entao
+        retorna f"Caro {nome}"
+    fim
+    retorna f"Oi {nome}"
+fim
+func pares(n: int): [int]
+    v : [int] = vec(int, n)
+    para i de 0..n faca
+        v[i] = i * 2
+    fim
+    retorna v
+fim
+func divide(a: int, b: int): int
+    retorna a // b
+fim
+func neg(a: int): int
+    retorna -a
+fim
+func metade(a: real): real
+    retorna a / 2
+fim
+guardados : [texto] = vec(texto, 0)
+ultimo : [int] = vec(int, 0)
+func guarda(nome: texto): int
+    anexa(guardados, f"<{nome}>")
+    retorna tam(guardados)
+fim
+func troca(n: int): int
+    ultimo = pares(n)
+    retorna tam(ultimo)
+fim
+func le_guardado(i: int): texto
+    retorna guardados[i]
+fim
+func le_ultimo(i: int): int
+    retorna ultimo[i]
+fim
+base = 10
+"""
+
+    def setUp(self):
+        self.session = load_module(dumps(compile_src(self.SRC)))
+        run_session(self.session)
+
+    def tearDown(self):
+        free_session(self.session)
+
+    def test_args_and_results(self):
+        self.assertEqual(call_function(self.session, "soma", 1, 2), 13)
+        self.assertEqual(call_function(self.session, "media", [1, 2]), 1.5)
+        self.assertEqual(
+            call_function(self.session, "saudacao", "Ana", True), "Caro Ana"
+        )
+        self.assertEqual(call_function(self.session, "pares", 3), [0, 2, 4])
+
+    def test_repeated_calls(self):
+        for i in range(100):
+            result = call_function(self.session, "soma", i, i)
+            self.assertEqual(result, 10 + 2 * i)
+
+    def test_values_kept_by_globals(self):
+        # Values a call stores in a global must outlive the call
+        for i in range(50):
+            call_function(self.session, "pares", 100)
+            self.assertEqual(
+                call_function(self.session, "guarda", str(i)), i + 1
+            )
+            self.assertEqual(call_function(self.session, "troca", i + 1), i + 1)
+        self.assertEqual(call_function(self.session, "le_guardado", 7), "<7>")
+        self.assertEqual(call_function(self.session, "le_ultimo", 49), 98)
+
+    def test_errors(self):
+        with self.assertRaises(NameError):
+            call_function(self.session, "nao_existe")
+        with self.assertRaises(TypeError):
+            call_function(self.session, "soma", 1)
+        with self.assertRaises(TypeError):
+            call_function(self.session, "soma", 1, object())
+        with self.assertRaises(RuntimeError):
+            call_function(self.session, "divide", 1, 0)
+        # The session can still be used after an error
+        self.assertEqual(call_function(self.session, "divide", 9, 2), 4)
+
+    def test_arg_types(self):
+        for args in (("a",), (2.5,), (True,), (None,), ([1],)):
+            with self.assertRaises(TypeError):
+                call_function(self.session, "neg", *args)
+        with self.assertRaises(TypeError):
+            call_function(self.session, "media", [1, "2"])
+        with self.assertRaises(TypeError):
+            call_function(self.session, "saudacao", "Ana", 1)
+        # Ints are converted where a real is expected
+        self.assertEqual(call_function(self.session, "metade", 3), 1.5)
+        self.assertEqual(call_function(self.session, "neg", 2), -2)
+
+
+class CapturedRunTestCase(unittest.TestCase):
+    SRC = """
+n : int = leia_int("n: ")
+total : int = 0
+para i de 0..n faca
+    x : int = leia_int("")
+    total += x
+    mostra x
+fim
+escreva(f"total: {total}")
+"""
+
+    def setUp(self):
+        self.module = dumps(compile_src(self.SRC))
+
+    def test_input_and_output(self):
+        result = run_module_io(self.module, b"3\n1\n2\r\n3")
+        self.assertEqual(result.output, b"n: 1\n2\n3\ntotal: 6")
+        self.assertEqual(result.error, "")
+        self.assertEqual(result.status, OK)
+
+    def test_runs_are_independent(self):
+        session = load_module(self.module)
+        try:
+            first = run_session_io(session, b"1\n5\n")
+            self.assertEqual(first.output, b"n: 5\ntotal: 5")
+            second = run_session_io(session, b"2\n1\n1\n")
+            self.assertEqual(second.output, b"n: 1\n1\ntotal: 2")
+            self.assertEqual(first.status, OK)
+            self.assertEqual(second.status, OK)
+        finally:
+            free_session(session)
+
+    def test_errors(self):
+        result = run_module_io(self.module, b"2\n1\n")
+        self.assertEqual(result.status, ERROR)
+        self.assertEqual(result.output, b"n: 1\n")
+        self.assertIn("Fim da entrada", result.error)
+        result = run_module_io(self.module, b"x\n")
+        self.assertIn("inteiro", result.error)
+
+    def test_output_limit(self):
+        stdin = b"100\n" + b"12345\n" * 100
+        result = run_module_io(self.module, stdin, output_limit=10)
+        self.assertEqual(result.output, b"n: 12345\n1")
+        self.assertIn("Limite de saída excedido", result.error)
+
+
+class BufferedOutputTestCase(unittest.TestCase):
+    SRC = """
+para i de 0..3 faca
+    mostra i
+fim
+nome : texto = leia("nome: ")
+escrevaln(f"Oi {nome}")
+v : [int] = [int: 1]
+mostra v[2]
+"""
+
+    def run_cli(self, *args):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, "prog.ama")
+            with open(filename, "w", encoding="utf-8") as src_file:
+                src_file.write(self.SRC)
+            return subprocess.run(
+                [sys.executable, "-m", "amanda", *args, filename],
+                input="Ana\n",
+                capture_output=True,
+                encoding="utf8",
+            )
+
+    def test_same_output_as_unbuffered(self):
+        unbuffered = self.run_cli()
+        buffered = self.run_cli("--buffered")
+        self.assertEqual(buffered.stdout, "0\n1\n2\nnome: Oi Ana\n")
+        self.assertEqual(buffered.stdout, unbuffered.stdout)
+        self.assertEqual(buffered.stderr, unbuffered.stderr)
+        self.assertIn("Erro na linha 8", buffered.stderr)
+
+
+class BulkInputTestCase(unittest.TestCase):
+    SRC = """
+n : int = leia_int("")
+v : [int] = leia_ints(n)
+r : [real] = leia_reais(2)
+linhas : [texto] = leia_linhas(-1)
+mostra v
+mostra r[0] + r[1]
+mostra linhas
+"""
+
+    def setUp(self):
+        self.module = dumps(compile_src(self.SRC))
+
+    def test_bulk_reads(self):
+        stdin = b"3\n1 -2\n  3\n1.5 2\nola mundo\nadeus"
+        result = run_module_io(self.module, stdin)
+        self.assertEqual(result.error, "")
+        self.assertEqual(
+            result.output, b"[1, -2, 3]\n3.5\n[ola mundo, adeus]\n"
+        )
+
+    def test_errors(self):
+        result = run_module_io(self.module, b"3\n1 2\n")
+        self.assertIn("Fim da entrada", result.error)
+        result = run_module_io(self.module, b"2\n1 dois\n")
+        self.assertIn("inteiro", result.error)
+
+
+class LimitsTestCase(unittest.TestCase):
+    SRC = """
+func conta(n: int): int
+    se n == 0 entao
+        retorna 0
+    fim
+    retorna conta(n - 1)
+fim
+func sem_fim(): int
+    i : int = 0
+    enquanto verdadeiro faca
+        i += 1
+    fim
+    retorna i
+fim
+n : int = leia_int("")
+para i de 0..n faca
+fim
+mostra conta(n)
+"""
+
+    def setUp(self):
+        self.session = load_module(dumps(compile_src(self.SRC)))
+
+    def tearDown(self):
+        free_session(self.session)
+
+    def test_budget(self):
+        result = run_session_io(self.session, b"1000\n", budget=100)
+        self.assertEqual(result.status, OUT_OF_BUDGET)
+        self.assertIn("Limite de instruções excedido", result.error)
+        # Recursion is stopped too. The loop is skipped when n is 0
+        result = run_session_io(self.session, b"0\n")
+        dispatches = dispatch_count()
+        result = run_session_io(self.session, b"0\n", budget=dispatches)
+        self.assertEqual(result.status, OK)
+        self.assertEqual(result.output, b"0\n")
+        self.assertEqual(result.error, "")
+        with self.assertRaises(OutOfBudget):
+            call_function(self.session, "conta", 10**6, budget=1000)
+        self.assertEqual(call_function(self.session, "conta", 10), 0)
+
+    def test_cancel(self):
+        cancel = CancelFlag()
+        timer = threading.Timer(0.05, cancel.set)
+        timer.start()
+        with self.assertRaises(Cancelled):
+            call_function(self.session, "sem_fim", cancel=cancel)
+        timer.join()
+        self.assertTrue(cancel.is_set())
+        result = run_session_io(self.session, b"10\n", cancel=cancel)
+        self.assertEqual(result.status, CANCELLED)
+        self.assertEqual(result.output, b"")
+        cancel.clear()
+        result = run_session_io(self.session, b"10\n", cancel=cancel)
+        self.assertEqual(result.status, OK)
+        self.assertEqual(result.output, b"0\n")
+
+    def test_run_module(self):
+        module = dumps(compile_src("enquanto verdadeiro faca\nfim\n"))
+        self.assertEqual(run_module(module, budget=1000), OUT_OF_BUDGET)
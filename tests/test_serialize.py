@@ -1,35 +1,145 @@
 from unittest import TestCase
 
-from amanda.compiler.bindump import dumps, into_bson_int32, into_int32
+from amanda.compiler.bindump import (
+    dumps,
+    loads,
+    read_sections,
+    pack_line_table,
+    unpack_line_table,
+    ConstTag,
+    Section,
+    HEADER,
+    SECTION,
+    CONST_INT,
+    CONST_REAL,
+    CONST_REF,
+    NAME,
+    FUNCTION,
+)
+
+
+def make_module(**fields):
+    module = {
+        "entry_locals": 2,
+        "entry_max_stack": 3,
+        "constants": [],
+        "globals": [],
+        "ops": bytearray([0, 1, 255]),
+        "functions": [],
+        "line_table": pack_line_table([(0, 1)]),
+    }
+    module.update(fields)
+    return module
 
 
 class TestSerialize(TestCase):
-    def test_string(self):
-        doc = {"name": "João Boris"}
-        ser_doc = dumps(doc)
-        print("STRING_FIELD: ", [int(byte) for byte in ser_doc])
-
-    def test_dict(self):
-        doc = {"user": {"name": "João Boris", "age": 28, "balance": 1000.52}}
-        ser_doc = dumps(doc)
-        print("DOC_FIELD: ", [int(byte) for byte in ser_doc])
-
-    def test_array(self):
-        doc = {"names": ["João Boris", "Some other dude"]}
-        ser_doc = dumps(doc)
-        print("ARRAY: ", [int(byte) for byte in ser_doc])
-
-    def test_bytes(self):
-        doc = {"bytes": bytes([0, 1, 1, 2, 3, 255])}
-        ser_doc = dumps(doc)
-        print("BYTES: ", [int(byte) for byte in ser_doc])
-
-    def test_i64(self):
-        doc = {"age": 100}
-        ser_doc = dumps(doc)
-        print("I64: ", [int(byte) for byte in ser_doc])
-
-    def test_f64(self):
-        doc = {"credit": 100.50}
-        ser_doc = dumps(doc)
-        print("F64: ", [int(byte) for byte in ser_doc])
+    def test_header(self):
+        bin_module = dumps(make_module())
+        magic, version, count, locals_, max_stack = HEADER.unpack_from(
+            bin_module
+        )
+        self.assertEqual(magic, b"AMAC")
+        self.assertEqual(version, 3)
+        self.assertEqual(count, len(Section))
+        self.assertEqual((locals_, max_stack), (2, 3))
+
+    def test_sections_are_aligned(self):
+        bin_module = dumps(make_module(constants=["abc"], globals=["x"]))
+        for i in range(len(Section)):
+            _, offset, _ = SECTION.unpack_from(
+                bin_module, HEADER.size + i * SECTION.size
+            )
+            self.assertEqual(offset % 8, 0)
+        sections = read_sections(bin_module)
+        self.assertEqual(sections[Section.CODE], bytes([0, 1, 255]))
+
+    def test_constants(self):
+        constants = [1, -2.5, "João", True, None]
+        sections = read_sections(dumps(make_module(constants=constants)))
+        consts = sections[Section.CONSTANTS]
+        self.assertEqual(len(consts), CONST_REF.size * len(constants))
+        self.assertEqual(CONST_INT.unpack_from(consts, 0), (ConstTag.INT, 0, 1))
+        self.assertEqual(
+            CONST_REAL.unpack_from(consts, 16), (ConstTag.REAL, 0, -2.5)
+        )
+        tag, size, offset = CONST_REF.unpack_from(consts, 32)
+        self.assertEqual(tag, ConstTag.STR)
+        strings = sections[Section.STRINGS]
+        string = bytes(strings[offset : offset + size])
+        self.assertEqual(string.decode(), "João")
+        self.assertEqual(
+            CONST_REF.unpack_from(consts, 48), (ConstTag.BOOL, 0, 1)
+        )
+        self.assertEqual(
+            CONST_REF.unpack_from(consts, 64), (ConstTag.NULL, 0, 0)
+        )
+
+    def test_names_are_stored_once(self):
+        functions = [
+            {
+                "name": "f",
+                "start_ip": 9,
+                "locals": 1,
+                "params": 1,
+                "max_stack": 2,
+                "param_types": "[i",
+            }
+        ]
+        module = make_module(
+            constants=["f"], globals=["f", "escreva"], functions=functions
+        )
+        sections = read_sections(dumps(module))
+        self.assertEqual(sections[Section.STRINGS], b"fescreva[i")
+        globals_ = sections[Section.GLOBALS]
+        self.assertEqual(NAME.unpack_from(globals_, 0), (0, 1))
+        self.assertEqual(NAME.unpack_from(globals_, NAME.size), (1, 7))
+        function = FUNCTION.unpack_from(sections[Section.FUNCTIONS])
+        self.assertEqual(function, (0, 1, 9, 1, 1, 2, 8, 2))
+
+    def test_unsupported_constant(self):
+        with self.assertRaises(NotImplementedError):
+            dumps(make_module(constants=[[1]]))
+
+    def test_line_table(self):
+        table = pack_line_table([(0, 1), (3, 2), (300, 1), (301, 200)])
+        self.assertEqual(list(table), [0, 2, 3, 2, 169, 2, 1, 1, 142, 3])
+
+    def test_loads(self):
+        functions = [
+            {
+                "name": "f",
+                "start_ip": 9,
+                "locals": 1,
+                "params": 1,
+                "max_stack": 2,
+                "param_types": "[i",
+            }
+        ]
+        module = make_module(
+            constants=[1, 2.5, "João", False, None],
+            globals=["f", "x"],
+            functions=functions,
+        )
+        loaded = loads(dumps(module))
+        self.assertEqual(loaded["ops"], module["ops"])
+        self.assertEqual(loaded["line_table"], module["line_table"])
+        del loaded["ops"], loaded["line_table"]
+        del module["ops"], module["line_table"]
+        self.assertEqual(loaded, module)
+
+    def test_loads_does_not_copy(self):
+        bin_module = bytearray(dumps(make_module()))
+        ops = loads(bin_module)["ops"]
+        self.assertIsInstance(ops, memoryview)
+        self.assertIs(ops.obj, bin_module)
+
+    def test_bad_module(self):
+        bin_module = bytearray(dumps(make_module()))
+        bin_module[0] = ord("B")
+        with self.assertRaises(ValueError):
+            loads(bin_module)
+
+    def test_unpack_line_table(self):
+        entries = [(0, 1), (3, 2), (300, 1), (301, 200)]
+        table = memoryview(pack_line_table(entries))
+        self.assertEqual(unpack_line_table(table), entries)
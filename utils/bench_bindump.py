@@ -0,0 +1,79 @@
+import argparse
+import time
+from typing import Any, Dict
+from amanda.compiler.bindump import dumps
+
+
+def make_module(num_funcs: int, num_consts: int) -> Dict[str, Any]:
+    """Builds a module shaped like the ones produced by ByteGen."""
+    constants = []
+    for i in range(num_consts):
+        constants.append((i, float(i) + 0.5, f"texto {i}", i % 2 == 0)[i % 4])
+    functions = [
+        {
+            "name": f"f{i}",
+            "start_ip": i * 64,
+            "locals": 4,
+            "params": 2,
+            "max_stack": 8,
+            "param_types": "ir",
+        }
+        for i in range(num_funcs)
+    ]
+    return {
+        "entry_locals": 16,
+        "entry_max_stack": 8,
+        "constants": constants,
+        "globals": [func["name"] for func in functions],
+        "ops": bytes(num_funcs * 64),
+        "functions": functions,
+        "line_table": bytes(num_funcs * 8),
+    }
+
+
+def time_dumps(module: Dict[str, Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        dumps(module)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measures how long bindump takes to serialize a module"
+    )
+    parser.add_argument(
+        "-f",
+        "--functions",
+        help="Number of functions in the module",
+        type=int,
+        default=5000,
+    )
+    parser.add_argument(
+        "-c",
+        "--constants",
+        help="Number of constants in the module",
+        type=int,
+        default=20000,
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        help="Number of times the module is serialized. The best time is reported",
+        type=int,
+        default=5,
+    )
+    args = parser.parse_args()
+
+    module = make_module(args.functions, args.constants)
+    print(f"functions:   {args.functions}")
+    print(f"constants:   {args.constants}")
+    print(f"module size: {len(dumps(module))} bytes")
+    print(f"dumps:       {time_dumps(module, args.repeat) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from os import path
+from typing import Any, Tuple
+from amanda.__main__ import run_frontend
+from amanda.compiler import ast
+from amanda.compiler.codegen import ByteGen
+
+# Chunk of code repeated to build the program. Each copy gets its own names
+CHUNK = """func f{i}(n: int): int
+    total : int = 0
+    para j de 0..n faca
+        se j % 2 == 0 entao
+            total += j
+        senao
+            total -= 1
+        fim
+    fim
+    retorna total
+fim
+x{i} : int = f{i}({i})
+"""
+
+CHUNK_LINES = CHUNK.count("\n")
+
+
+def make_program(lines: int) -> str:
+    return "".join(CHUNK.format(i=i) for i in range(lines // CHUNK_LINES))
+
+
+def time_codegen(
+    program: ast.Program, repeat: int, **options: Any
+) -> Tuple[ByteGen, bytes, float]:
+    best = float("inf")
+    for _ in range(repeat):
+        compiler = ByteGen(**options)
+        start = time.perf_counter()
+        module = compiler.compile(program)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+    return compiler, module, best
+
+
+def peak_memory(program: ast.Program, **options: Any) -> int:
+    tracemalloc.start()
+    ByteGen(**options).compile(program)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measures how long ByteGen takes to compile a large program"
+    )
+    parser.add_argument(
+        "-l",
+        "--lines",
+        help="Number of lines of the generated program",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        help="Number of times codegen is run. The best time is reported",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "-m",
+        "--memory",
+        help="Also report the peak memory used by codegen",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="Encode ops as they are generated instead of keeping them in a list",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = path.join(tmp_dir, "bench.ama")
+        with open(filename, "w", encoding="utf-8") as src_file:
+            src_file.write(make_program(args.lines))
+        start = time.perf_counter()
+        program = run_frontend(filename)
+        frontend = time.perf_counter() - start
+
+    compiler, module, elapsed = time_codegen(
+        program, args.repeat, stream=args.stream
+    )
+    print(f"lines:       {args.lines}")
+    if not args.stream:
+        print(f"ops:         {len(compiler.ops)}")
+    print(f"code size:   {len(compiler.code)} bytes")
+    print(f"module size: {len(module)} bytes")
+    print(f"frontend:    {frontend:.3f}s")
+    print(f"codegen:     {elapsed:.3f}s")
+    if args.memory:
+        peak = peak_memory(program, stream=args.stream)
+        print(f"peak memory: {peak / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
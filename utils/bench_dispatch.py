@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from os import path
+from typing import List, Tuple
+from amanda.__main__ import run_frontend
+from amanda.compiler.codegen import ByteGen
+from amanda.libamanda import run_module, dispatch_count
+
+# Programs used to measure how many ops the vm dispatches
+WORKLOADS = {
+    "soma_enquanto": """
+func soma(n: int): int
+    total : int = 0
+    i : int = 0
+    enquanto i < n faca
+        total = total + i
+        i += 1
+    fim
+    retorna total
+fim
+mostra soma({n})
+""",
+    "soma_para": """
+func soma(n: int): int
+    total : int = 0
+    para i de 0..n faca
+        total += i
+    fim
+    retorna total
+fim
+mostra soma({n})
+""",
+    "primos": """
+func conta_primos(n: int): int
+    total : int = 0
+    para i de 2..n faca
+        primo : bool = verdadeiro
+        d : int = 2
+        enquanto d * d <= i faca
+            se i % d == 0 entao
+                primo = falso
+                quebra
+            fim
+            d += 1
+        fim
+        se primo entao
+            total += 1
+        fim
+    fim
+    retorna total
+fim
+mostra conta_primos({n})
+""",
+    "fibo": """
+func fibo(n : int) : int
+    se n < 2 entao
+       retorna n
+    fim
+    retorna fibo(n-1) + fibo(n-2)
+fim
+mostra fibo({n})
+""",
+}
+
+WORKLOAD_SIZE = {
+    "soma_enquanto": 100000,
+    "soma_para": 100000,
+    "primos": 20000,
+    "fibo": 20,
+}
+
+
+def compile_workload(filename: str, fuse_ops: bool) -> Tuple[ByteGen, bytes]:
+    compiler = ByteGen(fuse_ops=fuse_ops)
+    module = compiler.compile(run_frontend(filename))
+    return compiler, module
+
+
+def run_silently(module: bytes) -> float:
+    # The vm writes directly to fd 1, so redirect it at the os level
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start = time.perf_counter()
+        run_module(module)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.dup2(stdout, 1)
+        os.close(devnull)
+        os.close(stdout)
+    return elapsed
+
+
+def bench(name: str, src: str) -> List[Tuple[int, int, float]]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = path.join(tmp_dir, f"{name}.ama")
+        with open(filename, "w", encoding="utf-8") as src_file:
+            src_file.write(src)
+        results = []
+        for fuse_ops in (False, True):
+            compiler, module = compile_workload(filename, fuse_ops)
+            elapsed = run_silently(module)
+            results.append((len(compiler.ops), dispatch_count(), elapsed))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compares the number of ops dispatched by the vm with and without superinstructions"
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        help="Multiplier applied to the size of each workload",
+        type=float,
+        default=1.0,
+    )
+    args = parser.parse_args()
+
+    header = f"{'workload':<15}{'ops':>12}{'dispatches':>26}{'reduction':>10}{'time (s)':>18}"
+    print(header)
+    print("-" * len(header))
+    for name, src in WORKLOADS.items():
+        size = WORKLOAD_SIZE[name]
+        if name != "fibo":
+            size = int(size * args.scale)
+        plain, fused = bench(name, src.format(n=size))
+        reduction = 1 - fused[1] / plain[1]
+        print(
+            f"{name:<15}{plain[0]:>6}{fused[0]:>6}{plain[1]:>13}{fused[1]:>13}"
+            f"{reduction:>10.1%}{plain[2]:>9.3f}{fused[2]:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from os import path
+from amanda.__main__ import run_frontend
+from amanda.compiler.codegen import ByteGen
+from amanda.libamanda import run_module
+
+# Program that writes n lines, half with mostra and half with escrevaln
+PROGRAM = """
+para i de 0..{n} faca
+    se i % 2 == 0 entao
+        mostra i
+    senao
+        escrevaln(i)
+    fim
+fim
+"""
+
+
+def run_to_file(module: bytes, filename: str, buffered: bool) -> float:
+    # The vm writes directly to fd 1, so redirect it at the os level
+    sys.stdout.flush()
+    stdout = os.dup(1)
+    output = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(output, 1)
+    try:
+        start = time.perf_counter()
+        run_module(module, buffered)
+        elapsed = time.perf_counter() - start
+    finally:
+        os.dup2(stdout, 1)
+        os.close(output)
+        os.close(stdout)
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compares the time taken to write many lines with and without buffered output"
+    )
+    parser.add_argument(
+        "-n",
+        "--lines",
+        help="Number of lines written by the program",
+        type=int,
+        default=1000000,
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = path.join(tmp_dir, "bench.ama")
+        with open(filename, "w", encoding="utf-8") as src_file:
+            src_file.write(PROGRAM.format(n=args.lines))
+        module = ByteGen().compile(run_frontend(filename))
+        output = path.join(tmp_dir, "output.txt")
+        unbuffered = run_to_file(module, output, False)
+        buffered = run_to_file(module, output, True)
+        size = path.getsize(output)
+
+    print(f"lines:      {args.lines}")
+    print(f"output:     {size} bytes")
+    print(f"unbuffered: {unbuffered:.3f}s")
+    print(f"buffered:   {buffered:.3f}s")
+
+
+if __name__ == "__main__":
+    main()